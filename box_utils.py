@@ -0,0 +1,177 @@
+"""
+Overlap scores of axis aligned boxes.
+
+Boxes are arrays of [..., 4], [left, top, right, bottom]. The element-wise
+functions broadcast their arguments like any numpy operation, the pairwise
+ones compute [N, M] matrices in row chunks within a memory budget.
+
+Usage:
+    iou(pred_bbox, gt_bbox)                 # [T] from two [T, 4]
+    pairwise_iou(proposals, gt_bbox)        # [N, M] from [N, 4] and [M, 4]
+    for start, block in iter_pairwise(iou, boxes1, boxes2):
+        best[start: start + block.shape[0]] = block.max(axis=1)
+"""
+
+import numpy as np
+
+# Budget of the temporary arrays of a pairwise chunk, in bytes.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Rough number of temporary float64 arrays per score of a chunk.
+NUM_TEMPS = 16
+
+
+def _get_coords(boxes):
+    """Split boxes into float64 coordinates."""
+    boxes = np.asarray(boxes, dtype='float64')
+    return boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+
+
+def _safe_div(num, den):
+    """Divide, zero where the denominator is not positive."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den > 0, num / den, 0.0)
+
+
+def get_area(boxes):
+    """Area of boxes, zero for empty ones.
+
+    Args:
+        boxes: [..., 4].
+
+    Returns:
+        area: [...].
+    """
+    left, top, right, bot = _get_coords(boxes)
+    return np.maximum(right - left, 0) * np.maximum(bot - top, 0)
+
+
+def get_intersection(boxes1, boxes2):
+    """Intersection area of boxes.
+
+    Args:
+        boxes1: [..., 4].
+        boxes2: [..., 4].
+
+    Returns:
+        inter: [...], broadcast shape of the arguments.
+    """
+    left1, top1, right1, bot1 = _get_coords(boxes1)
+    left2, top2, right2, bot2 = _get_coords(boxes2)
+    width = np.minimum(right1, right2) - np.maximum(left1, left2)
+    height = np.minimum(bot1, bot2) - np.maximum(top1, top2)
+    return np.maximum(width, 0) * np.maximum(height, 0)
+
+
+def iou(boxes1, boxes2):
+    """Intersection over union.
+
+    Args:
+        boxes1: [..., 4].
+        boxes2: [..., 4].
+
+    Returns:
+        score: [...], in [0, 1].
+    """
+    inter = get_intersection(boxes1, boxes2)
+    union = get_area(boxes1) + get_area(boxes2) - inter
+    return _safe_div(inter, union)
+
+
+def iom(boxes1, boxes2):
+    """Intersection over the smaller area, i.e. max(precision, recall).
+
+    Args:
+        boxes1: [..., 4].
+        boxes2: [..., 4].
+
+    Returns:
+        score: [...], in [0, 1].
+    """
+    inter = get_intersection(boxes1, boxes2)
+    return _safe_div(inter, np.minimum(get_area(boxes1), get_area(boxes2)))
+
+
+def giou(boxes1, boxes2):
+    """Generalized intersection over union.
+
+    IOU minus the fraction of the smallest enclosing box not covered by the
+    union, so disjoint boxes still get a score that grows as they get closer.
+
+    Args:
+        boxes1: [..., 4].
+        boxes2: [..., 4].
+
+    Returns:
+        score: [...], in [-1, 1].
+    """
+    left1, top1, right1, bot1 = _get_coords(boxes1)
+    left2, top2, right2, bot2 = _get_coords(boxes2)
+    inter = get_intersection(boxes1, boxes2)
+    union = get_area(boxes1) + get_area(boxes2) - inter
+    hull = (np.maximum(right1, right2) - np.minimum(left1, left2)) * \
+        (np.maximum(bot1, bot2) - np.minimum(top1, top2))
+    return _safe_div(inter, union) - _safe_div(hull - union, hull)
+
+
+def get_chunk_rows(num_cols, max_bytes=DEFAULT_MAX_BYTES):
+    """Number of rows of a pairwise chunk that fits in a memory budget."""
+    return max(1, int(max_bytes // (max(num_cols, 1) * 8 * NUM_TEMPS)))
+
+
+def iter_pairwise(score_fn, boxes1, boxes2, max_bytes=DEFAULT_MAX_BYTES):
+    """Iterate a pairwise score matrix in row chunks.
+
+    Args:
+        score_fn: element-wise score, e.g. iou, iom or giou.
+        boxes1: [N, 4].
+        boxes2: [M, 4].
+        max_bytes: budget of the temporary arrays of a chunk.
+
+    Returns:
+        iterator of (start, block), block is [R, M], rows start to
+        start + R of the matrix.
+    """
+    boxes1 = np.asarray(boxes1).reshape([-1, 4])
+    boxes2 = np.asarray(boxes2).reshape([-1, 4])
+    num_rows = get_chunk_rows(boxes2.shape[0], max_bytes)
+    for start in xrange(0, boxes1.shape[0], num_rows):
+        block = boxes1[start: start + num_rows]
+        yield start, score_fn(block[:, None, :], boxes2[None, :, :])
+
+
+def pairwise(score_fn, boxes1, boxes2, max_bytes=DEFAULT_MAX_BYTES,
+             dtype='float32'):
+    """Pairwise score matrix, computed in row chunks.
+
+    Args:
+        score_fn: element-wise score, e.g. iou, iom or giou.
+        boxes1: [N, 4].
+        boxes2: [M, 4].
+        max_bytes: budget of the temporary arrays of a chunk.
+        dtype: type of the output.
+
+    Returns:
+        score: [N, M].
+    """
+    boxes1 = np.asarray(boxes1).reshape([-1, 4])
+    boxes2 = np.asarray(boxes2).reshape([-1, 4])
+    score = np.zeros([boxes1.shape[0], boxes2.shape[0]], dtype=dtype)
+    for start, block in iter_pairwise(score_fn, boxes1, boxes2, max_bytes):
+        score[start: start + block.shape[0]] = block
+    return score
+
+
+def pairwise_iou(boxes1, boxes2, max_bytes=DEFAULT_MAX_BYTES):
+    """[N, M] intersection over union, see pairwise."""
+    return pairwise(iou, boxes1, boxes2, max_bytes)
+
+
+def pairwise_iom(boxes1, boxes2, max_bytes=DEFAULT_MAX_BYTES):
+    """[N, M] intersection over the smaller area, see pairwise."""
+    return pairwise(iom, boxes1, boxes2, max_bytes)
+
+
+def pairwise_giou(boxes1, boxes2, max_bytes=DEFAULT_MAX_BYTES):
+    """[N, M] generalized intersection over union, see pairwise."""
+    return pairwise(giou, boxes1, boxes2, max_bytes)
@@ -0,0 +1,92 @@
+"""
+Benchmarks of the box overlap utilities.
+
+Usage:
+    python box_utils_bench.py pairwise --num_boxes 500 200
+    python box_utils_bench.py pairwise --num_boxes 20000 5000 --no_loop
+"""
+
+import argparse
+import box_utils
+import logger
+import numpy
+import time
+
+log = logger.get()
+
+
+def make_boxes(random, num, im_height=375, im_width=1242):
+    """Random boxes inside a KITTI sized image."""
+    left = random.uniform(0, im_width - 20, num)
+    top = random.uniform(0, im_height - 20, num)
+    width = random.uniform(5, 200, num)
+    height = random.uniform(5, 150, num)
+    return numpy.stack([left, top, left + width, top + height], axis=1)
+
+
+def _loop_iou(box1, box2):
+    """Scalar intersection over union, as computed before box_utils."""
+    left_ = max(box1[0], box2[0])
+    top_ = max(box1[1], box2[1])
+    right_ = min(box1[2], box2[2])
+    bot_ = min(box1[3], box2[3])
+    inter = max(right_ - left_, 0) * max(bot_ - top_, 0)
+    union = (box1[2] - box1[0]) * (box1[3] - box1[1]) + \
+        (box2[2] - box2[0]) * (box2[3] - box2[1]) - inter
+    return inter / union
+
+
+def bench_pairwise(num_boxes, max_bytes_list, loop):
+    """Compare pairwise IOU of a scalar loop and of box_utils.
+
+    Args:
+        num_boxes: list, N and M.
+        max_bytes_list: list, chunk budgets of box_utils.pairwise_iou.
+        loop: bool, whether to run the scalar loop.
+    """
+    random = numpy.random.RandomState(0)
+    boxes1 = make_boxes(random, num_boxes[0])
+    boxes2 = make_boxes(random, num_boxes[1])
+    num_pairs = boxes1.shape[0] * boxes2.shape[0]
+    ref = None
+    if loop:
+        start = time.time()
+        ref = numpy.zeros([boxes1.shape[0], boxes2.shape[0]])
+        for ii in xrange(boxes1.shape[0]):
+            for jj in xrange(boxes2.shape[0]):
+                ref[ii, jj] = _loop_iou(boxes1[ii], boxes2[jj])
+        elapsed = time.time() - start
+        log.info('Loop: {:.3f}s, {:.2f}M pairs/s'.format(
+            elapsed, num_pairs / elapsed / 1e6))
+
+    for max_bytes in max_bytes_list:
+        start = time.time()
+        score = box_utils.pairwise_iou(boxes1, boxes2, max_bytes=max_bytes)
+        elapsed = time.time() - start
+        chunk_rows = box_utils.get_chunk_rows(boxes2.shape[0], max_bytes)
+        log.info('Pairwise, {:d}MB budget ({:d} rows per chunk): {:.3f}s, '
+                 '{:.2f}M pairs/s'.format(
+                     max_bytes / 1024 / 1024, chunk_rows, elapsed,
+                     num_pairs / elapsed / 1e6))
+        if ref is not None:
+            log.info('Max difference to loop: {:.2e}'.format(
+                numpy.abs(score - ref).max()))
+    pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Box utility benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_pairwise = subparsers.add_parser(
+        'pairwise', help='Pairwise IOU matrix, scalar loop vs vectorized')
+    parser_pairwise.add_argument('--num_boxes', type=int, nargs=2,
+                                 default=[500, 200])
+    parser_pairwise.add_argument('--max_mb', type=int, nargs='+',
+                                 default=[1, 64])
+    parser_pairwise.add_argument('--no_loop', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'pairwise':
+        bench_pairwise(args.num_boxes,
+                       [mb * 1024 * 1024 for mb in args.max_mb],
+                       not args.no_loop)
@@ -13,7 +13,8 @@ import kitti_new as kitti
 import conv_lstm_tracker_model
 import seg_tracker_model
 import orientation_plotter
-from tfplus.utils import BatchIterator, ConcurrentBatchIterator
+from tfplus.utils import BatchIterator
+from tracking_data_provider import BatchLoader
 
 tfplus.init('Train a Conv-LSTM tracker on KITTI')
 
@@ -27,6 +28,7 @@ tfplus.cmd_args.add('restore_model', 'str', None)
 tfplus.cmd_args.add('restore_logs', 'str', None)
 tfplus.cmd_args.add('batch_size', 'int', 8)
 tfplus.cmd_args.add('prefetch', 'bool', False)
+tfplus.cmd_args.add('seed', 'int', 1234)
 opt = tfplus.cmd_args.make()
 
 DATASET = 'kitti_track'
@@ -38,6 +40,41 @@ log = tfplus.utils.logger.get(os.path.join(logs_folder, 'raw'))
 tfplus.utils.LogManager(logs_folder).register('raw', 'plain', 'Raw Logs')
 results_folder = os.path.join(opt['results'], uid)
 
+# Intialize data.
+data = {}
+for split in ['train', 'valid']:
+    data[split] = tfplus.data.create_from_main(DATASET, split=split)
+
+
+def get_data(split, batch_size=4, cycle=True, max_queue_size=10,
+             num_workers=4, seed=0):
+    if opt['prefetch']:
+        # Batches are assembled by worker processes, as decoding holds the
+        # GIL.
+        return BatchLoader(
+            data[split], batch_size=batch_size, shuffle=True, cycle=cycle,
+            num_workers=num_workers, num_slots=max_queue_size,
+            seed=seed)
+    return BatchIterator(
+        num=data[split].get_size(), progress_bar=False, shuffle=True,
+        batch_size=batch_size, cycle=cycle,
+        get_fn=data[split].get_batch_idx)
+
+
+# Loaders fork their workers here, before the session and the model hold a
+# TensorFlow runtime and GPU context that the workers would inherit. Each
+# loader has its own seed, so that trainval and plots do not follow the
+# training order.
+iters = {
+    'train': get_data('train', batch_size=opt['batch_size'], cycle=True,
+                      max_queue_size=5, num_workers=4, seed=opt['seed']),
+    'trainval': get_data('train', batch_size=1, cycle=True,
+                         max_queue_size=2, num_workers=1,
+                         seed=opt['seed'] + 1),
+    'plot': get_data('train', batch_size=2, cycle=True,
+                     max_queue_size=2, num_workers=1, seed=opt['seed'] + 2)
+}
+
 # Initialize session.
 sess = tf.Session()
 tf.set_random_seed(1234)
@@ -56,24 +93,6 @@ if opt['restore_model'] is not None:
 else:
     model.init(sess)
 
-# Intialize data.
-data = {}
-for split in ['train', 'valid']:
-    data[split] = tfplus.data.create_from_main(DATASET, split=split)
-
-
-def get_data(split, batch_size=4, cycle=True, max_queue_size=10,
-             num_threads=10):
-    batch_iter = BatchIterator(
-        num=data[split].get_size(), progress_bar=False, shuffle=True,
-        batch_size=batch_size, cycle=cycle,
-        get_fn=data[split].get_batch_idx)
-    if opt['prefetch']:
-        batch_iter = ConcurrentBatchIterator(
-            batch_iter, max_queue_size=max_queue_size,
-            num_threads=num_threads)
-    return batch_iter
-
 # Initialize experiment.
 exp = (
     tfplus.experiment.create_from_main('train')
@@ -107,8 +126,7 @@ exp = (
         .add_cmd_listener('Step', 'step')
         .add_cmd_listener('Loss', 'loss')
         .add_cmd_listener('Step Time', 'step_time')
-        .set_iter(get_data('train', batch_size=opt['batch_size'],
-                           cycle=True, max_queue_size=10, num_threads=10))
+        .set_iter(iters['train'])
         .set_phase_train(True)
         .set_num_batch(10)
         .set_interval(1))
@@ -119,8 +137,7 @@ exp = (
         .add_output('gt_switch')
         .add_csv_listener('GT Switch', 'gt_switch', 'train')
         .add_cmd_listener('GT Switch', 'gt_switch')
-        .set_iter(get_data('train', batch_size=1, cycle=True,
-                           max_queue_size=1, num_threads=1))
+        .set_iter(iters['trainval'])
         .set_phase_train(False)
         .set_num_batch(1)
         .set_interval(50)
@@ -134,8 +151,7 @@ runner_plot = (
     .add_plot_listener('Input (Train)', {'x': 'images'})
     .add_plot_listener('GT (Train)', {'bbox_gt_dense': 'images'})
     .add_plot_listener('Output (Train)', {'bbox_out_dense': 'images'})
-    .set_iter(get_data('train', batch_size=2, cycle=True,
-                       max_queue_size=1, num_threads=1))
+    .set_iter(iters['plot'])
     .set_phase_train(False)
     .set_offset(0)
     .set_interval(20)       # Every 200 steps
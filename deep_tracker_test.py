@@ -10,6 +10,7 @@ import cv2
 import math
 import logger
 
+import box_utils
 import deep_tracker_utils as ut
 import build_deep_tracker as dt
 
@@ -42,14 +43,17 @@ if __name__ == "__main__":
     num_valid_seq = 0
     train_data_full = get_dataset(folder, 'train')
 
-    with sh.ShardedFileReader(train_data_full) as reader:
-        num_seq = len(reader)
+    # Images are read lazily, only the tested frames are loaded, so the 
+    # reader stays open until the end of testing.
+    reader = sh.ShardedFileReader(train_data_full)
+    num_seq = len(reader)
 
-        for idx_seq, seq_data in enumerate(pb.get_iter(reader)):
-            if idx_seq >= num_train_seq:
-                if seq_data['gt_bbox'].shape[0] > 0:
-                    valid_video_seq.append(seq_data)
-                    num_valid_seq += 1
+    for idx_seq, seq_num in enumerate(pb.get_iter(reader.keys())):
+        if idx_seq >= num_train_seq:
+            seq_data = reader.read_key(seq_num, lazy=['images_0', 'images_1'])
+            if seq_data['gt_bbox'].shape[0] > 0:
+                valid_video_seq.append(seq_data)
+                num_valid_seq += 1
 
     # setting model
     opt_tracking = {}
@@ -85,8 +89,7 @@ if __name__ == "__main__":
     saver.restore(
         sess, "/ais/gobi4/rjliao/Projects/Kitti/tracking_models/deep_tracker_0018000.ckpt")
 
-    nodes_run = ['IOU_score', 'predict_bbox',
-                 'predict_score', 'final_rnn_state']
+    nodes_run = ['predict_bbox', 'predict_score', 'final_rnn_state']
     node_list = [tracking_model[i] for i in nodes_run]
 
     # testing loop
@@ -166,7 +169,8 @@ if __name__ == "__main__":
                 last_rnn_state = results_dict['final_rnn_state']
                 pred_bbox.append(results_dict['predict_bbox'])
                 pred_score.append(results_dict['predict_score'])
-                IOU_score.append(results_dict['IOU_score'])
+                IOU_score.append(box_utils.iou(
+                    results_dict['predict_bbox'], batch_box[:, 1:]))
 
                 # save results
                 print IOU_score
@@ -181,3 +185,4 @@ if __name__ == "__main__":
                                        raw_imgs[start_idx_frame:], pred_bbox, gt_bbox[start_idx_frame:], pred_score)
 
     sess.close()
+    reader.close()
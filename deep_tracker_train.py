@@ -44,16 +44,19 @@ if __name__ == "__main__":
     num_valid_seq = 0
     train_data_full = get_dataset(folder, 'train')
     
-    with sh.ShardedFileReader(train_data_full) as reader:    
-        num_seq = len(reader)
-        
-        for idx_seq, seq_data in enumerate(pb.get_iter(reader)):
-            if idx_seq < num_train_seq:
-                train_video_seq.append(seq_data)
-            else:            
-                if seq_data['gt_bbox'].shape[0] > 0:
-                    valid_video_seq.append(seq_data)
-                    num_valid_seq += 1
+    # Images are read lazily, only the sampled frames are loaded, so the 
+    # reader stays open until the end of training.
+    reader = sh.ShardedFileReader(train_data_full)
+    num_seq = len(reader)
+
+    for idx_seq, seq_num in enumerate(pb.get_iter(reader.keys())):
+        seq_data = reader.read_key(seq_num, lazy=['images_0', 'images_1'])
+        if idx_seq < num_train_seq:
+            train_video_seq.append(seq_data)
+        else:            
+            if seq_data['gt_bbox'].shape[0] > 0:
+                valid_video_seq.append(seq_data)
+                num_valid_seq += 1
     
     # logger for saving intermediate output
     model_id = 'deep-tracker-002'
@@ -227,3 +230,4 @@ if __name__ == "__main__":
         step += 1
 
     sess.close()
+    reader.close()
@@ -1,10 +1,13 @@
+import collections
 import cv2
 import h5py
 import logger
+import multiprocessing
 import numpy as np
 import os
 import progress_bar as pb
 import sharded_hdf5 as sh
+import time
 
 log = logger.get()
 
@@ -15,12 +18,204 @@ def add_3d_bbox(folder, split):
     _3d_bbox_folder = os.path.join(folder, split, '3d_bbox')
 
 
-def get_dataset(folder, split):
+def _read_labels(folder, split, seq_num):
+    """Read labels of a KITTI training sequence.
+
+    Args:
+        folder: root directory.
+        split: train or test.
+        seq_num: string, sequence folder name.
+
+    Returns:
+        seq_data: dict, label fields of the sequence item, empty if not 
+        training.
+        frame_start: first labelled frame, None if not training.
+        frame_end: last labelled frame, None if not training.
+    """
+    seq_data = {}
+    frame_start = None
+    frame_end = None
+    if split != 'train':
+        return seq_data, frame_start, frame_end
+
+    label_folder = os.path.join(folder, split + 'ing', 'label_02')
+    target_types = set(['Van', 'Car', 'Truck'])
+    label_fname = os.path.join(label_folder, seq_num + '.txt')
+    obj_data = {}
+    with open(label_fname) as label_f:
+        lines = label_f.readlines()
+        for ll in lines:
+            parts = ll.split(' ')
+            frame_no = int(parts[0])
+            ins_no = int(parts[1])
+            typ = parts[2]
+            truncated = int(parts[3])
+            occluded = int(parts[4])
+            bleft = float(parts[6])
+            btop = float(parts[7])
+            bright = float(parts[8])
+            bbot = float(parts[9])
+            if frame_start is None:
+                frame_start = frame_no
+                frame_end = frame_no
+            else:
+                frame_start = min(frame_start, frame_no)
+                frame_end = max(frame_end, frame_no)
+
+            raw_data = {
+                'frame_no': frame_no,
+                'ins_no': ins_no,
+                'typ': typ,
+                'truncated': truncated,
+                'occluded': occluded,
+                'bbox': (bleft, btop, bright, bbot)
+            }
+            if ins_no != -1 and typ in target_types:
+                if ins_no in obj_data:
+                    obj_data[ins_no].append(raw_data)
+                else:
+                    obj_data[ins_no] = [raw_data]
+
+    num_ins = len(obj_data.keys())
+    num_frames = frame_end - frame_start + 1
+    bbox = np.zeros([num_ins, num_frames, 5], dtype='float32')
+    idx_map = []
+
+    for idx in obj_data.iterkeys():
+        new_idx = len(idx_map)
+        for dd in obj_data[idx]:
+            new_frame = dd['frame_no'] - frame_start
+            bbox[new_idx, new_frame, 4] = 1.0
+            bbox[new_idx, new_frame, 0: 4] = dd['bbox']
+        idx_map.append(idx)
+    idx_map = np.array(idx_map, dtype='uint8')
+    frame_map = np.arange(frame_start, frame_end + 1)
+
+    seq_data['gt_bbox'] = bbox
+    seq_data['idx_map'] = idx_map
+    seq_data['frame_map'] = frame_map
+
+    return seq_data, frame_start, frame_end
+
+
+def _read_image(fname):
+    """Decode a frame as uint8, None if there is no frame."""
+    if fname is None:
+        return None
+
+    return cv2.imread(fname)
+
+
+def _iter_decoded(pool, fnames, max_pending):
+    """Decode frames in a process pool, in order, at most max_pending ahead
+    of the consumer."""
+    pending = collections.deque()
+    for fname in fnames:
+        if len(pending) == max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(_read_image, (fname,)))
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+    pass
+
+
+def _iter_frames(pool, fnames, max_pending):
+    """Decode frames in a process pool, in order.
+
+    Nothing is decoded before the iterator is consumed, and at most 
+    max_pending frames are decoded ahead, so a sequence is never held in 
+    memory.
+
+    Args:
+        pool: multiprocessing.Pool instance.
+        fnames: list, image file name of each frame, None for missing frames.
+        max_pending: number, maximum number of frames in flight.
+
+    Returns:
+        frames: iterator of [1, H, W, 3] uint8 arrays, zeros for missing 
+        frames.
+    """
+    shape = None
+    num_missing = 0
+    for img in _iter_decoded(pool, fnames, max_pending):
+        if img is None:
+            if shape is None:
+                num_missing += 1
+                continue
+            img = np.zeros(shape, dtype='uint8')
+        elif shape is None:
+            shape = img.shape
+            for ii in xrange(num_missing):
+                yield np.zeros([1] + list(shape), dtype='uint8')
+        yield img.reshape([1] + list(shape))
+
+    if shape is None:
+        raise Exception('No frames found')
+
+    pass
+
+
+def _read_sequence(folder, split, seq_num, pool, max_pending):
+    """Read labels and images of a KITTI sequence.
+
+    Args:
+        folder: root directory.
+        split: train or test.
+        seq_num: string, sequence folder name.
+        pool: multiprocessing.Pool instance, decodes the frames.
+        max_pending: number, maximum number of frames in flight per camera.
+
+    Returns:
+        seq_data: dict, one item of the sharded dataset. Images are iterators 
+        of frames decoded as they are consumed, see _iter_frames.
+        source_bytes: number, size of the image files.
+    """
+    split_ing = split + 'ing'
+    left_folder = os.path.join(folder, split_ing, 'image_02')
+    right_folder = os.path.join(folder, split_ing, 'image_03')
+    seq_data, frame_start, frame_end = _read_labels(folder, split, seq_num)
+
+    camera_fnames = []
+    source_bytes = 0
+    for camera_folder in [left_folder, right_folder]:
+        seq_folder = os.path.join(camera_folder, seq_num)
+        fnames = {}
+        for fname in os.listdir(seq_folder):
+            frame_no = int(fname[: 6])
+            fnames[frame_no] = os.path.join(seq_folder, fname)
+            source_bytes += os.path.getsize(fnames[frame_no])
+        camera_fnames.append(fnames)
+
+    # Training frames follow the labelled range, so that they line up with
+    # gt_bbox and frame_map. Testing frames cover the images of both
+    # cameras.
+    if frame_start is None:
+        frame_nos = [frame_no for fnames in camera_fnames
+                     for frame_no in fnames.iterkeys()]
+        if len(frame_nos) == 0:
+            raise Exception('No frames found in sequence {}'.format(seq_num))
+        frame_start = min(frame_nos)
+        frame_end = max(frame_nos)
+    num_frames = frame_end - frame_start + 1
+    for camera, fnames in enumerate(camera_fnames):
+        seq_data['images_{}'.format(camera)] = _iter_frames(
+            pool, [fnames.get(frame_start + ii) for ii in xrange(num_frames)],
+            max_pending)
+
+    return seq_data, source_bytes
+
+
+def get_dataset(folder, split, num_workers=4):
     """Get KITTI dataset.
 
+    Frames are stored as uint8, decoded by a process pool and streamed into 
+    the shards. An existing dataset is returned as is, delete it to rebuild.
+
     Args:
         folder: root directory.
         split: train or test.
+        num_workers: number of processes decoding frames.
 
     Returns:
         dataset_file: ShardedFile object, use ShardedFileReader to read.
@@ -39,9 +234,7 @@ def get_dataset(folder, split):
         return h5_f
 
     left_folder = os.path.join(folder, split_ing, 'image_02')
-    right_folder = os.path.join(folder, split_ing, 'image_03')
     if split == 'train':
-        label_folder = os.path.join(folder, split_ing, 'label_02')
         seqs = range(13)
     elif split == 'valid':
         seqs = range(13, 21)
@@ -55,112 +248,42 @@ def get_dataset(folder, split):
             seq_list.append(seq_num)
             pass
         pass
+    seq_list = sorted(seq_list)
 
     # Prepare output file
     fname_out = os.path.join(folder, split_ing, 'dataset')
     f_out = sh.ShardedFile(fname_out, num_shards=len(seq_list))
-    target_types = set(['Van', 'Car', 'Truck'])
 
-    with sh.ShardedFileWriter(f_out, num_objects=len(seq_list)) as writer:
-        for seq_num in pb.get_iter(seq_list):
-
-            seq_data = {}
-            frame_start = None
-            frame_end = None
-
-            if split == 'train':
-                label_fname = os.path.join(label_folder, seq_num + '.txt')
-                obj_data = {}
-                idx_map = []
-                with open(label_fname) as label_f:
-                    lines = label_f.readlines()
-                    for ll in lines:
-                        parts = ll.split(' ')
-                        frame_no = int(parts[0])
-                        ins_no = int(parts[1])
-                        typ = parts[2]
-                        truncated = int(parts[3])
-                        occluded = int(parts[4])
-                        bleft = float(parts[6])
-                        btop = float(parts[7])
-                        bright = float(parts[8])
-                        bbot = float(parts[9])
-                        if frame_start is None:
-                            frame_start = frame_no
-                            frame_end = frame_no
-                        else:
-                            frame_start = min(frame_start, frame_no)
-                            frame_end = max(frame_start, frame_no)
-
-                        raw_data = {
-                            'frame_no': frame_no,
-                            'ins_no': ins_no,
-                            'typ': typ,
-                            'truncated': truncated,
-                            'occluded': occluded,
-                            'bbox': (bleft, btop, bright, bbot)
-                        }
-                        if ins_no != -1 and typ in target_types:
-                            if ins_no in obj_data:
-                                obj_data[ins_no].append(raw_data)
-                            else:
-                                obj_data[ins_no] = [raw_data]
-
-                num_ins = len(obj_data.keys())
-                num_frames = frame_end - frame_start + 1
-                bbox = np.zeros([num_ins, num_frames, 5], dtype='float32')
-                idx_map = []
-
-                for idx in obj_data.iterkeys():
-                    new_idx = len(idx_map)
-                    for dd in obj_data[idx]:
-                        new_frame = dd['frame_no'] - frame_start
-                        bbox[new_idx, new_frame, 4] = 1.0
-                        bbox[new_idx, new_frame, 0: 4] = dd['bbox']
-                    idx_map.append(idx)
-                idx_map = np.array(idx_map, dtype='uint8')
-                frame_map = np.arange(frame_start, frame_end + 1)
-
-                seq_data['gt_bbox'] = bbox
-                seq_data['idx_map'] = idx_map
-                seq_data['frame_map'] = frame_map
-
-            for camera, camera_folder in enumerate([left_folder, right_folder]):
-                if seq_num.startswith('0'):
-                    seq_folder = os.path.join(camera_folder, seq_num)
-                else:
-                    continue
-                seq_folder = os.path.join(
-                    folder, split_ing, camera_folder, seq_num)
-                image_list = os.listdir(seq_folder)
-                im_height = None
-                im_width = None
-                images = {}
-                for ii, fname in enumerate(image_list):
-                    img_fname = os.path.join(seq_folder, fname)
-                    log.info(img_fname)
-                    frame_no = int(fname[: 6])
-                    img = cv2.imread(img_fname)
-                    if frame_start is None:
-                        frame_start = frame_no
-                        frame_end = frame_no
-                    else:
-                        frame_start = min(frame_start, frame_no)
-                        frame_end = max(frame_start, frame_no)
-                    if im_height is None:
-                        im_height = img.shape[0]
-                        im_width = img.shape[1]
-                    images[frame_no] = img
-
-                if num_frames is None:
-                    num_frames = frame_end - frame_start + 1
-                final_images = np.zeros([num_frames, im_height, im_width, 3])
-                for ii in images.iterkeys():
-                    final_images[ii] = images
-                    
-                seq_data['images_{}'.format(camera)] = final_images
-
-            writer.write(seq_data)
+    start_time = time.time()
+    source_bytes = 0
+    float64_bytes = 0
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        with sh.ShardedFileWriter(f_out, num_objects=len(seq_list),
+                                  streaming=True) as writer:
+            for seq_num in pb.get_iter(seq_list):
+                seq_data, seq_bytes = _read_sequence(
+                    folder, split, seq_num, pool, 4 * num_workers)
+                source_bytes += seq_bytes
+                writer.write(seq_data)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # Float64 frames, as written before.
+    with sh.ShardedFileReader(f_out) as reader:
+        for seq_num in xrange(len(seq_list)):
+            seq_data = reader.read_key(seq_num, lazy=True)
+            for camera in xrange(2):
+                images = seq_data['images_{}'.format(camera)]
+                float64_bytes += np.prod(images.shape) * 8
+    dataset_bytes = sum([os.path.getsize(f_out.get_fname(shard))
+                         for shard in xrange(f_out.num_shards)])
+    log.info(('Built {} in {:.1f}s, {:.1f}MB on disk ({:.1f}MB as float64, '
+              '{:.1f}MB of PNG)').format(
+        f_out, time.time() - start_time, dataset_bytes / 1048576.0,
+        float64_bytes / 1048576.0, source_bytes / 1048576.0))
 
     return f_out
 
@@ -51,8 +51,15 @@ class KITTITrackingDataAssembler(TrackingDataAssembler):
         return sorted(map(lambda x: x[:6], os.listdir(vid_folder)))
 
     def get_frame_img(self, vid_id, frm_id):
-        fname = os.path.join(self.left_folder, vid_id, frm_id + '.png')
-        return cv2.imread(fname)
+        return cv2.imread(self.get_frame_source(vid_id, frm_id))
+
+    def get_frame_source(self, vid_id, frm_id):
+        return os.path.join(self.left_folder, vid_id, frm_id + '.png')
+
+    def get_obj_source(self, vid_id):
+        if self.label_folder is None:
+            return None
+        return os.path.join(self.label_folder, vid_id + '.txt')
 
     def _read_annotations(self, vid_id):
         label_fname = os.path.join(self.label_folder, vid_id + '.txt')
@@ -162,7 +169,7 @@ if __name__ == '__main__':
         assembler = KITTITrackingDataAssembler(
             '/ais/gobi4/mren/data/kitti/tracking', split=split)
         # print assembler.get_frame_ids('0017')
-        assembler.assemble()
+        assembler.assemble(num_workers=8, incremental=True)
     pass
     # b = tfplus.data.create_from_main('kitti_track').get_batch_idx(np.arange(5))
     # print b['x'].shape
@@ -1,17 +1,77 @@
+import box_utils
+import collections
 import cv2
 import data_utils
 import logger
+import multiprocessing
 import numpy as np
 import os
 import progress_bar as pb
 import sharded_hdf5 as sh
+import time
+import traceback
 
 log = logger.get()
 
+# Patch data, reader and shared outputs of an extraction worker, see
+# _init_extract_worker.
+_extract_worker = None
+
+
+def _init_extract_worker(patch_data, dataset_file, images, labels):
+    """Open the reader of an extraction worker process."""
+    global _extract_worker
+    reader = sh.ShardedFileReader(dataset_file, check=False,
+                                  max_open_files=1)
+    _extract_worker = (patch_data, reader, images, labels)
+
+    pass
+
+
+def _extract_sequence(args):
+    """Extract the patches of a sequence into the shared outputs."""
+    seq_num, start, end = args
+    patch_data, reader, images, labels = _extract_worker
+    try:
+        patch_data.extract_key(reader, seq_num, images[start: end],
+                               labels[start: end])
+    except Exception:
+        raise Exception('Extraction of sequence {} failed:\n{}'.format(
+            seq_num, traceback.format_exc()))
+
+    return seq_num
+
+
+# Patch data, reader and sequences of a sampler worker, see
+# _init_sampler_worker.
+_sampler_worker = None
+
+
+def _init_sampler_worker(patch_data, dataset_file, seq_nums, seq_weights):
+    """Open the reader of a sampler worker process."""
+    global _sampler_worker
+    reader = sh.ShardedFileReader(dataset_file, check=False)
+    _sampler_worker = (patch_data, reader, seq_nums, seq_weights)
+
+    pass
+
+
+def _sample_batch(args):
+    """Sample a mini-batch in a sampler worker."""
+    batch_id, batch_size = args
+    patch_data, reader, seq_nums, seq_weights = _sampler_worker
+    try:
+        return patch_data.sample_batch(
+            reader, batch_id, batch_size, seq_nums, seq_weights)
+    except Exception:
+        raise Exception('Sampling of batch {:d} failed:\n{}'.format(
+            batch_id, traceback.format_exc()))
+
 
 class KITTIPatchData(object):
 
-    def __init__(self, folder, opt, split='train', seqs=None, usage='match'):
+    def __init__(self, folder, opt, split='train', seqs=None, usage='match',
+                 num_workers=0, seed=2):
         """
         Args:
 
@@ -30,13 +90,22 @@ class KITTIPatchData(object):
             split: string, 'train': sequences 0 - 12, 'valid': sequences 13 - 20
 
             seqs: list of sequences.
+
+            num_workers: number of processes extracting sequences in
+            parallel, 0 to extract them one after another in this process.
+
+            seed: master seed. Each sequence gets its own random state
+            derived from it, so the output does not depend on the number of
+            workers.
         """
         self.folder = folder
         self.opt = opt
         self.split = split
         self.seqs = seqs
         self.usage = usage
-        self.random = np.random.RandomState(2)
+        self.num_workers = num_workers
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
         num_ex_pos = self.opt['num_ex_pos']
         num_ex_neg = self.opt['num_ex_neg']
         if split is not None:
@@ -64,90 +133,270 @@ class KITTIPatchData(object):
             cache = data_utils.read_h5_data(self.h5_fname)
             if cache:
                 return cache
-        patch_height = self.opt['patch_height']
-        patch_width = self.opt['patch_width']
-        center_noise = self.opt['center_noise']
-        padding_noise = self.opt['padding_noise']
-        padding_mean = self.opt['padding_mean']
-        num_ex_pos = self.opt['num_ex_pos']
-        num_ex_neg = self.opt['num_ex_neg']
-        shuffle = self.opt['shuffle']
-        folder = self.folder
-        split = self.split
-        seqs = self.seqs
-        usage = self.usage
-        random = self.random
+        dataset_file = self.get_dataset_file()
+        if self.num_workers > 0:
+            final_images, final_labels = self.extract_parallel(dataset_file)
+        else:
+            final_images, final_labels = self.extract_serial(dataset_file)
+        dataset = self.finish_dataset(final_images, final_labels)
+        self.dataset = dataset
 
-        dataset_pattern = os.path.join(folder, 'dataset-*')
-        dataset_file = sh.ShardedFile.from_pattern_read(dataset_pattern)
-        dataset_images = []
-        dataset_labels = []
+        if self.h5_fname is not None:
+            data_utils.write_h5_data(self.h5_fname, dataset)
 
+        return dataset
+
+    def get_dataset_file(self):
+        """Sharded file of the sequences."""
+        dataset_pattern = os.path.join(self.folder, 'dataset-*')
+        return sh.ShardedFile.from_pattern_read(dataset_pattern)
+
+    def get_seqs(self):
+        """Sequences of the split, or the given ones without a split."""
+        split = self.split
         if split is not None:
             if split == 'train':
-                seqs = range(13)
-                self.seqs = seqs
+                self.seqs = range(13)
             elif split == 'valid':
-                seqs = range(13, 21)
-                self.seqs = seqs
+                self.seqs = range(13, 21)
             else:
                 raise Exception('Unknown split: {}'.format(split))
             pass
+        return self.seqs
+
+    def get_num_ex(self, num_obj):
+        """Number of examples of a sequence with num_obj objects."""
+        return (self.opt['num_ex_neg'] + self.opt['num_ex_pos']) * num_obj
 
+    def get_output_shape(self, num_ex):
+        """Shape of the output images of num_ex examples."""
+        patch_height = self.opt['patch_height']
+        patch_width = self.opt['patch_width']
+        if self.usage == 'match':
+            return [num_ex, 2, patch_height, patch_width, 3]
+        elif self.usage == 'detect' or self.usage == 'detect_multiscale':
+            return [num_ex, patch_height, patch_width, 3]
+        else:
+            raise Exception('Unknown usage: {}'.format(self.usage))
+
+    def get_seq_random(self, seq_num):
+        """Random state of a sequence."""
+        return np.random.RandomState([self.seed, int(seq_num)])
+
+    def get_seq_ranges(self, dataset_file):
+        """Examples of each sequence in the final dataset.
+
+        Args:
+            dataset_file: ShardedFile instance.
+
+        Returns:
+            tasks: list of (seq_num, start, end).
+            num_ex: number, total number of examples.
+        """
+        tasks = []
+        num_ex = 0
         with sh.ShardedFileReader(dataset_file) as reader:
-            for seq_num in pb.get_iter(seqs):
-                seq_data = reader[seq_num]
-                images = seq_data['images_0']
-                gt_bbox = seq_data['gt_bbox']
-                num_obj = gt_bbox.shape[0]
-                num_frames = gt_bbox.shape[1]
-                nneg = num_ex_neg * num_obj
-                npos = num_ex_pos * num_obj
-
-                if usage == 'match':
-                    output_images = np.zeros(
-                        [nneg + npos, 2, patch_height, patch_width, 3],
-                        dtype='uint8')
-                elif usage == 'detect' or usage == 'detect_multiscale':
-                    output_images = np.zeros(
-                        [nneg + npos, patch_height, patch_width, 3],
-                        dtype='uint8')
-
-                output_labels = np.zeros([nneg + npos], dtype='uint8')
-                dataset_images.append(output_images)
-                dataset_labels.append(output_labels)
-
-                if num_obj < 2:
-                    continue
-
-                if usage == 'match':
-                    output_images[: nneg], output_labels[: nneg] = \
-                        self.get_neg_pair(nneg, images, gt_bbox)
-
-                    output_images[nneg:], output_labels[nneg:] = \
-                        self.get_pos_pair(npos, images, gt_bbox)
-                elif usage == 'detect':
-                    output_images[: nneg], output_labels[: nneg] = \
-                        self.get_neg_patch(nneg, images, gt_bbox)
-
-                    output_images[nneg:], output_labels[nneg:] = \
-                        self.get_pos_patch(npos, images, gt_bbox)
-                elif usage == 'detect_multiscale':
-                    output_images[: nneg], output_labels[: nneg] = \
-                        self.get_neg_patch_multiscale(nneg, images, gt_bbox)
-
-                    output_images[nneg:], output_labels[nneg:] = \
-                        self.get_pos_patch_multiscale(npos, images, gt_bbox)
+            for seq_num in self.get_seqs():
+                gt_bbox = reader.read_key(seq_num, lazy=True)['gt_bbox']
+                _num_ex = self.get_num_ex(gt_bbox.shape[0])
+                tasks.append((seq_num, num_ex, num_ex + _num_ex))
+                num_ex += _num_ex
                 pass
             pass
 
-        dataset = self.assemble_dataset(dataset_images, dataset_labels)
-        self.dataset = dataset
+        return tasks, num_ex
 
-        if self.h5_fname is not None:
-            data_utils.write_h5_data(self.h5_fname, dataset)
+    def extract_key(self, reader, seq_num, output_images, output_labels):
+        """Extract the examples of a sequence with its own random state.
 
-        return dataset
+        Frames of both cameras are read lazily, only the cropped frames are
+        loaded.
+
+        Args:
+            reader: ShardedFileReader of the sequences.
+            seq_num: sequence key.
+            output_images: output, see get_output_shape.
+            output_labels: output, [B].
+        """
+        seq_data = reader.read_key(seq_num, lazy=['images_0', 'images_1'])
+        self.random = self.get_seq_random(seq_num)
+        self.extract_sequence(seq_data['images_0'], seq_data['gt_bbox'],
+                              output_images, output_labels)
+
+        pass
+
+    def extract_sequence(self, images, gt_bbox, output_images,
+                         output_labels):
+        """Extract the negative then positive examples of a sequence.
+
+        Sequences with less than two objects are left as zeros.
+
+        Args:
+            images: [T, H, W, 3]
+            gt_bbox: [N, T, 5]
+            output_images: output, see get_output_shape.
+            output_labels: output, [B].
+        """
+        usage = self.usage
+        num_obj = gt_bbox.shape[0]
+        nneg = self.opt['num_ex_neg'] * num_obj
+        npos = self.opt['num_ex_pos'] * num_obj
+        if num_obj < 2:
+            return
+
+        if usage == 'match':
+            output_images[: nneg], output_labels[: nneg] = \
+                self.get_neg_pair(nneg, images, gt_bbox)
+
+            output_images[nneg:], output_labels[nneg:] = \
+                self.get_pos_pair(npos, images, gt_bbox)
+        elif usage == 'detect':
+            output_images[: nneg], output_labels[: nneg] = \
+                self.get_neg_patch(nneg, images, gt_bbox)
+
+            output_images[nneg:], output_labels[nneg:] = \
+                self.get_pos_patch(npos, images, gt_bbox)
+        elif usage == 'detect_multiscale':
+            output_images[: nneg], output_labels[: nneg] = \
+                self.get_neg_patch_multiscale(nneg, images, gt_bbox)
+
+            output_images[nneg:], output_labels[nneg:] = \
+                self.get_pos_patch_multiscale(npos, images, gt_bbox)
+        pass
+
+    def extract_parallel(self, dataset_file):
+        """Extract all sequences in a process pool.
+
+        Outputs are preallocated in shared memory, each worker writes the
+        examples of its sequence at their final offset.
+
+        Args:
+            dataset_file: ShardedFile instance.
+
+        Returns:
+            final_images: see get_output_shape.
+            final_labels: [B].
+        """
+        tasks, num_ex = self.get_seq_ranges(dataset_file)
+
+        # Shared before forking, the workers write straight into them.
+        shape = self.get_output_shape(num_ex)
+        final_images = np.frombuffer(
+            multiprocessing.RawArray('b', int(np.prod(shape))),
+            dtype='uint8').reshape(shape)
+        final_labels = np.frombuffer(
+            multiprocessing.RawArray('b', num_ex), dtype='uint8')
+
+        pool = multiprocessing.Pool(
+            self.num_workers, initializer=_init_extract_worker,
+            initargs=(self, dataset_file, final_images, final_labels))
+        try:
+            progress = pb.get(len(tasks))
+            for seq_num in pool.imap_unordered(_extract_sequence, tasks):
+                progress.increment()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return final_images, final_labels
+
+    def extract_serial(self, dataset_file):
+        """Extract all sequences one after another in this process.
+
+        Same output as extract_parallel.
+
+        Args:
+            dataset_file: ShardedFile instance.
+
+        Returns:
+            final_images: see get_output_shape.
+            final_labels: [B].
+        """
+        tasks, num_ex = self.get_seq_ranges(dataset_file)
+        final_images = np.zeros(self.get_output_shape(num_ex), dtype='uint8')
+        final_labels = np.zeros([num_ex], dtype='uint8')
+        with sh.ShardedFileReader(dataset_file) as reader:
+            for seq_num, start, end in pb.get_iter(tasks):
+                self.extract_key(reader, seq_num, final_images[start: end],
+                                 final_labels[start: end])
+                pass
+            pass
+
+        return final_images, final_labels
+
+    def sample_batch(self, reader, batch_id, batch_size, seq_nums,
+                     seq_weights):
+        """Sample a mini-batch of examples from the sequence frames.
+
+        Sequences are drawn in proportion to seq_weights, and each example
+        is negative with probability num_ex_neg / (num_ex_neg + num_ex_pos).
+        The random state only depends on the seed and batch_id.
+
+        Args:
+            reader: ShardedFileReader of the sequences.
+            batch_id: number, index of the batch.
+            batch_size: number, number of examples.
+            seq_nums: list of sequences with at least two objects.
+            seq_weights: [S], sampling probability of each sequence.
+
+        Returns:
+            batch: dict, see get_dataset.
+        """
+        random = np.random.RandomState([self.seed, batch_id])
+        self.random = random
+        num_ex_neg = self.opt['num_ex_neg']
+        neg_ratio = num_ex_neg / float(num_ex_neg + self.opt['num_ex_pos'])
+        output_images = np.zeros(
+            self.get_output_shape(batch_size), dtype='uint8')
+        output_labels = np.zeros([batch_size], dtype='uint8')
+
+        seq_counts = random.multinomial(batch_size, seq_weights)
+        start = 0
+        for seq_num, count in zip(seq_nums, seq_counts):
+            if count == 0:
+                continue
+            # Only the sampled frames are read.
+            seq_data = reader.read_key(seq_num,
+                                       lazy=['images_0', 'images_1'])
+            images = seq_data['images_0']
+            gt_bbox = seq_data['gt_bbox']
+            nneg = random.binomial(count, neg_ratio)
+            npos = count - nneg
+            if self.usage == 'match':
+                get_neg = self.get_neg_pair
+                get_pos = self.get_pos_pair
+            elif self.usage == 'detect':
+                get_neg = self.get_neg_patch
+                get_pos = self.get_pos_patch
+            elif self.usage == 'detect_multiscale':
+                get_neg = self.get_neg_patch_multiscale
+                get_pos = self.get_pos_patch_multiscale
+            if nneg > 0:
+                output_images[start: start + nneg], \
+                    output_labels[start: start + nneg] = \
+                    get_neg(nneg, images, gt_bbox)
+            if npos > 0:
+                output_images[start + nneg: start + count], \
+                    output_labels[start + nneg: start + count] = \
+                    get_pos(npos, images, gt_bbox)
+            start += count
+            pass
+
+        idx = random.permutation(batch_size)
+        output_images = output_images[idx]
+        output_labels = output_labels[idx]
+        if self.usage == 'match':
+            return {
+                'images_0': output_images[:, 0],
+                'images_1': output_images[:, 1],
+                'labels': output_labels
+            }
+        else:
+            return {
+                'images': output_images,
+                'labels': output_labels
+            }
 
     def crop_patch(self, image, bbox):
         """Get a crop of the image.
@@ -156,56 +405,83 @@ class KITTIPatchData(object):
             image: [H, W, 3]
             bbox: [left, top, right, bottom] 
         """
+        return self.crop_patches(image[None], [0], [bbox])[0]
+
+    def crop_patches(self, images, frames, bboxes, out=None):
+        """Get jittered crops of boxes, resized to the patch size.
+
+        The jitter of all boxes is drawn in one call, in the same order as
+        successive crop_patch calls, and boxes are visited frame by frame so
+        that each frame of a lazy dataset is read once.
+
+        Args:
+            images: [T, H, W, 3]
+            frames: [B], frame of each box.
+            bboxes: [B, 4], [left, top, right, bottom]
+            out: optional preallocated output, [B, patch_height, patch_width,
+            3].
+
+        Returns:
+            out: [B, patch_height, patch_width, 3]
+        """
         patch_height = self.opt['patch_height']
         patch_width = self.opt['patch_width']
         center_noise = self.opt['center_noise']
         padding_noise = self.opt['padding_noise']
-        padding_mean = self.opt['padding_mean']
-        padding = padding_mean
-        patch_size = [patch_height, patch_width]
+        padding = self.opt['padding_mean']
         random = self.random
 
-        left = bbox[0]
-        top = bbox[1]
-        right = bbox[2]
-        bottom = bbox[3]
-        size_x = right - left
-        size_y = bottom - top
-        im_height = image.shape[0]
-        im_width = image.shape[1]
-
-        pn_x = random.uniform(padding - padding_noise, padding + padding_noise)
-        pn_y = random.uniform(padding - padding_noise, padding + padding_noise)
-        cn_x = random.uniform(-center_noise, center_noise)
-        cn_y = random.uniform(-center_noise, center_noise)
-
-        left = left + (cn_x - pn_x) * size_x
-        right = right + (cn_x + pn_x) * size_x
-        top = top + (cn_y - pn_y) * size_y
-        bottom = bottom + (cn_y + pn_y) * size_y
-
-        left = max(0, left)
-        right = min(right, im_width)
-        top = max(0, top)
-        bottom = min(bottom, im_height)
-        image_crop = image[top: bottom + 1, left: right + 1, :]
-        image_resize = cv2.resize(image_crop, (patch_size[1], patch_size[0]))
-
-        return image_resize
+        frames = np.asarray(frames, dtype='int64').reshape([-1])
+        bboxes = np.asarray(bboxes, dtype='float64').reshape([-1, 4])
+        num = frames.shape[0]
+        if out is None:
+            out = np.zeros([num, patch_height, patch_width, 3], dtype='uint8')
+        if num == 0:
+            return out
+        im_height = images.shape[1]
+        im_width = images.shape[2]
+
+        # [pn_x, pn_y, cn_x, cn_y] of each box.
+        low = np.array([padding - padding_noise, padding - padding_noise,
+                        -center_noise, -center_noise])
+        high = np.array([padding + padding_noise, padding + padding_noise,
+                         center_noise, center_noise])
+        noise = low + (high - low) * random.uniform(size=[num, 4])
+        pn = noise[:, :2]
+        cn = noise[:, 2:]
+
+        size = bboxes[:, 2:] - bboxes[:, :2]
+        top_left = bboxes[:, :2] + (cn - pn) * size
+        bot_right = bboxes[:, 2:] + (cn + pn) * size
+        im_max = np.array([im_width, im_height])
+        top_left = np.floor(np.clip(top_left, 0, im_max - 1)).astype('int64')
+        bot_right = np.floor(np.minimum(bot_right, im_max)).astype('int64')
+        bot_right = np.maximum(bot_right, top_left)
+
+        frm = -1
+        for ii in np.argsort(frames, kind='mergesort'):
+            if frames[ii] != frm:
+                frm = frames[ii]
+                image = images[frm]
+            left, top = top_left[ii]
+            right, bottom = bot_right[ii]
+            image_crop = image[top: bottom + 1, left: right + 1, :]
+            out[ii] = cv2.resize(image_crop, (patch_width, patch_height))
+            pass
+
+        return out
 
     def get_neg_pair(self, num, images, gt_bbox):
         """Get negative pair."""
         patch_height = self.opt['patch_height']
         patch_width = self.opt['patch_width']
-        center_noise = self.opt['center_noise']
-        padding_noise = self.opt['padding_noise']
-        padding_mean = self.opt['padding_mean']
         random = self.random
 
-        patch_size = [patch_height, patch_width]
         output_images = np.zeros(
             [num, 2, patch_height, patch_width, 3], dtype='uint8')
         output_labels = np.zeros([num], dtype='uint8')
+        frames = np.zeros([num, 2], dtype='int64')
+        bboxes = np.zeros([num, 2, 4])
         num_obj = gt_bbox.shape[0]
 
         for ii in xrange(num):
@@ -218,66 +494,66 @@ class KITTIPatchData(object):
                 pass
 
             non_zero_frames1 = gt_bbox[obj_id1, :, 4].nonzero()[0]
-            idx1 = np.floor(random.uniform(0,
-                                           non_zero_frames1.shape[0]))
+            idx1 = int(np.floor(random.uniform(0,
+                                               non_zero_frames1.shape[0])))
             frm1 = non_zero_frames1[idx1]
 
             non_zero_frames2 = gt_bbox[obj_id2, :, 4].nonzero()[0]
-            idx2 = np.floor(random.uniform(0,
-                                           non_zero_frames2.shape[0]))
+            idx2 = int(np.floor(random.uniform(0,
+                                               non_zero_frames2.shape[0])))
             frm2 = non_zero_frames2[idx2]
 
-            image1 = images[frm1]
-            image2 = images[frm2]
-            bbox1 = gt_bbox[obj_id1, frm1, :4]
-            bbox2 = gt_bbox[obj_id2, frm2, :4]
-            patch_size = [patch_height, patch_width]
-            output_images[ii, 0] = self.crop_patch(image1, bbox1)
-            output_images[ii, 1] = self.crop_patch(image2, bbox2)
-            output_labels[ii] = 0
+            frames[ii] = [frm1, frm2]
+            bboxes[ii, 0] = gt_bbox[obj_id1, frm1, :4]
+            bboxes[ii, 1] = gt_bbox[obj_id2, frm2, :4]
             pass
 
+        self.crop_patches(
+            images, frames, bboxes,
+            out=output_images.reshape([-1, patch_height, patch_width, 3]))
+        output_labels[:] = 0
+
         return output_images, output_labels
 
     def get_pos_pair(self, num, images, gt_bbox):
         """Get positive pair."""
         patch_height = self.opt['patch_height']
         patch_width = self.opt['patch_width']
-        center_noise = self.opt['center_noise']
-        padding_noise = self.opt['padding_noise']
-        padding_mean = self.opt['padding_mean']
         random = self.random
 
-        patch_size = [patch_height, patch_width]
         output_images = np.zeros(
             [num, 2, patch_height, patch_width, 3], dtype='uint8')
         output_labels = np.zeros([num], dtype='uint8')
+        frames = np.zeros([num, 2], dtype='int64')
+        bboxes = np.zeros([num, 2, 4])
         num_obj = gt_bbox.shape[0]
 
         for ii in xrange(num):
-            frames = np.array([0])
-            while frames.shape[0] <= 1:
+            frames_obj = np.array([0])
+            while frames_obj.shape[0] <= 1:
                 obj_id = int(np.floor(random.uniform(0, num_obj)))
-                frames = gt_bbox[obj_id, :, 4].nonzero()[0]
+                frames_obj = gt_bbox[obj_id, :, 4].nonzero()[0]
                 pass
 
             idx1 = 0
             idx2 = 0
             while idx1 == idx2:
-                idx1 = int(np.floor(random.uniform(0, frames.shape[0])))
-                idx2 = int(np.floor(random.uniform(0, frames.shape[0])))
+                idx1 = int(np.floor(random.uniform(0, frames_obj.shape[0])))
+                idx2 = int(np.floor(random.uniform(0, frames_obj.shape[0])))
                 pass
 
-            frm1 = frames[idx1]
-            frm2 = frames[idx2]
-            image1 = images[frm1]
-            image2 = images[frm2]
-            bbox1 = gt_bbox[obj_id, frm1, :4]
-            bbox2 = gt_bbox[obj_id, frm2, :4]
-            output_images[ii, 0] = self.crop_patch(image1, bbox1)
-            output_images[ii, 1] = self.crop_patch(image2, bbox2)
-            output_labels[ii] = 1
+            frm1 = frames_obj[idx1]
+            frm2 = frames_obj[idx2]
+            frames[ii] = [frm1, frm2]
+            bboxes[ii, 0] = gt_bbox[obj_id, frm1, :4]
+            bboxes[ii, 1] = gt_bbox[obj_id, frm2, :4]
             pass
+
+        self.crop_patches(
+            images, frames, bboxes,
+            out=output_images.reshape([-1, patch_height, patch_width, 3]))
+        output_labels[:] = 1
+
         return output_images, output_labels
 
     def get_neg_patch(self, num, images, gt_bbox):
@@ -290,16 +566,13 @@ class KITTIPatchData(object):
         """
         patch_height = self.opt['patch_height']
         patch_width = self.opt['patch_width']
-        center_noise = self.opt['center_noise']
-        padding_noise = self.opt['padding_noise']
-        padding_mean = self.opt['padding_mean']
         random = self.random
 
-        patch_size = [patch_height, patch_width]
         output_images = np.zeros(
             [num, patch_height, patch_width, 3], dtype='uint8')
         output_labels = np.zeros([num], dtype='uint8')
-        num_obj = gt_bbox.shape[0]
+        frames = np.zeros([num], dtype='int64')
+        bboxes = np.zeros([num, 4])
         im_height = images.shape[-3]
         im_width = images.shape[-2]
 
@@ -319,19 +592,20 @@ class KITTIPatchData(object):
              gt_bbox[:, :, 4]).sum() / num_boxes)
 
         for ii in xrange(num):
-            frm = int(np.floor(random.uniform(0, images.shape[0])))
-            image = images[frm]
+            frames[ii] = int(np.floor(random.uniform(0, images.shape[0])))
             bbox_height = int(random.normal(mean_box_height, std_box_height))
             bbox_height = max(20, bbox_height)
             bbox_width = int(random.normal(mean_box_width, std_box_width))
             bbox_width = max(20, bbox_width)
             bbox_y = int(random.uniform(0, im_height - bbox_height))
             bbox_x = int(random.uniform(0, im_width - bbox_width))
-            bbox = [bbox_x, bbox_y, bbox_x + bbox_width, bbox_y + bbox_height]
-            output_images[ii] = self.crop_patch(image, bbox)
-            output_labels[ii] = 0
+            bboxes[ii] = [bbox_x, bbox_y,
+                          bbox_x + bbox_width, bbox_y + bbox_height]
             pass
 
+        self.crop_patches(images, frames, bboxes, out=output_images)
+        output_labels[:] = 0
+
         return output_images, output_labels
 
     def get_pos_patch(self, num, images, gt_bbox):
@@ -344,32 +618,30 @@ class KITTIPatchData(object):
         """
         patch_height = self.opt['patch_height']
         patch_width = self.opt['patch_width']
-        center_noise = self.opt['center_noise']
-        padding_noise = self.opt['padding_noise']
-        padding_mean = self.opt['padding_mean']
         random = self.random
 
-        patch_size = [patch_height, patch_width]
         output_images = np.zeros(
             [num, patch_height, patch_width, 3], dtype='uint8')
         output_labels = np.zeros([num], dtype='uint8')
+        frames = np.zeros([num], dtype='int64')
+        bboxes = np.zeros([num, 4])
         num_obj = gt_bbox.shape[0]
 
         for ii in xrange(num):
-            frames = np.array([0])
-            while frames.shape[0] <= 1:
+            frames_obj = np.array([0])
+            while frames_obj.shape[0] <= 1:
                 obj_id = int(np.floor(random.uniform(0, num_obj)))
-                frames = gt_bbox[obj_id, :, 4].nonzero()[0]
+                frames_obj = gt_bbox[obj_id, :, 4].nonzero()[0]
                 pass
 
-            idx = int(np.floor(random.uniform(0, frames.shape[0])))
-            frm = frames[idx]
-            image = images[frm]
-            bbox = gt_bbox[obj_id, frm, :4]
-            output_images[ii] = self.crop_patch(image, bbox)
-            output_labels[ii] = 1
+            idx = int(np.floor(random.uniform(0, frames_obj.shape[0])))
+            frames[ii] = frames_obj[idx]
+            bboxes[ii] = gt_bbox[obj_id, frames[ii], :4]
             pass
 
+        self.crop_patches(images, frames, bboxes, out=output_images)
+        output_labels[:] = 1
+
         return output_images, output_labels
 
     def get_neg_patch_multiscale(self, num, images, gt_bbox):
@@ -460,7 +732,6 @@ class KITTIPatchData(object):
                 # print scale
                 ratio = base_ratio / scale
                 im_size = (base_size * scale).astype('int32')
-                image = cv2.resize(image, (im_size[1], im_size[0]))
                 bbox_gt_rescale = np.zeros(4)
                 bbox_gt_rescale[0] = bbox_gt[0] / ratio[0]
                 bbox_gt_rescale[2] = bbox_gt[2] / ratio[0]
@@ -475,6 +746,8 @@ class KITTIPatchData(object):
                     box_id = int(
                         np.floor(random.uniform(0, len(bbox_prop))))
                     bbox = bbox_prop[box_id]
+                    # Only resize frames that have a proposal.
+                    image = cv2.resize(image, (im_size[1], im_size[0]))
                     output_images[ii] = image[
                         bbox[1]: bbox[3], bbox[0]: bbox[2], :]
                     output_labels[ii] = 1.0
@@ -484,51 +757,75 @@ class KITTIPatchData(object):
 
     @staticmethod
     def find_all_overlap_bbox(im_height, im_width, patch_height, patch_width, bbox, stride, thresh):
-        bleft = max(int(bbox[0]), patch_width / 2)
-        btop = max(int(bbox[1]), patch_height / 2)
-        bright = min(int(bbox[2]), im_width - patch_width / 2)
-        bbot = min(int(bbox[3]), im_height - patch_height / 2)
-        box_out = []
-        max_iou = 0.0
-
-        for x in xrange(bleft, bright, stride):
-            for y in xrange(btop, bbot, stride):
-                box_ = (x - patch_width / 2, y - patch_height / 2,
-                        x + patch_width / 2, y + patch_width / 2)
-                iou = KITTIPatchData.box_iou(box_, bbox)
-                max_iou = max(iou, max_iou)
-                if iou > thresh:
-                    box_out.append(box_)
+        """Find the patch sized windows that overlap with a box.
 
-        return box_out, max_iou
+        Args:
+            im_height: image height.
+            im_width: image width.
+            patch_height: window height.
+            patch_width: window width.
+            bbox: [left, top, right, bottom], ground truth box.
+            stride: distance between window centers.
+            thresh: minimum intersection over the smaller area.
+
+        Returns:
+            box_out: [M, 4], windows with score above thresh, in the order
+            of their centers, x first.
+            max_iou: maximum score of all windows.
+        """
+        box_out, max_iou = KITTIPatchData.find_all_overlap_bbox_batch(
+            im_height, im_width, patch_height, patch_width,
+            np.array([bbox]), stride, thresh)
+        return box_out[0], max_iou[0]
 
     @staticmethod
-    def box_iou(box1, box2):
-        # Not IOU here, it is max(Precision, Recall)
-        left1 = box1[0]
-        left2 = box2[0]
-        top1 = box1[1]
-        top2 = box2[1]
-        right1 = box1[2]
-        right2 = box2[2]
-        bot1 = box1[3]
-        bot2 = box2[3]
-        left_ = max(left1, left2)
-        top_ = max(top1, top2)
-        right_ = min(right1, right2)
-        bot_ = min(bot1, bot2)
-        inter = (right_ - left_) * (bot_ - top_)
-        # union = (right1 - left1) * (bot1 - top1) + \
-        #     (right1 - left1) * (bot1 - top1) - inter
-        union = min((right1 - left1) * (bot1 - top1),
-                    (right1 - left1) * (bot1 - top1))
-        return inter / union
+    def find_all_overlap_bbox_batch(im_height, im_width, patch_height,
+                                    patch_width, bbox, stride, thresh):
+        """Find the patch sized windows that overlap with each of the boxes.
+
+        Window centers are on a grid inside each box, clipped so that the
+        windows stay inside the image. The windows of all boxes are scored
+        at once.
+
+        Args:
+            bbox: [N, 4], ground truth boxes.
+            See find_all_overlap_bbox for the others.
+
+        Returns:
+            box_out: list of N [M_i, 4] arrays.
+            max_iou: [N], maximum score of the windows of each box.
+        """
+        bbox = np.asarray(bbox).reshape([-1, 4])
+        bleft = np.maximum(bbox[:, 0].astype('int64'), patch_width / 2)
+        btop = np.maximum(bbox[:, 1].astype('int64'), patch_height / 2)
+        bright = np.minimum(bbox[:, 2].astype('int64'),
+                            im_width - patch_width / 2)
+        bbot = np.minimum(bbox[:, 3].astype('int64'),
+                          im_height - patch_height / 2)
+        num_x = max(int(np.ceil((bright - bleft).max() / float(stride))), 0)
+        num_y = max(int(np.ceil((bbot - btop).max() / float(stride))), 0)
+
+        # [N, X, Y] window centers and validity.
+        x = bleft[:, None, None] + \
+            np.arange(num_x)[None, :, None] * stride
+        y = btop[:, None, None] + \
+            np.arange(num_y)[None, None, :] * stride
+        valid = (x < bright[:, None, None]) & (y < bbot[:, None, None])
+        x, y = np.broadcast_arrays(x, y)
+        box_ = np.stack([x - patch_width / 2, y - patch_height / 2,
+                         x + patch_width / 2, y + patch_height / 2], axis=-1)
+        iou = box_utils.iom(box_, bbox[:, None, None, :])
+        iou = np.where(valid, iou, 0.0)
+        max_iou = iou.reshape([bbox.shape[0], -1]).max(axis=1) \
+            if iou.size > 0 else np.zeros([bbox.shape[0]])
+        box_out = [box_[ii][iou[ii] > thresh]
+                   for ii in xrange(bbox.shape[0])]
+
+        return box_out, max_iou
 
     def assemble_dataset(self, dataset_images, dataset_labels):
         seqs = self.seqs
-        random = self.random
         usage = self.usage
-        shuffle = self.opt['shuffle']
         num_ex = 0
         for ss in xrange(len(seqs)):
             num_ex += dataset_images[ss].shape[0]
@@ -544,8 +841,6 @@ class KITTIPatchData(object):
             final_images = np.zeros([num_ex, patch_height, patch_width, 3],
                                     dtype='uint8')
         final_labels = np.zeros([num_ex], dtype='uint8')
-        log.info('Image shape: {}'.format(final_images.shape))
-        log.info('Label shape: {}'.format(final_labels.shape))
 
         counter = 0
         for ss in xrange(len(seqs)):
@@ -555,6 +850,17 @@ class KITTIPatchData(object):
             counter += _num_ex
             pass
 
+        return self.finish_dataset(final_images, final_labels)
+
+    def finish_dataset(self, final_images, final_labels):
+        """Shuffle the examples of all sequences and split the pairs."""
+        random = np.random.RandomState(self.seed)
+        usage = self.usage
+        shuffle = self.opt['shuffle']
+        num_ex = final_labels.shape[0]
+        log.info('Image shape: {}'.format(final_images.shape))
+        log.info('Label shape: {}'.format(final_labels.shape))
+
         if shuffle:
             idx = np.arange(num_ex)
             random.shuffle(idx)
@@ -577,6 +883,174 @@ class KITTIPatchData(object):
         return dataset
 
 
+class PatchSampler(object):
+    """Iterates mini-batches sampled on the fly from the sequence frames.
+
+    Unlike KITTIPatchData.get_dataset, nothing is precomputed or cached:
+    every batch has fresh examples, see KITTIPatchData.sample_batch. A pool
+    of processes samples batches ahead, at most num_prefetch of them are in
+    flight, so memory stays bounded. Batches come out in order and batch i
+    only depends on the seed, whatever the number of workers. reset goes
+    back to an earlier batch, e.g. to evaluate on the same batches again.
+    """
+
+    def __init__(self, patch_data, batch_size, num_workers=4,
+                 num_prefetch=8):
+        """Construct a patch sampler.
+
+        Args:
+            patch_data: KITTIPatchData instance, its folder, split or seqs,
+            usage, opt and seed are used.
+            batch_size: number, examples per batch.
+            num_workers: number, number of processes, 0 to sample in this
+            process.
+            num_prefetch: number, maximum number of batches in flight.
+        """
+        if num_prefetch < 1:
+            raise Exception('Number of prefetched batches must be at least 1')
+        self._batch_size = batch_size
+        self._num_prefetch = num_prefetch
+        self._next_batch = 0
+        self._cursor = 0
+        self._pending = collections.deque()
+        self._closed = False
+
+        # Stats.
+        self._num_batches = 0
+        self._wait_time = 0.0
+
+        # Sequences are drawn in proportion to their number of objects,
+        # as in the precomputed dataset.
+        dataset_file = patch_data.get_dataset_file()
+        seq_nums = []
+        num_obj = []
+        with sh.ShardedFileReader(dataset_file) as reader:
+            for seq_num in patch_data.get_seqs():
+                gt_bbox = reader.read_key(seq_num, lazy=True)['gt_bbox']
+                if gt_bbox.shape[0] >= 2:
+                    seq_nums.append(seq_num)
+                    num_obj.append(gt_bbox.shape[0])
+                pass
+            pass
+        if len(seq_nums) == 0:
+            raise Exception('No sequence with at least two objects')
+        seq_weights = np.array(num_obj, dtype='float64')
+        seq_weights /= seq_weights.sum()
+        initargs = (patch_data, dataset_file, seq_nums, seq_weights)
+
+        if num_workers == 0:
+            self._pool = None
+            reader = sh.ShardedFileReader(dataset_file, check=False)
+            self._local = (patch_data, reader, seq_nums, seq_weights)
+        else:
+            self._local = None
+            self._pool = multiprocessing.Pool(
+                num_workers, initializer=_init_sampler_worker,
+                initargs=initargs)
+            for ii in xrange(num_prefetch):
+                self._submit()
+
+        pass
+
+    def __iter__(self):
+        """Get an iterator."""
+        return self
+
+    def __enter__(self):
+        """Enter with clause."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Exit with clause."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        else:
+            # Files open in this process would be inherited by later forks.
+            self._local[1].close()
+            self._local = None
+
+        pass
+
+    def _submit(self):
+        """Send the next batch to the pool."""
+        args = (self._next_batch, self._batch_size)
+        self._pending.append(self._pool.apply_async(_sample_batch, (args,)))
+        self._next_batch += 1
+
+        pass
+
+    def reset(self, batch_id=0):
+        """Restart the stream at a batch.
+
+        Batches already in flight are dropped, unless the stream is already
+        at batch_id.
+
+        Args:
+            batch_id: number, index of the next batch.
+        """
+        if self._closed:
+            raise Exception('Sampler is closed')
+        if self._cursor == batch_id:
+            return
+        self._pending.clear()
+        self._next_batch = batch_id
+        self._cursor = batch_id
+        if self._pool is not None:
+            for ii in xrange(self._num_prefetch):
+                self._submit()
+
+        pass
+
+    def next(self):
+        """Get the next batch.
+
+        Returns:
+            batch: dict, see KITTIPatchData.get_dataset.
+        """
+        if self._closed:
+            raise StopIteration()
+        start = time.time()
+        if self._pool is None:
+            patch_data, reader, seq_nums, seq_weights = self._local
+            batch = patch_data.sample_batch(
+                reader, self._next_batch, self._batch_size, seq_nums,
+                seq_weights)
+            self._next_batch += 1
+        else:
+            batch = self._pending.popleft().get()
+            self._submit()
+        self._cursor += 1
+        self._wait_time += time.time() - start
+        self._num_batches += 1
+
+        return batch
+
+    def get_stats(self):
+        """Get sampler stats.
+
+        Returns:
+            stats: dict, number of batches consumed, total and mean time
+            spent waiting for a batch in seconds.
+        """
+        num_batches = max(self._num_batches, 1)
+
+        return {
+            'num_batches': self._num_batches,
+            'wait_time': self._wait_time,
+            'mean_wait_time': self._wait_time / num_batches
+        }
+
+    def close(self):
+        """Stop the workers."""
+        self.__exit__(None, None, None)
+
+        pass
+
+
 if __name__ == '__main__':
     opt = {
         'patch_height': 32,
@@ -591,4 +1065,4 @@ if __name__ == '__main__':
 
     d = KITTIPatchData(
         '/ais/gobi3/u/mren/data/kitti/tracking/training', opt, split='train',
-        usage='detect_multiscale').get_dataset()
+        usage='detect_multiscale', num_workers=8).get_dataset()
@@ -0,0 +1,140 @@
+"""
+Benchmarks of the KITTI patch extraction.
+
+Usage:
+    python patch_data_bench.py crop
+    python patch_data_bench.py crop --num_frames 800 --num_patches 4000
+    python patch_data_bench.py crop --folder kitti/training --seq 0
+"""
+
+import argparse
+import h5py
+import logger
+import numpy
+import os
+import patch_data
+import sharded_hdf5 as sh
+import tempfile
+import time
+
+log = logger.get()
+
+OPT = {
+    'patch_height': 48,
+    'patch_width': 48,
+    'center_noise': 0.2,
+    'padding_noise': 0.2,
+    'padding_mean': 0.4,
+    'num_ex_pos': 10,
+    'num_ex_neg': 10,
+    'shuffle': True
+}
+
+
+def make_sequence(random, num_frames, num_obj, im_height=375, im_width=1242):
+    """Random frames and object tracks of a KITTI sized sequence.
+
+    Returns:
+        images: [T, H, W, 3]
+        gt_bbox: [N, T, 5]
+    """
+    images = random.randint(
+        0, 255, [num_frames, im_height, im_width, 3]).astype('uint8')
+    gt_bbox = numpy.zeros([num_obj, num_frames, 5])
+    for obj in xrange(num_obj):
+        start = random.randint(0, num_frames / 2)
+        end = random.randint(start + 2, num_frames + 1)
+        width = random.uniform(30, 200)
+        height = random.uniform(30, 150)
+        left = numpy.linspace(random.uniform(0, im_width - width),
+                              random.uniform(0, im_width - width),
+                              end - start)
+        top = numpy.linspace(random.uniform(0, im_height - height),
+                             random.uniform(0, im_height - height),
+                             end - start)
+        gt_bbox[obj, start: end] = numpy.stack(
+            [left, top, left + width, top + height,
+             numpy.ones(end - start)], axis=1)
+    return images, gt_bbox
+
+
+def _loop_crop(data, images, frames, bboxes):
+    """One crop_patch call per box, reading its frame each time."""
+    out = numpy.zeros([frames.shape[0], OPT['patch_height'],
+                       OPT['patch_width'], 3], dtype='uint8')
+    for ii in xrange(frames.shape[0]):
+        out[ii] = data.crop_patch(images[frames[ii]], bboxes[ii])
+    return out
+
+
+def bench_crop(images_list, gt_bbox, num_patches):
+    """Compare per-patch crop_patch calls and one crop_patches call.
+
+    Args:
+        images_list: list of (name, images), frames of the sequence.
+        gt_bbox: [N, T, 5]
+        num_patches: number, boxes to crop.
+    """
+    data = patch_data.KITTIPatchData(None, OPT, split=None)
+    random = numpy.random.RandomState(0)
+    obj_ids, frames = gt_bbox[:, :, 4].nonzero()
+    idx = random.randint(0, frames.shape[0], num_patches)
+    frames = frames[idx]
+    bboxes = gt_bbox[obj_ids[idx], frames, :4]
+    log.info('{:d} patches from {:d} frames'.format(
+        num_patches, numpy.unique(frames).shape[0]))
+
+    for name, images in images_list:
+        data.random = numpy.random.RandomState(1)
+        start = time.time()
+        ref = _loop_crop(data, images, frames, bboxes)
+        elapsed_loop = time.time() - start
+
+        data.random = numpy.random.RandomState(1)
+        start = time.time()
+        out = data.crop_patches(images, frames, bboxes)
+        elapsed = time.time() - start
+
+        log.info('{}: loop {:.3f}s ({:.1f}us per patch), batched {:.3f}s '
+                 '({:.1f}us per patch), {:.1f}x, {:d} patches differ'.format(
+                     name, elapsed_loop, elapsed_loop * 1e6 / num_patches,
+                     elapsed, elapsed * 1e6 / num_patches,
+                     elapsed_loop / elapsed,
+                     int((ref != out).any(axis=(1, 2, 3)).sum())))
+    pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Patch data benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_crop = subparsers.add_parser(
+        'crop', help='Crop and resize, per patch vs batched')
+    parser_crop.add_argument('--folder', default=None,
+                             help='KITTI training folder, synthetic if unset')
+    parser_crop.add_argument('--seq', type=int, default=0)
+    parser_crop.add_argument('--num_frames', type=int, default=400)
+    parser_crop.add_argument('--num_obj', type=int, default=20)
+    parser_crop.add_argument('--num_patches', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.command == 'crop':
+        if args.folder is not None:
+            data = patch_data.KITTIPatchData(args.folder, OPT, split=None)
+            reader = sh.ShardedFileReader(data.get_dataset_file(),
+                                          check=False)
+            seq_data = reader.read_key(args.seq, lazy=['images_0'])
+            gt_bbox = seq_data['gt_bbox']
+            images = seq_data['images_0']
+            bench_crop([('Memory', numpy.asarray(images)), ('Lazy', images)],
+                       gt_bbox, args.num_patches)
+        else:
+            images, gt_bbox = make_sequence(numpy.random.RandomState(0),
+                                            args.num_frames, args.num_obj)
+            fname = os.path.join(tempfile.mkdtemp(), 'images.h5')
+            with h5py.File(fname, 'w') as h5f:
+                h5f['images'] = images
+            with h5py.File(fname, 'r') as h5f:
+                bench_crop([('Memory', images), ('HDF5', h5f['images'])],
+                           gt_bbox, args.num_patches)
+            os.remove(fname)
+            os.rmdir(os.path.dirname(fname))
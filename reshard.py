@@ -0,0 +1,81 @@
+"""
+Rewrite a sharded HDF5 file into balanced shards.
+
+Usage:
+    python reshard.py --source '/path/kitti/train/dataset-*' \
+        --output /path/kitti/train_32/dataset --num_shards 32 --by bytes \
+        --compression lzf --chunk_rows 1 --verify
+"""
+
+import argparse
+import logger
+import os
+import sharded_hdf5 as sh
+
+log = logger.get()
+
+
+def get_storage(fields, chunk_rows, compression, compression_opts, shuffle):
+    """Get the same storage spec for every field.
+
+    Returns:
+        storage: dict, see sharded_hdf5.ShardedFileWriter, None if no option 
+        is set.
+    """
+    spec = {}
+    if chunk_rows is not None:
+        spec['chunks'] = chunk_rows
+    if compression is not None:
+        spec['compression'] = compression
+        if compression_opts is not None:
+            spec['compression_opts'] = compression_opts
+    if shuffle:
+        spec['shuffle'] = True
+    if len(spec) == 0:
+        return None
+
+    return dict([(field, spec) for field in fields or []])
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(
+        description='Rewrite a sharded file into balanced shards')
+    parser.add_argument('--source', required=True,
+                        help='Pattern of the source shards')
+    parser.add_argument('--output', required=True,
+                        help='File prefix of the output shards')
+    parser.add_argument('--num_shards', type=int, required=True)
+    parser.add_argument('--by', default='bytes', choices=['bytes', 'items'])
+    parser.add_argument('--fields', nargs='+', default=None,
+                        help='Fields the storage options apply to, '
+                        'default all fields of more than one dimension')
+    parser.add_argument('--chunk_rows', type=int, default=None)
+    parser.add_argument('--compression', default=None,
+                        choices=['gzip', 'lzf'])
+    parser.add_argument('--compression_opts', type=int, default=None)
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--verify', action='store_true')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    source = sh.ShardedFile.from_pattern_read(args.source)
+    target = sh.ShardedFile(args.output, num_shards=args.num_shards)
+    if not os.path.exists(os.path.dirname(target.file_prefix)):
+        os.makedirs(os.path.dirname(target.file_prefix))
+
+    fields = args.fields
+    if fields is None:
+        with sh.ShardedFileReader(source) as reader:
+            for key, item in reader.iteritems(squeeze=False):
+                fields = [field for field in item.iterkeys()
+                          if item[field].ndim > 1]
+                break
+    storage = get_storage(fields, args.chunk_rows, args.compression,
+                          args.compression_opts, args.shuffle)
+    sh.reshard(source, target, by=args.by, storage=storage,
+               batch_size=args.batch_size, verify=args.verify)
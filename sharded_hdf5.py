@@ -31,10 +31,20 @@ Storing of a bundle of sharded files for homogeneous data type.
         ...
     }
 
+    4. Index sidecar
+    /path/folder/file_prefix-index-of-{num_shards}.idx
+    Written by ShardedFileWriter on close. Holds the number of items per
+    shard, the (key, shard, offset) table and the separators of every key,
+    so that a reader can skip opening every shard at start up. The file is
+    memory mapped and ignored if any shard size or mtime has changed.
+
 ==Key classes
     1. ShardedFile
     2. ShardedFileReader
     3. ShardedFileWriter
+    4. ParallelShardedFileWriter
+    5. PrefetchReader
+    6. LazyArray
 
 ==Examples
     1. Read: iterate everything
@@ -61,33 +71,108 @@ Storing of a bundle of sharded files for homogeneous data type.
     >>     reader.seek(pos=position)
     >>     items = reader.read(num_items=100)
 
-    5. Read: random access with a key (string or int)
+    5. Read: a batch as stacked arrays, rows of item i of key are
+       items[key][items['__offset_key__'][i]: items['__offset_key__'][i + 1]]
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileReader(f) as reader:
+    >>     items = reader.read(num_items=100, columnar=True)
+
+    6. Read: random access with a key (string or int)
     >> f = ShardedFile('a', num_shards=100)
     >> with ShardedFileReader(f) as reader:
     >>     item = reader[key]
 
-    6. Write a list
+    7. Read: random access with a list of keys
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileReader(f) as reader:
+    >>     items = reader.read_keys(keys)
+
+    8. Write a list
     >> f = ShardedFile('a', num_shards=100)
     >> with ShardedFileWriter(f, num_objects=1000) as writer:
     >>     for i in xrange(1000):
     >>         writer.write(item[i])
 
-    7. Write a dictionary (see example 5 for reading dictionary)
+    9. Write a dictionary (see example 6 for reading dictionary)
     >> f = ShardedFile('a', num_shards=100)
     >> with ShardedFileWriter(f, num_objects=1000) as writer:
     >>     for i in xrange(1000):
     >>         writer.write(item, key=key)
+
+    10. Write with bounded memory, appending to resizable datasets
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileWriter(f, num_objects=1000, streaming=True,
+    >>                        flush_bytes=2 ** 26) as writer:
+    >>     for i in xrange(1000):
+    >>         writer.write(item[i])
+
+    11. Write with a process per shard, items produced by the workers
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ParallelShardedFileWriter(f, num_objects=1000) as writer:
+    >>     for i in xrange(1000):
+    >>         writer.write_from(load_item, (i,))
+
+    12. Write with per-key chunking, compression and dtype
+    >> f = ShardedFile('a', num_shards=100)
+    >> storage = {'images': {'chunks': 1, 'compression': 'lzf',
+    >>                       'dtype': 'uint8'}}
+    >> with ShardedFileWriter(f, num_objects=1000, storage=storage) as writer:
+    >>     for i in xrange(1000):
+    >>         writer.write(item[i])
+
+    13. Read batches ahead on a background thread or process
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileReader(f, batch_size=32) as reader:
+    >>     with PrefetchReader(reader, num_prefetch=4) as prefetch:
+    >>         for batch in prefetch:
+    >>             train(batch)
+    >>         log.info(prefetch.get_stats())
+
+    14. Read through memory mapped views of uncompressed shards
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileReader(f, mmap=True) as reader:
+    >>     images = reader[key]['images']
+
+    15. Compute statistics shard by shard in a process pool
+    >> f = ShardedFile('a', num_shards=100)
+    >> def count_boxes(items):
+    >>     return sum([item['bbox'].shape[0] for item in items])
+    >> num_boxes = map_shards(f, count_boxes, reducer=operator.add)
+
+    16. Rewrite into balanced shards, see also reshard.py
+    >> source = ShardedFile.from_pattern_read('/path/folder/a-*')
+    >> target = ShardedFile('/path/folder2/a', num_shards=32)
+    >> reshard(source, target, by='bytes', verify=True)
+
+    17. Read frames of a sequence only when indexed
+    >> with ShardedFileReader(f) as reader:
+    >>     seq = reader.read_key(key, lazy=['images_0'])
+    >>     window = seq['images_0'][start: start + 20]
+
+    18. Write a field in chunks, e.g. frames decoded one at a time
+    >> with ShardedFileWriter(f, num_objects=10, streaming=True) as writer:
+    >>     writer.write({'images': (read_frame(ii) for ii in xrange(1000)),
+    >>                   'label': label})
 """
 
 
 import bisect
+import collections
 import fnmatch
 import h5py
+import json
 import logger
 import math
+import multiprocessing
 import numpy
 import os
+import Queue
 import re
+import struct
+import threading
+import time
+import traceback
+import zlib
 
 log = logger.get()
 
@@ -101,8 +186,16 @@ KEY_SEPARATOR = '__sep_{}__'
 KEY_SEPARATOR_RE = re.compile('^__sep_([^_]+)__$')
 KEY_SEPARATOR_PREFIX = '__sep_'
 KEY_KEYS = '__keys__'
+KEY_OFFSET = '__offset_{}__'
 FILE_PATTERN = re.compile(
     '^(?P<prefix>.*)-(?P<shard>[0-9]{5})-of-(?P<total>[0-9]{5})(?P<suffix>.*)$')
+INDEX_FILE_PATTERN = re.compile('^.*-index-of-[0-9]{5}\\.idx$')
+INDEX_MAGIC = 'SHIDX002'
+INDEX_ALIGN = 64
+STREAM_FLUSH_BYTES = 64 * 1024 * 1024
+STREAM_CHUNK_BYTES = 1024 * 1024
+STORAGE_OPTIONS = set(['chunks', 'compression', 'compression_opts',
+                       'shuffle', 'dtype'])
 
 
 def _get_sep_from_key(key):
@@ -110,6 +203,11 @@ def _get_sep_from_key(key):
     return KEY_SEPARATOR.format(key)
 
 
+def _get_offset_from_key(key):
+    """Get offset key of columnar read results from key name"""
+    return KEY_OFFSET.format(key)
+
+
 def _get_key_from_sep(sep):
     """Get key name from separator key"""
     match = fname_re.match(fname)
@@ -119,6 +217,431 @@ def _get_key_from_sep(sep):
         return None
 
 
+def _align(offset):
+    """Round up an offset in the index file to the alignment boundary."""
+    return int(math.ceil(offset / float(INDEX_ALIGN))) * INDEX_ALIGN
+
+
+def _write_index_file(fname, arrays):
+    """Write a dictionary of arrays into a memory mappable file.
+
+    Args:
+        fname: string, output file name.
+        arrays: dict, name to numpy.ndarray.
+    """
+    header = {}
+    values = {}
+    offset = 0
+    for name in sorted(arrays.keys()):
+        value = numpy.ascontiguousarray(arrays[name])
+        values[name] = value
+        header[name] = [value.dtype.str, list(value.shape), offset]
+        offset = _align(offset + value.nbytes)
+    header_str = json.dumps(header)
+    data_start = _align(len(INDEX_MAGIC) + 8 + len(header_str))
+
+    # Write to a temporary file so that readers never see a partial index.
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack('<Q', len(header_str)))
+        f.write(header_str)
+        for name in sorted(values.keys()):
+            f.seek(data_start + header[name][2])
+            f.write(values[name].tobytes())
+    os.rename(tmp_fname, fname)
+
+    pass
+
+
+def _read_index_file(fname):
+    """Memory map a file written by _write_index_file.
+
+    Args:
+        fname: string, input file name.
+    Returns:
+        arrays: dict, name to read-only numpy.ndarray.
+    """
+    with open(fname, 'rb') as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise Exception('Unknown index file format: {}'.format(fname))
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    data_start = _align(len(INDEX_MAGIC) + 8 + header_len)
+    buf = numpy.memmap(fname, dtype='uint8', mode='r')
+    arrays = {}
+    for name, (dtype, shape, offset) in header.iteritems():
+        dtype = numpy.dtype(str(dtype))
+        shape = tuple(shape)
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+        start = data_start + offset
+        arrays[str(name)] = buf[start: start + nbytes].view(
+            dtype).reshape(shape)
+
+    return arrays
+
+
+def _write_index(sharded_file, shard_meta):
+    """Write the index sidecar of a sharded file.
+
+    Args:
+        sharded_file: ShardedFile instance, all shards are already closed.
+        shard_meta: list of dict, one per shard.
+            num_items: number of items in the shard.
+            keys: 1D numpy.ndarray, keys of the items.
+            sep: dict, separator array of each key.
+    """
+    num_shards = len(shard_meta)
+    shard_meta_nonempty = [meta for meta in shard_meta
+                           if meta['num_items'] > 0]
+    if len(shard_meta_nonempty) == 0:
+        return
+    data_keys = set(shard_meta_nonempty[0]['sep'].keys())
+    for meta in shard_meta_nonempty:
+        if set(meta['sep'].keys()) != data_keys:
+            log.warning('Keys differ across shards, skip writing index '
+                        'for {}'.format(sharded_file))
+            return
+
+    stats = [os.stat(sharded_file.get_fname(shard))
+             for shard in xrange(num_shards)]
+    num_items = numpy.array([meta['num_items'] for meta in shard_meta],
+                            dtype='int64')
+    arrays = {}
+    arrays['shard_mtime'] = numpy.array([st.st_mtime for st in stats],
+                                        dtype='float64')
+    arrays['shard_size'] = numpy.array([st.st_size for st in stats],
+                                       dtype='int64')
+    arrays['num_items'] = num_items
+
+    # Keys are stored sorted, so that the reader can binary search them in
+    # place.
+    keys = numpy.concatenate([meta['keys'] for meta in shard_meta_nonempty])
+    order = numpy.argsort(keys, kind='mergesort')
+    arrays['keys'] = keys[order]
+    arrays['key_shard'] = numpy.repeat(
+        numpy.arange(num_shards, dtype='int32'), num_items)[order]
+    arrays['key_offset'] = numpy.concatenate(
+        [numpy.arange(nn, dtype='int64') for nn in num_items])[order]
+    for key in data_keys:
+        arrays[_get_sep_from_key(key)] = numpy.concatenate(
+            [meta['sep'][key] for meta in shard_meta_nonempty]).astype(
+            'int64')
+    _write_index_file(sharded_file.get_index_fname(), arrays)
+
+    pass
+
+
+def _read_index(sharded_file):
+    """Read the index sidecar of a sharded file.
+
+    Args:
+        sharded_file: ShardedFile instance.
+    Returns:
+        index: dict, name to numpy.ndarray, None if the index is missing or
+        out of date with the shards.
+    """
+    fname = sharded_file.get_index_fname()
+    if not os.path.exists(fname):
+        return None
+    try:
+        index = _read_index_file(fname)
+    except Exception as e:
+        log.warning('Failed to read index {}: {}'.format(fname, e))
+        return None
+
+    if index['num_items'].shape[0] != sharded_file.num_shards:
+        log.warning('Index does not match number of shards: {}'.format(fname))
+        return None
+    for shard in xrange(sharded_file.num_shards):
+        shard_fname = sharded_file.get_fname(shard)
+        if not os.path.exists(shard_fname):
+            return None
+        st = os.stat(shard_fname)
+        if st.st_size != index['shard_size'][shard] or \
+                st.st_mtime != index['shard_mtime'][shard]:
+            log.warning('Index is out of date: {}'.format(fname))
+            return None
+
+    return index
+
+
+class _KeyIndex(object):
+    """Key index stored as a sorted key array and parallel shard and offset
+    arrays. Keys are looked up by binary search.
+    """
+
+    def __init__(self, keys, shard, offset, is_sorted=False):
+        """Construct a key index.
+
+        Args:
+            keys: 1D numpy.ndarray, keys of all items.
+            shard: 1D int numpy.ndarray, shard index of each key.
+            offset: 1D int numpy.ndarray, position of each key in its shard.
+            is_sorted: bool, whether the keys are already sorted.
+        """
+        if not is_sorted:
+            order = numpy.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            shard = shard[order]
+            offset = offset[order]
+        self._keys = keys
+        self._shard = shard
+        self._offset = offset
+        self._is_str = keys.dtype.kind in 'SU'
+
+        if keys.shape[0] > 1 and numpy.any(keys[1:] == keys[:-1]):
+            log.warning('Duplicate keys found, only the first one is used.')
+
+        pass
+
+    def __len__(self):
+        return self._keys.shape[0]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _cast(self, keys):
+        """Convert query keys to an array comparable with the key array, None
+        if the types are not compatible."""
+        keys = numpy.asarray(keys)
+        if (keys.dtype.kind in 'SU') != self._is_str:
+            return None
+
+        return keys
+
+    def lookup(self, keys):
+        """Look up a list of keys.
+
+        Args:
+            keys: list or 1D numpy.ndarray, query keys.
+        Returns:
+            found: 1D bool numpy.ndarray, whether each key exists.
+            shard: 1D int numpy.ndarray, shard index of each key.
+            offset: 1D int numpy.ndarray, position of each key in its shard.
+        """
+        query = self._cast(keys)
+        if query is None or self._keys.shape[0] == 0:
+            num = len(keys)
+            return (numpy.zeros([num], dtype='bool'),
+                    numpy.zeros([num], dtype='int64'),
+                    numpy.zeros([num], dtype='int64'))
+        pos = numpy.searchsorted(self._keys, query)
+        pos = numpy.minimum(pos, self._keys.shape[0] - 1)
+        found = self._keys[pos] == query
+
+        return found, self._shard[pos], self._offset[pos]
+
+    def get(self, key):
+        """Get the location of a key.
+
+        Args:
+            key: int or string.
+        Returns:
+            location: tuple (shard, offset), None if not found.
+        """
+        # Single key path, avoids building temporary arrays.
+        if isinstance(key, basestring) != self._is_str:
+            return None
+        pos = self._keys.searchsorted(key)
+        if pos < self._keys.shape[0] and self._keys[pos] == key:
+            return int(self._shard[pos]), int(self._offset[pos])
+        else:
+            return None
+
+    def keys(self):
+        """Get a list of keys, in sorted order."""
+        return self._keys.tolist()
+
+    def iterkeys(self):
+        """Get an iterable of keys, in sorted order."""
+        return iter(self._keys)
+
+
+def _mmap_dataset(fname, dataset):
+    """Map a dataset into memory, bypassing HDF5.
+
+    Args:
+        fname: string, file name of the shard.
+        dataset: h5py.Dataset.
+    Returns:
+        array: read-only numpy.ndarray view of the file, None if the dataset 
+        is chunked, compressed, not allocated or of a non numeric type.
+    """
+    if dataset.chunks is not None or dataset.dtype.hasobject or \
+            dataset.dtype.kind not in 'biufcSV':
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+
+    return numpy.asarray(numpy.memmap(
+        fname, mode='r', dtype=dataset.dtype, shape=dataset.shape,
+        offset=offset))
+
+
+class LazyArray(object):
+    """Read-only view of the rows of an item, only the indexed rows are read.
+
+    The view reads through its ShardedFileReader, which reopens the shard if 
+    it has been evicted, so it stays valid as long as the reader is open.
+    """
+
+    def __init__(self, reader, shard, key, line_start, line_end):
+        """Construct a lazy array.
+
+        Args:
+            reader: ShardedFileReader instance.
+            shard: number, shard index.
+            key: string, field name.
+            line_start: number, first row in the shard.
+            line_end: number, end row (exclusive) in the shard.
+        """
+        self._reader = reader
+        self._shard = shard
+        self._key = key
+        self._line_start = line_start
+        data = reader._get_data(shard, key)
+        self.shape = (line_end - line_start,) + data.shape[1:]
+        self.dtype = data.dtype
+        self.ndim = len(self.shape)
+
+        pass
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        """Read all rows."""
+        result = self[:]
+        if dtype is not None:
+            result = result.astype(dtype)
+
+        return result
+
+    def _get_rows(self, idx):
+        """Read rows by an index along the first dimension."""
+        data = self._reader._get_data(self._shard, self._key)
+        num_rows = self.shape[0]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(num_rows)
+            if step == 1:
+                stop = max(start, stop)
+                return data[self._line_start + start:
+                            self._line_start + stop]
+            idx = numpy.arange(start, stop, step)
+        elif isinstance(idx, (int, long, numpy.integer)):
+            if idx < -num_rows or idx >= num_rows:
+                raise IndexError('Index {} out of range {}'.format(
+                    idx, num_rows))
+            return data[self._line_start + idx % num_rows]
+
+        idx = numpy.asarray(idx)
+        if idx.dtype == 'bool':
+            idx = numpy.nonzero(idx)[0]
+        if idx.size == 0:
+            return numpy.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        if idx.min() < -num_rows or idx.max() >= num_rows:
+            raise IndexError('Index out of range {}'.format(num_rows))
+
+        # h5py needs increasing indices.
+        rows, inverse = numpy.unique(idx % num_rows + self._line_start,
+                                     return_inverse=True)
+
+        return data[rows.tolist()][inverse.reshape(idx.shape)]
+
+    def __getitem__(self, idx):
+        """Read the indexed rows."""
+        if isinstance(idx, tuple):
+            if len(idx) == 0:
+                return self[:]
+            if isinstance(idx[0], (int, long, numpy.integer)):
+                return self._get_rows(idx[0])[idx[1:]]
+            else:
+                return self._get_rows(idx[0])[(slice(None),) + idx[1:]]
+        else:
+            return self._get_rows(idx)
+
+
+class ShardHandlePool(object):
+    """Bounded LRU pool of open shard files, their separators and data
+    arrays."""
+
+    def __init__(self, capacity=8):
+        """Construct a shard handle pool.
+
+        Args:
+            capacity: number, maximum number of shards kept open.
+        """
+        if capacity < 1:
+            raise Exception('Pool capacity must be at least 1')
+        self.capacity = capacity
+        self._entries = collections.OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+        pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, fid):
+        """Get an open shard and mark it as most recently used.
+
+        Args:
+            fid: number, shard index.
+        Returns:
+            entry: tuple (h5py.File, dict of separators, dict of data 
+            arrays), None if not open.
+        """
+        if fid in self._entries:
+            entry = self._entries.pop(fid)
+            self._entries[fid] = entry
+            self.num_hits += 1
+            return entry
+        else:
+            self.num_misses += 1
+            return None
+
+    def put(self, fid, fh, sep, data):
+        """Add an open shard, closing the least recently used ones if full.
+
+        Args:
+            fid: number, shard index.
+            fh: h5py.File, opened shard.
+            sep: dict, separators of each key.
+            data: dict, h5py.Dataset or memory mapped array of each key.
+        Returns:
+            entry: tuple (h5py.File, dict of separators, dict of data arrays).
+        """
+        while len(self._entries) >= self.capacity:
+            old_fid, old_entry = self._entries.popitem(last=False)
+            old_entry[0].close()
+            self.num_evictions += 1
+        entry = (fh, sep, data)
+        self._entries[fid] = entry
+
+        return entry
+
+    def get_stats(self):
+        """Get hit, miss and eviction counters."""
+        return {
+            'hits': self.num_hits,
+            'misses': self.num_misses,
+            'evictions': self.num_evictions,
+            'open': len(self._entries)
+        }
+
+    def close(self):
+        """Close all open shards."""
+        for entry in self._entries.itervalues():
+            entry[0].close()
+        self._entries.clear()
+
+        pass
+
+
 class ShardedFile(object):
     """Sharded file object."""
 
@@ -167,6 +690,8 @@ class ShardedFile(object):
 
         for fname in os.listdir(dirname):
             fullname = os.path.join(dirname, fname)
+            if INDEX_FILE_PATTERN.match(fname):
+                continue
             if fnmatch.fnmatch(fullname, file_pattern):
                 flist.append(fullname)
 
@@ -217,13 +742,19 @@ class ShardedFile(object):
         return '{}-{:05d}-of-{:05d}{}'.format(
             self.file_prefix, shard, self.num_shards, self.suffix)
 
+    def get_index_fname(self):
+        """Get the file name of the index sidecar."""
+        return '{}-index-of-{:05d}.idx'.format(self.file_prefix,
+                                               self.num_shards)
+
 
 class ShardedFileReader(object):
     """Shareded file reader.
     """
 
     def __init__(self, sharded_file,
-                 key_name=KEY_KEYS, batch_size=1, check=True):
+                 key_name=KEY_KEYS, batch_size=1, check=True, use_index=True,
+                 max_open_files=8, mmap=False):
         """Construct a sharded file reader instance.
 
         Args:
@@ -232,9 +763,24 @@ class ShardedFileReader(object):
             batch_size: number, average batch_size for each read. The actual 
             size depends on the number of items in a file so is not guaranteed 
             to be the same size.
+            use_index: bool, whether to use the index sidecar when it is 
+            available and up to date.
+            max_open_files: number, number of shards kept open at the same 
+            time, with their separators.
+            mmap: bool, whether to read contiguous uncompressed keys from 
+            memory mapped views of the shards instead of through HDF5. Items 
+            are then read-only views of the mapping. Chunked or compressed 
+            keys are still read with h5py.
         """
         self.file = sharded_file
 
+        # Whether to use the index sidecar.
+        self._use_index = use_index
+
+        # Index sidecar, lazily loaded.
+        self._index = None
+        self._index_loaded = False
+
         # Batch size of reading.
         self.batch_size = batch_size
 
@@ -250,12 +796,18 @@ class ShardedFileReader(object):
         # Current file handler.
         self._fh = None
 
-        # Whether need to refresh file handler in the next read.
-        self._need_refresh = False
+        # Open shards.
+        self._pool = ShardHandlePool(max_open_files)
 
         # Current file separator.
         self._cur_sep = {}
 
+        # Whether to memory map contiguous datasets.
+        self._mmap = mmap
+
+        # Current file data arrays, h5py.Dataset or memory mapped.
+        self._cur_data = {}
+
         # Index based on keys.
         self._key_index = None
 
@@ -282,9 +834,9 @@ class ShardedFileReader(object):
 
     def __exit__(self, type, value, traceback):
         """Exit with clause."""
-        if self._fh is not None:
-            self._fh.close()
-            self._fh = None
+        self._pool.close()
+        self._fh = None
+        self._cur_data = {}
 
         pass
 
@@ -294,13 +846,7 @@ class ShardedFileReader(object):
 
     def __contains__(self, key):
         """Check whether a key is contained in the file."""
-        # Lazy build key index.
-        if self._key_index is None:
-            if self._key_name:
-                self._build_key(self._key_name)
-            else:
-                raise Exception(
-                    'You need to specify key field in the constructor.')
+        self._build_key_index()
 
         return key in self._key_index
 
@@ -338,22 +884,36 @@ class ShardedFileReader(object):
 
         pass
 
+    def _get_index(self):
+        """Get the index sidecar, None if not available."""
+        if not self._index_loaded:
+            if self._use_index:
+                self._index = _read_index(self.file)
+            self._index_loaded = True
+
+        return self._index
+
     def _build_index(self):
         """Build a mapping from an index to shard number.
 
         Returns:
             file_index: list, end element id - 1 of each shard.
         """
+        index_sidecar = self._get_index()
+        if index_sidecar is not None:
+            return numpy.cumsum(index_sidecar['num_items']).tolist()
+
         # log.info('Building index of file {}'.format(self.file.basename))
         file_index = []
         index = 0
         for shard_idx in xrange(self.file.num_shards):
             fname = self.file.get_fname(shard_idx)
-            fh = h5py.File(fname, 'r')
-            if KEY_NUM_ITEM in fh:
-                num_items = fh[KEY_NUM_ITEM][0]
-            else:
-                raise Exception(ERR_MSG_MISSING_NUM_ITEMS_FIELD.format(fname))
+            with h5py.File(fname, 'r') as fh:
+                if KEY_NUM_ITEM in fh:
+                    num_items = fh[KEY_NUM_ITEM][0]
+                else:
+                    raise Exception(
+                        ERR_MSG_MISSING_NUM_ITEMS_FIELD.format(fname))
             index += num_items
             file_index.append(index)
 
@@ -365,12 +925,24 @@ class ShardedFileReader(object):
         Args:
             key_name: string, name of the key field.
         """
+        index_sidecar = self._get_index()
+        if index_sidecar is not None and key_name == KEY_KEYS:
+            self._key_index = _KeyIndex(index_sidecar['keys'],
+                                        index_sidecar['key_shard'],
+                                        index_sidecar['key_offset'],
+                                        is_sorted=True)
+            return
+
         # log.info('Building key index of file {}'.format(self.file.basename))
-        self._key_index = {}
+        keys = []
         for shard_idx in xrange(self.file.num_shards):
             fname = self.file.get_fname(shard_idx)
-            fh = h5py.File(fname, 'r')
-            if key_name in fh:
+            with h5py.File(fname, 'r') as fh:
+                if key_name not in fh:
+                    raise Exception(
+                        'Key "{}" not found in the file {}'.format(
+                            key_name, fname))
+
                 key_index_i = fh[key_name][:]
                 num_keys = key_index_i.shape[0]
 
@@ -384,13 +956,19 @@ class ShardedFileReader(object):
                     raise Exception(
                         'Number of keys not equal to number of items')
 
-                for key_idx in xrange(key_index_i.shape[0]):
-                    k = key_index_i[key_idx]
-                    self._key_index[k] = (shard_idx, key_idx)
-            else:
-                raise Exception(
-                    'Key "{}" not found in the file {}'.format(
-                        key_name, fname))
+                if num_keys > 0:
+                    keys.append(key_index_i)
+                else:
+                    keys.append(None)
+
+        num_keys = numpy.array([kk.shape[0] if kk is not None else 0
+                                for kk in keys], dtype='int64')
+        self._key_index = _KeyIndex(
+            numpy.concatenate([kk for kk in keys if kk is not None]),
+            numpy.repeat(numpy.arange(self.file.num_shards, dtype='int32'),
+                         num_keys),
+            numpy.concatenate([numpy.arange(nn, dtype='int64')
+                               for nn in num_keys]))
 
         pass
 
@@ -405,166 +983,439 @@ class ShardedFileReader(object):
         if self._file_index is None:
             self._file_index = self._build_index()
 
-        return bisect.bisect_left(self._file_index, index)
+        # File index holds the end of each shard, so the first item of a shard
+        # equals the end of the previous one.
+        return bisect.bisect_right(self._file_index, index)
 
-    def _renew(self):
-        """Move to next file."""
-        self._cur_fid += 1
-        if self._fh is not None:
-            self._fh.close()
-            self._fh = None
-        # self._fh = h5py.File(self.file.get_fname(self._cur_fid), 'r')
-        self._need_refresh = False
+    def _get_shard_start(self, fid):
+        """Get the position of the first item of a shard."""
+        if fid == 0:
+            return 0
+        else:
+            return self._file_index[fid - 1]
+
+    def _open_shard(self, fid):
+        """Make a shard the current file, if it is not already.
+
+        Args:
+            fid: number, shard index.
+        """
+        if fid == self._cur_fid and self._fh is not None:
+            return
+        entry = self._pool.get(fid)
+        if entry is None:
+            fh = h5py.File(self.file.get_fname(fid), 'r')
+            sep = self._build_sep(fid, fh)
+            entry = self._pool.put(fid, fh, sep, self._build_data(fh, sep))
+        self._cur_fid = fid
+        self._fh, self._cur_sep, self._cur_data = entry
+
+        pass
+
+    def get_pool_stats(self):
+        """Get hit, miss and eviction counters of the open shard pool."""
+        return self._pool.get_stats()
+
+    def _build_key_index(self):
+        """Lazy build key index."""
+        if self._key_index is None:
+            if self._key_name:
+                self._build_key(self._key_name)
+            else:
+                raise Exception(
+                    'You need to specify key field in the constructor.')
 
         pass
 
-    def _build_sep(self):
-        """Build separators."""
-        num_items = self._fh[KEY_NUM_ITEM][0]
-        for key in self._fh.keys():
+    def _build_sep(self, fid, fh):
+        """Build separators.
+
+        Args:
+            fid: number, shard index.
+            fh: h5py.File, opened shard.
+        Returns:
+            sep: dict, key to end position of each item.
+        """
+        index_sidecar = self._get_index()
+        if index_sidecar is not None:
+            file_start = self._get_shard_start(fid)
+            file_end = self._file_index[fid]
+
+        num_items = fh[KEY_NUM_ITEM][0]
+        sep = {}
+        for key in fh.keys():
             if not key.startswith('__'):
                 sepname = _get_sep_from_key(key)
-                if sepname in self._fh:
-                    self._cur_sep[key] = self._fh[sepname][:]
+                if index_sidecar is not None and sepname in index_sidecar:
+                    sep[key] = numpy.array(
+                        index_sidecar[sepname][file_start: file_end])
+                elif sepname in fh:
+                    sep[key] = fh[sepname][:]
                 else:
-                    if self._fh[key].shape[0] != num_items:
+                    if fh[key].shape[0] != num_items:
                         raise Exception('Unknown sep {}'.format(key))
                     else:
-                        self._cur_sep[key] = numpy.arange(num_items)
+                        sep[key] = numpy.arange(1, num_items + 1)
 
-        pass
+        return sep
 
-    def _read_item(self, idx):
-        result = {}
-        for key in self._fh.keys():
-            if not key.startswith('__'):
-                # Compute line start and end.
-                if idx == 0:
-                    line_start = 0
-                else:
-                    line_start = self._cur_sep[key][idx - 1]
-                line_end = self._cur_sep[key][idx]
-                if line_start == line_end - 1:
-                    result[key] = self._fh[key][line_start]
+    def _build_data(self, fh, sep):
+        """Build data arrays of each key.
+
+        Args:
+            fh: h5py.File, opened shard.
+            sep: dict, separators of each key.
+        Returns:
+            data: dict, key to memory mapped array if mmap is on and the 
+            dataset allows it, otherwise h5py.Dataset.
+        """
+        data = {}
+        for key in sep.iterkeys():
+            data[key] = fh[key]
+            if self._mmap:
+                mapped = _mmap_dataset(fh.filename, data[key])
+                if mapped is not None:
+                    data[key] = mapped
+
+        return data
+
+    def _read_block(self, item_start, item_end):
+        """Read a contiguous range of items with one read per key.
+
+        Args:
+            item_start: number, first item in the current shard.
+            item_end: number, end item (exclusive) in the current shard.
+        Returns:
+            blocks: dict, key to numpy.ndarray, rows of all items.
+            offsets: dict, key to 1D int64 numpy.ndarray, row offset of each 
+            item in the block, num_items + 1 elements starting from 0.
+        """
+        blocks = {}
+        offsets = {}
+        for key in self._cur_sep.iterkeys():
+            sep = self._cur_sep[key]
+            if item_start == 0:
+                line_start = 0
+            else:
+                line_start = sep[item_start - 1]
+            line_end = sep[item_end - 1]
+            blocks[key] = self._cur_data[key][line_start: line_end]
+            offset = numpy.zeros([item_end - item_start + 1], dtype='int64')
+            offset[1:] = sep[item_start: item_end] - line_start
+            offsets[key] = offset
+
+        return blocks, offsets
+
+    def _split_block(self, blocks, offsets, squeeze=True):
+        """Split blocks into a list of items, values are views of the block.
+        Single rows are returned without the first dimension if squeeze.
+        """
+        num_items = None
+        for key in offsets.iterkeys():
+            num_items = offsets[key].shape[0] - 1
+            break
+
+        results = [{} for idx in xrange(num_items)]
+        for key in blocks.iterkeys():
+            block = blocks[key]
+            offset = offsets[key].tolist()
+            for idx in xrange(num_items):
+                if squeeze:
+                    results[idx][key] = self._get_rows(
+                        block, offset[idx], offset[idx + 1])
                 else:
-                    # log.info(line_start)
-                    # log.info(line_end)
-                    result[key] = self._fh[key][line_start: line_end]
+                    results[idx][key] = block[offset[idx]: offset[idx + 1]]
 
-        return result
+        return results
 
-    def read(self, num_items=1):
+    def _get_rows(self, block, line_start, line_end):
+        """Get the rows of an item, a single row is returned without the
+        first dimension."""
+        if line_start == line_end - 1:
+            return block[line_start]
+        else:
+            return block[line_start: line_end]
+
+    def _read_shard_items(self, item_idx):
+        """Read items of the current shard by coalescing contiguous rows into
+        one read per run.
+
+        Args:
+            item_idx: 1D int numpy.ndarray, sorted item indices in the current
+            shard, may contain duplicates.
+        Returns:
+            results: list of dict, one for each element of item_idx.
+        """
+        results = [{} for idx in xrange(item_idx.shape[0])]
+        for key in self._cur_sep.iterkeys():
+            sep = self._cur_sep[key]
+            line_end = sep[item_idx]
+            line_start = numpy.where(item_idx > 0, sep[item_idx - 1], 0)
+
+            # A new run starts when an item does not touch the rows read so
+            # far.
+            run_end = numpy.maximum.accumulate(line_end)
+            run_new = numpy.ones(item_idx.shape, dtype='bool')
+            run_new[1:] = line_start[1:] > run_end[:-1]
+            run_first = numpy.nonzero(run_new)[0].tolist()
+            run_first.append(item_idx.shape[0])
+            for rr in xrange(len(run_first) - 1):
+                first = run_first[rr]
+                last = run_first[rr + 1]
+                base = line_start[first]
+                block = self._cur_data[key][base: run_end[last - 1]]
+                for idx in xrange(first, last):
+                    results[idx][key] = self._get_rows(
+                        block, line_start[idx] - base, line_end[idx] - base)
+
+        return results
+
+    def read(self, num_items=1, columnar=False):
         """Read from the current position.
 
         Args:
             num_items: number, number of desired items to read. It is not 
             guaranteed to return the exact same number of items.
+            columnar: bool, whether to return the stacked rows of all items 
+            instead of a list of items.
         Returns:
             results: list of dict, keys are same with the keys defined in the 
-            file, values are numpy.ndarray.
+            file, values are numpy.ndarray. If columnar, a single dict with 
+            the rows of all items of each key, and the row offsets of each 
+            item under KEY_OFFSET.format(key).
         """
-        # Lazy build file index.
-        if self._file_index is None:
-            self._file_index = self._build_index()
-
-        # Renew file ID.
-        if self._need_refresh:
-            self._renew()
-
-        # Open a file.
-        if self._fh is None:
-            self._fh = h5py.File(self.file.get_fname(self._cur_fid), 'r')
-            self._build_sep()
+        # Open the shard of the current position.
+        self._open_shard(self.find(self._pos))
 
         # Compute file_start and file_end (absolute cursor) and
         # item_start and item_end (relative cursor).
-        if self._cur_fid == 0:
-            file_start = 0
-        else:
-            file_start = self._file_index[self._cur_fid - 1]
+        file_start = self._get_shard_start(self._cur_fid)
         file_end = self._file_index[self._cur_fid]
 
         item_start = self._pos - file_start
         item_end = min(self._pos + num_items, file_end) - file_start
 
-        # Refresh next time if reached the end.
-        if item_end == file_end - file_start:
-            self._need_refresh = True
-
         # log.error('fn: {}'.format(self.file))
         # log.error('fs: {:d}'.format(file_start))
         # log.error('fe: {:d}'.format(file_end))
         # log.error('is: {:d}'.format(item_start))
         # log.error('ie: {:d}'.format(item_end))
 
-        # Read data.
-        results = []
-        for i, idx in enumerate(xrange(item_start, item_end)):
-            results.append(self._read_item(idx))
+        # Read data, one read per key for the whole range.
+        blocks, offsets = self._read_block(item_start, item_end)
+        self._pos += item_end - item_start
 
-        self._pos += num_items
+        if columnar:
+            return self._get_columnar(blocks, offsets)
 
+        results = self._split_block(blocks, offsets)
         if num_items == 1:
             return results[0]
         else:
             return results
 
-    def read_key(self, key):
+    def _get_columnar(self, blocks, offsets):
+        """Add the row offsets of each key to the blocks."""
+        results = blocks
+        for key in offsets.iterkeys():
+            results[_get_offset_from_key(key)] = offsets[key]
+
+        return results
+
+    def read_shard(self, shard, columnar=False):
+        """Read all items of a shard, without moving the reader position.
+
+        Args:
+            shard: number, shard index.
+            columnar: bool, see read.
+        Returns:
+            results: list of dict, or a single dict if columnar, see read.
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+
+        num_items = self._file_index[shard] - self._get_shard_start(shard)
+        if num_items == 0:
+            return {} if columnar else []
+        self._open_shard(shard)
+        blocks, offsets = self._read_block(0, num_items)
+        if columnar:
+            return self._get_columnar(blocks, offsets)
+        else:
+            return self._split_block(blocks, offsets)
+
+    def iteritems(self, batch_size=1, squeeze=True):
+        """Iterate over all items with their keys, in position order, 
+        without moving the reader position.
+
+        Args:
+            batch_size: number, number of items read at once.
+            squeeze: bool, whether to return single rows without the first 
+            dimension, as read does. Otherwise every value keeps its rows, 
+            so that it can be written back unchanged.
+        Returns:
+            items: iterator over (key, dict) tuples.
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+
+        for shard in xrange(self.file.num_shards):
+            num_items = self._file_index[shard] - \
+                self._get_shard_start(shard)
+            if num_items == 0:
+                continue
+            self._open_shard(shard)
+            keys = self._fh[self._key_name][:]
+            for item_start in xrange(0, num_items, batch_size):
+                item_end = min(item_start + batch_size, num_items)
+                self._open_shard(shard)
+                blocks, offsets = self._read_block(item_start, item_end)
+                for key, item in zip(
+                        keys[item_start: item_end],
+                        self._split_block(blocks, offsets, squeeze)):
+                    yield key, item
+
+        pass
+
+    def get_item_bytes(self):
+        """Get the number of bytes of each item, from the separators and 
+        dataset shapes, without reading the data.
+
+        Returns:
+            item_bytes: 1D int64 numpy.ndarray, number of bytes of each item 
+            in position order.
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+
+        item_bytes = []
+        for shard in xrange(self.file.num_shards):
+            num_items = self._file_index[shard] - \
+                self._get_shard_start(shard)
+            if num_items == 0:
+                continue
+            self._open_shard(shard)
+            nbytes = numpy.zeros([num_items], dtype='int64')
+            for key in self._cur_sep.iterkeys():
+                data = self._cur_data[key]
+                row_bytes = data.dtype.itemsize * \
+                    int(numpy.prod(data.shape[1:]))
+                num_rows = numpy.diff(numpy.concatenate(
+                    [[0], self._cur_sep[key]]))
+                nbytes += num_rows * row_bytes
+            item_bytes.append(nbytes)
+        if len(item_bytes) == 0:
+            return numpy.zeros([0], dtype='int64')
+
+        return numpy.concatenate(item_bytes)
+
+    def _get_data(self, shard, key):
+        """Get the data array of a key in a shard, opening the shard if
+        needed."""
+        self._open_shard(shard)
+
+        return self._cur_data[key]
+
+    def _read_key_lazy(self, fid, pos, lazy):
+        """Read an item of a shard with lazy views, see read_key."""
+        self._open_shard(fid)
+        results = {}
+        for key in self._cur_sep.iterkeys():
+            sep = self._cur_sep[key]
+            line_start = 0 if pos == 0 else sep[pos - 1]
+            line_end = sep[pos]
+            if (lazy is True or key in lazy) and line_end - line_start != 1:
+                results[key] = LazyArray(self, fid, key, line_start, line_end)
+            else:
+                results[key] = self._get_rows(
+                    self._cur_data[key], line_start, line_end)
+
+        return results
+
+    def read_key(self, key, lazy=False):
         """Read an item based on key.
 
         Args:
             key: string, key of the item.
+            lazy: bool or list of field names, fields returned as LazyArray 
+            instead of being read. A single row is still read and returned 
+            without the first dimension.
         Returns:
             results: dict.
         """
         # Lazy build file index.
         if self._file_index is None:
             self._file_index = self._build_index()
+        self._build_key_index()
 
-        # Lazy build key index.
-        if self._key_index is None:
-            if self._key_name:
-                self._build_key(self._key_name)
-            else:
-                raise Exception(
-                    'You need to specify key field in the constructor.')
-
-        if key not in self._key_index:
+        location = self._key_index.get(key)
+        if location is None:
             log.warning('Key {} not found in file {}'.format(key, self.file))
             return None
         else:
-            location = self._key_index[key]
             fid = location[0]
             pos = location[1]
+            if lazy:
+                return self._read_key_lazy(fid, pos, lazy)
             # log.error('fid: {:d} pos: {:d}'.format(fid, pos))
-            if fid != self._cur_fid:
-                self._cur_fid = fid
-                self._fh = None
-            if fid != 0:
-                file_start = self._file_index[fid - 1]
-                pos = pos + file_start
-            self._pos = pos
-
-        # Disable refresh in key reading mode.
-        self._need_refresh = False
+            self._pos = self._get_shard_start(fid) + pos
 
         return self.read(num_items=1)
 
+    def read_keys(self, keys):
+        """Read a list of items based on keys.
+
+        Items are grouped by shard and sorted by position, so that each shard
+        is opened once and contiguous items are read together.
+
+        Args:
+            keys: list of keys.
+        Returns:
+            results: list of dict, in the same order as keys, None for keys
+            not found.
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+        self._build_key_index()
+
+        found, shard, offset = self._key_index.lookup(keys)
+        results = [None] * len(keys)
+        if not found.all():
+            log.warning('{:d} keys not found in file {}'.format(
+                int((~found).sum()), self.file))
+
+        # Sort by shard then by offset.
+        order = numpy.nonzero(found)[0]
+        order = order[numpy.lexsort((offset[order], shard[order]))]
+        shard = shard[order]
+        offset = offset[order]
+        shard_first = numpy.nonzero(shard[1:] != shard[:-1])[0] + 1
+        shard_first = [0] + shard_first.tolist() + [order.shape[0]]
+        for ss in xrange(len(shard_first) - 1):
+            first = shard_first[ss]
+            last = shard_first[ss + 1]
+            if first == last:
+                continue
+            self._open_shard(int(shard[first]))
+            items = self._read_shard_items(offset[first: last])
+            for idx, item in zip(order[first: last], items):
+                results[idx] = item
+
+        return results
+
     def keys(self):
         """Get a list of keys."""
-        # Lazy build key index.
-        if self._key_index is None:
-            if self._key_name:
-                self._build_key(self._key_name)
+        self._build_key_index()
 
         return self._key_index.keys()
 
     def iterkeys(self):
         """Get an iterable of keys."""
-        # Lazy build key index.
-        if self._key_index is None:
-            if self._key_name:
-                self._build_key(self._key_name)
+        self._build_key_index()
 
         return self._key_index.iterkeys()
 
@@ -577,13 +1428,7 @@ class ShardedFileReader(object):
             A SharededReader instance.
         """
         self._pos = pos
-        fid = self.find(self._pos)
-        if fid != self._cur_fid or self._fh is None:
-            self._cur_fid = fid
-            if self._fh is not None:
-                self._fh.close()
-                self._fh = None
-            self._fh = h5py.File(self.file.get_fname(fid), 'r')
+        self._open_shard(self.find(self._pos))
 
         return self
 
@@ -616,18 +1461,512 @@ class ShardedFileReader(object):
         pass
 
 
+def _prefetch_loop(reader, queue, stop):
+    """Read batches into a queue until the reader is exhausted or stopped.
+
+    Args:
+        reader: ShardedFileReader instance, positioned at the first batch.
+        queue: Queue.Queue or multiprocessing.Queue, receives ('batch', 
+        batch) for each batch, then ('done', None) or ('error', message).
+        stop: threading.Event or multiprocessing.Event, set to stop early.
+    """
+    def put(msg):
+        while not stop.is_set():
+            try:
+                queue.put(msg, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    try:
+        for batch in reader:
+            if not put(('batch', batch)):
+                return
+        put(('done', None))
+    except Exception:
+        put(('error', traceback.format_exc()))
+
+    pass
+
+
+def _prefetch_process_worker(sharded_file, reader_kwargs, pos, queue, stop):
+    """Open a reader in a prefetch process and read from a position."""
+    with ShardedFileReader(sharded_file, check=False,
+                           **reader_kwargs) as reader:
+        # Shards are opened on the first read, errors go to the queue.
+        reader._pos = pos
+        _prefetch_loop(reader, queue, stop)
+    queue.close()
+    queue.join_thread()
+
+    pass
+
+
+class PrefetchReader(object):
+    """Iterates the batches of a ShardedFileReader, reading ahead on a 
+    background thread or process.
+
+    In thread mode, the wrapped reader is used by the background thread and 
+    should not be used directly until the prefetch reader is closed. In 
+    process mode, the process opens its own reader on the same file, starting 
+    at the current position of the wrapped reader.
+    """
+
+    def __init__(self, reader, num_prefetch=4, mode='thread'):
+        """Construct a prefetch reader.
+
+        Args:
+            reader: ShardedFileReader instance.
+            num_prefetch: number, maximum number of batches read ahead.
+            mode: string, 'thread' or 'process'.
+        """
+        if mode not in ['thread', 'process']:
+            raise Exception('Unknown prefetch mode: {}'.format(mode))
+        if num_prefetch < 1:
+            raise Exception('Number of prefetched batches must be at least 1')
+        self._mode = mode
+        self._num_prefetch = num_prefetch
+        self._done = False
+        self._closed = False
+
+        # Stats.
+        self._num_batches = 0
+        self._wait_time = 0.0
+        self._depth_sum = 0
+
+        if mode == 'thread':
+            self._queue = Queue.Queue(num_prefetch)
+            self._stop = threading.Event()
+            self._worker = threading.Thread(
+                target=_prefetch_loop, args=(reader, self._queue, self._stop))
+            self._worker.daemon = True
+        else:
+            reader_kwargs = {
+                'key_name': reader._key_name,
+                'batch_size': reader.batch_size,
+                'use_index': reader._use_index,
+                'max_open_files': reader._pool.capacity,
+                'mmap': reader._mmap
+            }
+            self._queue = multiprocessing.Queue(num_prefetch)
+            self._stop = multiprocessing.Event()
+            self._worker = multiprocessing.Process(
+                target=_prefetch_process_worker,
+                args=(reader.file, reader_kwargs, reader._pos, self._queue,
+                      self._stop))
+            self._worker.daemon = True
+        self._worker.start()
+
+        pass
+
+    def __iter__(self):
+        """Get an iterator."""
+        return self
+
+    def __enter__(self):
+        """Enter with clause."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Exit with clause."""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+
+        # Unblock the worker and let a process flush its queue.
+        while self._worker.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self._worker.join()
+
+        pass
+
+    def _get_depth(self):
+        """Get the number of batches in the queue, -1 if unsupported."""
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def next(self):
+        """Get the next prefetched batch."""
+        if self._done or self._closed:
+            raise StopIteration()
+
+        depth = self._get_depth()
+        start = time.time()
+        while True:
+            try:
+                status, content = self._queue.get(timeout=1)
+                break
+            except Queue.Empty:
+                if not self._worker.is_alive():
+                    self._done = True
+                    raise Exception('Prefetch worker exited unexpectedly')
+        self._wait_time += time.time() - start
+
+        if status == 'done':
+            self._done = True
+            raise StopIteration()
+        elif status == 'error':
+            self._done = True
+            raise Exception('Prefetch worker failed:\n{}'.format(content))
+        self._num_batches += 1
+        self._depth_sum += max(depth, 0)
+
+        return content
+
+    def get_stats(self):
+        """Get prefetch stats.
+
+        Returns:
+            stats: dict, number of batches consumed, total and mean time spent 
+            waiting for a batch in seconds, mean and current queue depth 
+            (-1 if unsupported by the platform) and queue capacity. A mean 
+            depth close to zero with a large wait time means I/O bound.
+        """
+        num_batches = max(self._num_batches, 1)
+
+        return {
+            'num_batches': self._num_batches,
+            'wait_time': self._wait_time,
+            'mean_wait_time': self._wait_time / num_batches,
+            'mean_queue_depth': self._depth_sum / float(num_batches),
+            'queue_depth': self._get_depth(),
+            'capacity': self._num_prefetch
+        }
+
+    def close(self):
+        """Stop prefetching."""
+        self.__exit__(None, None, None)
+
+        pass
+
+
+# Reader of a scan worker process, see _init_scan_worker.
+_scan_reader = None
+
+
+def _init_scan_worker(sharded_file, reader_kwargs):
+    """Open the reader of a scan worker process."""
+    global _scan_reader
+    _scan_reader = ShardedFileReader(sharded_file, check=False,
+                                     **reader_kwargs)
+
+    pass
+
+
+def _scan_shard(args):
+    """Apply a function to all items of a shard in a scan worker."""
+    fn, shard, columnar = args
+    try:
+        return fn(_scan_reader.read_shard(shard, columnar=columnar))
+    except Exception:
+        raise Exception('Scan of shard {:d} failed:\n{}'.format(
+            shard, traceback.format_exc()))
+
+
+def imap_shards(sharded_file, fn, num_workers=4, columnar=False,
+                **reader_kwargs):
+    """Apply a function to each shard in a process pool, yielding results in
+    shard order as they become available.
+
+    Args:
+        sharded_file: ShardedFile instance.
+        fn: function, module level function taking the items of a shard, a 
+        list of dict or a columnar dict, see ShardedFileReader.read.
+        num_workers: number, number of processes, 0 to run in the current 
+        process.
+        columnar: bool, whether fn takes columnar data.
+        reader_kwargs: keyword arguments of the ShardedFileReader of each 
+        worker, e.g. mmap.
+    Returns:
+        results: iterator over the result of fn for each shard.
+    """
+    reader_kwargs.setdefault('max_open_files', 1)
+    tasks = [(fn, shard, columnar)
+             for shard in xrange(sharded_file.num_shards)]
+    if num_workers == 0:
+        _init_scan_worker(sharded_file, reader_kwargs)
+        try:
+            for task in tasks:
+                yield _scan_shard(task)
+        finally:
+            _scan_reader.close()
+        return
+
+    pool = multiprocessing.Pool(
+        num_workers, initializer=_init_scan_worker,
+        initargs=(sharded_file, reader_kwargs))
+    try:
+        for result in pool.imap(_scan_shard, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    pass
+
+
+def map_shards(sharded_file, fn, reducer=None, num_workers=4,
+               columnar=False, **reader_kwargs):
+    """Apply a function to each shard in a process pool and combine the
+    results.
+
+    Args:
+        sharded_file: ShardedFile instance.
+        fn: function, see imap_shards.
+        reducer: function, combines two results, applied in shard order. 
+        None to return the list of results.
+        num_workers: number, see imap_shards.
+        columnar: bool, see imap_shards.
+        reader_kwargs: see imap_shards.
+    Returns:
+        result: combined result, or list of results of each shard.
+    """
+    results = imap_shards(sharded_file, fn, num_workers=num_workers,
+                          columnar=columnar, **reader_kwargs)
+    if reducer is None:
+        return list(results)
+    else:
+        return reduce(reducer, results)
+
+
+def _append_item(buffer, sep, data, key):
+    """Append an item to the buffer of a shard.
+
+    Args:
+        buffer: dict, key to list of values, keys of items under KEY_KEYS.
+        sep: dict, key to list of end positions of each item.
+        data: dict, item to append.
+        key: int or string, key of the item.
+    """
+    # Check data format.
+    for kkey in data.iterkeys():
+        if kkey.startswith('__'):
+            raise Exception(
+                'Keys must not start with "__": {}'.format(kkey))
+        if len(buffer) > 0:
+            if kkey not in buffer:
+                raise Exception('Unknown key: {}'.format(kkey))
+
+    # Assign key.
+    if KEY_KEYS in buffer:
+        buffer[KEY_KEYS].append(key)
+    else:
+        buffer[KEY_KEYS] = [key]
+
+    for kkey in data.iterkeys():
+        if kkey in buffer:
+            buffer[kkey].append(data[kkey])
+        else:
+            buffer[kkey] = [data[kkey]]
+
+        if kkey not in sep:
+            sep[kkey] = []
+
+        shape0 = data[kkey].shape[0] if isinstance(
+            data[kkey], numpy.ndarray) else 1
+        if len(sep[kkey]) > 0:
+            last = sep[kkey][-1]
+            sep[kkey].append(last + shape0)
+        else:
+            sep[kkey].append(shape0)
+
+    pass
+
+
+def _concat_values(values):
+    """Convert a list of buffered values into an array."""
+    if isinstance(values[0], numpy.ndarray):
+        return numpy.concatenate(values, axis=0)
+    elif isinstance(values[0], str):
+        return numpy.array(values, dtype='string')
+    elif isinstance(values[0], int):
+        return numpy.array(values)
+    elif isinstance(values[0], float):
+        return numpy.array(values)
+    else:
+        raise Exception('Unknown type: {}'.format(type(values[0])))
+
+
+def _check_storage(storage):
+    """Check per-key storage specs, see ShardedFileWriter.
+
+    Returns:
+        storage: dict, empty if None.
+    """
+    if storage is None:
+        return {}
+    for key, spec in storage.iteritems():
+        for opt in spec.iterkeys():
+            if opt not in STORAGE_OPTIONS:
+                raise Exception(
+                    'Unknown storage option of key {}: {}'.format(key, opt))
+        if spec.get('compression') not in [None, 'gzip', 'lzf']:
+            raise Exception('Unknown compression of key {}: {}'.format(
+                key, spec['compression']))
+
+    return storage
+
+
+def _create_dataset(fh, name, value, spec=None, resizable=False):
+    """Create a dataset following a storage spec.
+
+    Args:
+        fh: h5py.File, opened shard.
+        name: string, dataset name.
+        value: numpy.ndarray, initial content.
+        spec: dict, storage spec of the key, see ShardedFileWriter.
+        resizable: bool, whether the first dimension can grow.
+    """
+    if spec is None:
+        spec = {}
+    if spec.get('dtype') is not None:
+        value = value.astype(spec['dtype'])
+    if value.size == 0 and not resizable:
+        fh[name] = value
+        return
+
+    kwargs = {}
+    chunks = spec.get('chunks')
+    if isinstance(chunks, int):
+        chunks = (chunks,) + value.shape[1:]
+    if resizable:
+        kwargs['maxshape'] = (None,) + value.shape[1:]
+        if chunks is None:
+            chunks = _get_stream_chunks(value)
+        dims = (chunks[0],) + value.shape[1:]
+    else:
+        dims = value.shape
+    if chunks is not None:
+        # Chunks can not exceed fixed dimensions.
+        kwargs['chunks'] = tuple(max(1, min(cc, dd))
+                                 for cc, dd in zip(chunks, dims))
+    if spec.get('compression') is not None:
+        kwargs['compression'] = spec['compression']
+        if spec.get('compression_opts') is not None:
+            kwargs['compression_opts'] = spec['compression_opts']
+    if spec.get('shuffle'):
+        kwargs['shuffle'] = True
+    fh.create_dataset(name, data=value, **kwargs)
+
+    pass
+
+
+def _write_buffer(fh, buffer, sep, num_items, storage=None):
+    """Write the buffer of a shard into an opened file.
+
+    Args:
+        fh: h5py.File, opened shard.
+        buffer: dict, see _append_item.
+        sep: dict, see _append_item.
+        num_items: number, number of items in the buffer.
+        storage: dict, storage spec of each key, see ShardedFileWriter.
+    Returns:
+        meta: dict, number of items, keys and separators of the shard, for 
+        the index sidecar.
+    """
+    if storage is None:
+        storage = {}
+    keys = None
+    for key in buffer.iterkeys():
+        value = _concat_values(buffer[key])
+        if key == KEY_KEYS:
+            fh[key] = value
+            keys = value
+        else:
+            _create_dataset(fh, key, value, storage.get(key))
+    if keys is None:
+        keys = numpy.zeros([0], dtype='int64')
+        fh[KEY_KEYS] = keys
+    fh[KEY_NUM_ITEM] = numpy.array([num_items])
+    sep_array = {}
+    for key in sep.iterkeys():
+        sep_array[key] = numpy.array(sep[key], dtype='int64')
+        fh[_get_sep_from_key(key)] = sep_array[key]
+
+    return {
+        'num_items': num_items,
+        'keys': keys,
+        'sep': sep_array
+    }
+
+
+def _get_stream_chunks(value):
+    """Get a chunk shape of whole rows, about STREAM_CHUNK_BYTES and no
+    larger than the first append."""
+    row_bytes = max(1, value.nbytes // max(1, value.shape[0]))
+    num_rows = max(1, min(STREAM_CHUNK_BYTES // row_bytes, value.shape[0]))
+
+    return (num_rows,) + value.shape[1:]
+
+
+def _append_dataset(fh, name, value, spec=None):
+    """Append rows to a resizable dataset, created on first use.
+
+    Args:
+        fh: h5py.File, opened shard.
+        name: string, dataset name.
+        value: numpy.ndarray, rows to append along the first dimension.
+        spec: dict, storage spec of the key, see ShardedFileWriter.
+    """
+    if name in fh:
+        dataset = fh[name]
+        num_rows = dataset.shape[0]
+        dataset.resize(num_rows + value.shape[0], axis=0)
+        dataset[num_rows:] = value
+    else:
+        _create_dataset(fh, name, value, spec, resizable=True)
+
+    pass
+
+
 class ShardedFileWriter(object):
     """Sharded file writer."""
 
-    def __init__(self, sharded_file, num_objects):
+    def __init__(self, sharded_file, num_objects, streaming=False,
+                 flush_bytes=STREAM_FLUSH_BYTES, storage=None,
+                 shard_sizes=None):
         """Construct a sharded file writer instance.
 
         Args:
             sharded_file: ShardedFile instance.
             num_objects: number, total number of objects to write.
+            streaming: bool, whether to append array fields to resizable 
+            datasets whenever the buffer reaches flush_bytes, instead of 
+            writing the whole shard at once.
+            flush_bytes: number, buffer size in bytes that triggers an append 
+            in streaming mode.
+            storage: dict, key to storage spec, a dict with optional fields
+                chunks: int, rows per chunk, or tuple, chunk shape.
+                compression: 'gzip' or 'lzf'.
+                compression_opts: gzip level.
+                shuffle: bool, whether to apply the shuffle filter.
+                dtype: numpy dtype the values are cast to.
+            shard_sizes: list, number of items of each shard, at least one. 
+            Default splits num_objects evenly.
         """
         self.file = sharded_file
 
+        # Storage spec of each key.
+        self._storage = _check_storage(storage)
+
+        # Streaming mode.
+        self._streaming = streaming
+        self._flush_bytes = flush_bytes
+
+        # Number of bytes of array fields in the buffer.
+        self._buffer_bytes = 0
+
+        # Array fields appended to resizable datasets in the current shard.
+        self._stream_keys = set()
+
         # Total number of items to write.
         self._num_objects = num_objects
 
@@ -638,6 +1977,20 @@ class ShardedFileWriter(object):
         self._num_objects_per_shard = int(
             math.ceil(num_objects / float(self._num_shards)))
 
+        # Item position where each shard ends.
+        if shard_sizes is None:
+            self._shard_end = [(shard + 1) * self._num_objects_per_shard
+                               for shard in xrange(self._num_shards)]
+        else:
+            if len(shard_sizes) != self._num_shards:
+                raise Exception('Expect {:d} shard sizes, got {:d}'.format(
+                    self._num_shards, len(shard_sizes)))
+            if min(shard_sizes) < 1 or sum(shard_sizes) != num_objects:
+                raise Exception(
+                    'Shard sizes must be positive and sum up to {:d}'.format(
+                        num_objects))
+            self._shard_end = numpy.cumsum(shard_sizes).tolist()
+
         # Current file handler.
         self._fh = None
 
@@ -659,6 +2012,10 @@ class ShardedFileWriter(object):
         # Set of keys used.
         self._keys = set()
 
+        # Number of items, keys and separators of each flushed shard, used to
+        # write the index sidecar.
+        self._index_meta = {}
+
         pass
 
     def __enter__(self):
@@ -667,10 +2024,30 @@ class ShardedFileWriter(object):
 
     def __exit__(self, type, value, traceback):
         """Exit with clause."""
-        self._flush()
+        try:
+            self._flush()
+        except Exception:
+            # An error in write can leave an item half buffered, keep the
+            # original error.
+            if type is None:
+                raise
+            log.error('Could not flush shard {:d} after an error'.format(
+                self._shard))
         if self._fh is not None:
             self._fh.close()
             self._fh = None
+        if type is None:
+            self._write_index()
+
+        pass
+
+    def _write_index(self):
+        """Write the index sidecar if all shards have been written."""
+        for shard in xrange(self._num_shards):
+            if shard not in self._index_meta:
+                return
+        _write_index(self.file, [self._index_meta[shard]
+                                 for shard in xrange(self._num_shards)])
 
         pass
 
@@ -678,11 +2055,16 @@ class ShardedFileWriter(object):
         """Write a single entry into buffer.
 
         Args:
-            data: numpy.ndarray or int or string, data entry.
+            data: numpy.ndarray or int or string, data entry. A field can also 
+            be an iterator of numpy.ndarray, the rows of the field in chunks. 
+            In streaming mode, chunks are appended to the shard as they come, 
+            so that the whole field is never in memory.
             key: (optional), int or string, key for data entry, default is the 
             0-based index.
         """
         if self._fh is None:
+            if self._shard >= self.file.num_shards:
+                raise Exception(ERR_MSG_IDX_TOO_LARGE2)
             self._fh = h5py.File(self.file.get_fname(self._shard), 'w')
 
         # Assign numerical key.
@@ -693,65 +2075,135 @@ class ShardedFileWriter(object):
         if key in self._keys:
             raise Exception('Key already exists: {}.'.format(key))
 
-        # Check data format.
-        for kkey in data.iterkeys():
-            if kkey.startswith('__'):
-                raise Exception(
-                    'Keys must not start with "__": {}'.format(kkey))
-            if len(self._buffer) > 0:
-                if kkey not in self._buffer:
-                    raise Exception('Unknown key: {}'.format(kkey))
-
-        # Assign key.
-        if KEY_KEYS in self._buffer:
-            self._buffer[KEY_KEYS].append(key)
-        else:
-            self._buffer[KEY_KEYS] = [key]
-
+        # Fields given in chunks. Each iterator is only consumed when its
+        # field is appended, one field after the other.
+        chunked = {}
         for kkey in data.iterkeys():
-            if kkey in self._buffer:
-                self._buffer[kkey].append(data[kkey])
-            else:
-                self._buffer[kkey] = [data[kkey]]
-
-            if kkey not in self._cur_sep:
-                self._cur_sep[kkey] = []
-
-            shape0 = data[kkey].shape[0] if isinstance(
-                data[kkey], numpy.ndarray) else 1
-            if len(self._cur_sep[kkey]) > 0:
-                last = self._cur_sep[kkey][-1]
-                self._cur_sep[kkey].append(last + shape0)
-            else:
-                self._cur_sep[kkey].append(shape0)
+            if isinstance(data[kkey], collections.Iterator):
+                chunked[kkey] = data[kkey]
+        if len(chunked) > 0:
+            data = dict([(kkey, data[kkey]) for kkey in data.iterkeys()
+                         if kkey not in chunked])
+            if not self._streaming:
+                for kkey in chunked.iterkeys():
+                    values = list(chunked[kkey])
+                    if len(values) == 0:
+                        raise Exception('No chunks for key {}'.format(kkey))
+                    data[kkey] = _concat_values(values)
+                chunked = {}
+
+        _append_item(self._buffer, self._cur_sep, data, key)
 
         # Increment counter.
         self._cur_num_items += 1
+
+        if self._streaming:
+            for kkey in data.iterkeys():
+                if isinstance(data[kkey], numpy.ndarray):
+                    self._buffer_bytes += data[kkey].nbytes
+            for kkey in sorted(chunked.iterkeys()):
+                self._append_chunks(kkey, chunked[kkey])
+            if self._buffer_bytes >= self._flush_bytes:
+                self._append_stream()
+
         self.next()
 
         pass
 
+    def _append_chunks(self, key, chunks):
+        """Buffer the rows of a field of the current item given in chunks, 
+        appending the buffer to the shard whenever it is full.
+
+        Args:
+            key: string, field name.
+            chunks: iterator of numpy.ndarray, rows of the field.
+        """
+        if key not in self._buffer:
+            self._buffer[key] = []
+            self._cur_sep[key] = []
+        sep = self._cur_sep[key]
+
+        # Rows of the field in the buffer, separators are relative to the
+        # rows appended so far.
+        num_rows = sep[-1] if len(sep) > 0 else 0
+        num_chunks = 0
+        for chunk in chunks:
+            self._buffer[key].append(chunk)
+            num_rows += chunk.shape[0]
+            num_chunks += 1
+            self._buffer_bytes += chunk.nbytes
+            if self._buffer_bytes >= self._flush_bytes:
+                self._append_stream()
+                num_rows = 0
+        if num_chunks == 0:
+            raise Exception('No chunks for key {}'.format(key))
+        self._cur_sep[key].append(num_rows)
+
+        pass
+
+    def _append_stream(self):
+        """Append buffered array fields to the resizable datasets of the
+        current shard. Keys and non-array fields stay in the buffer until the
+        shard is finished."""
+        for key in self._buffer.iterkeys():
+            values = self._buffer[key]
+            if key == KEY_KEYS:
+                continue
+            if len(values) == 0:
+                # Items of a streamed field may end right at an append.
+                if key not in self._stream_keys or \
+                        len(self._cur_sep[key]) == 0:
+                    continue
+            elif not isinstance(values[0], numpy.ndarray):
+                continue
+            if key in self._fh:
+                num_rows = self._fh[key].shape[0]
+            else:
+                num_rows = 0
+            if len(values) > 0:
+                _append_dataset(self._fh, key, _concat_values(values),
+                                self._storage.get(key))
+            _append_dataset(self._fh, _get_sep_from_key(key),
+                            numpy.array(self._cur_sep[key],
+                                        dtype='int64') + num_rows)
+            self._stream_keys.add(key)
+            self._buffer[key] = []
+            self._cur_sep[key] = []
+        self._buffer_bytes = 0
+
+        pass
+
+    def _finish_stream(self):
+        """Finish the current shard in streaming mode.
+
+        Returns:
+            meta: dict, see _write_buffer.
+        """
+        self._append_stream()
+        buffer = {}
+        sep = {}
+        for key in self._buffer.iterkeys():
+            if key not in self._stream_keys:
+                buffer[key] = self._buffer[key]
+                if key in self._cur_sep:
+                    sep[key] = self._cur_sep[key]
+        meta = _write_buffer(self._fh, buffer, sep, self._cur_num_items,
+                             self._storage)
+        for key in self._stream_keys:
+            meta['sep'][key] = self._fh[_get_sep_from_key(key)][:]
+        self._stream_keys = set()
+
+        return meta
+
     def _flush(self):
         """Flush the buffer into the current shard."""
         if len(self._buffer) > 0:
-            for key in self._buffer.iterkeys():
-                if isinstance(self._buffer[key][0], numpy.ndarray):
-                    value = numpy.concatenate(self._buffer[key], axis=0)
-                elif isinstance(self._buffer[key][0], str):
-                    value = numpy.array(self._buffer[key], dtype='string')
-                elif isinstance(self._buffer[key][0], int):
-                    value = numpy.array(self._buffer[key])
-                elif isinstance(self._buffer[key][0], float):
-                    value = numpy.array(self._buffer[key])
-                else:
-                    raise Exception('Unknown type: {}'.format(
-                        type(self._buffer[key][0])))
-                self._fh[key] = value
-            self._fh[KEY_NUM_ITEM] = numpy.array([self._cur_num_items])
-            for key in self._cur_sep.iterkeys():
-                sepname = _get_sep_from_key(key)
-                self._fh[sepname] = numpy.array(
-                    self._cur_sep[key], dtype='int64')
+            if self._streaming:
+                self._index_meta[self._shard] = self._finish_stream()
+            else:
+                self._index_meta[self._shard] = _write_buffer(
+                    self._fh, self._buffer, self._cur_sep,
+                    self._cur_num_items, self._storage)
             self._cur_num_items = 0
             self._cur_sep = {}
             self._buffer = {}
@@ -773,9 +2225,9 @@ class ShardedFileWriter(object):
         if self._cur_num_items > 0:
             self._flush()
 
+        # Shard index is checked when the next shard gets opened, so that
+        # filling up the last shard does not raise.
         self._shard += 1
-        if self._shard >= self.file.num_shards:
-            raise Exception(ERR_MSG_IDX_TOO_LARGE2)
         if self._fh is not None:
             self._fh.close()
             self._fh = None
@@ -786,8 +2238,7 @@ class ShardedFileWriter(object):
         """Move to writing the next object."""
         if self._pos < self._num_objects:
             self._pos += 1
-            r = self._pos - self._shard * self._num_objects_per_shard
-            if r == self._num_objects_per_shard:
+            if self._pos == self._shard_end[self._shard]:
                 self.next_file()
             i = self._pos
             return i
@@ -799,3 +2250,361 @@ class ShardedFileWriter(object):
         self.__exit__(None, None, None)
 
         pass
+
+
+def _get_shard_by_hash(key, num_shards):
+    """Get the shard of a key by a hash that is stable across processes."""
+    return (zlib.crc32(str(key)) & 0xffffffff) % num_shards
+
+
+def _parallel_writer_worker(sharded_file, shards, num_objects_per_shard,
+                            route, storage, in_queue, out_queue):
+    """Write the shards owned by a worker of ParallelShardedFileWriter.
+
+    Args:
+        sharded_file: ShardedFile instance.
+        shards: list, shard indices owned by this worker.
+        num_objects_per_shard: number, shard size when routing by position.
+        route: string, 'position' or 'hash'.
+        storage: dict, storage spec of each key, see ShardedFileWriter.
+        in_queue: multiprocessing.Queue, (shard, key, data, fn, args) items, 
+        None to finish.
+        out_queue: multiprocessing.Queue, ('meta', shard, meta) for each 
+        written shard, then ('done', None, None) or ('error', None, message).
+    """
+    buffers = {}
+
+    def flush(shard):
+        buffer, sep, num_items = buffers.pop(shard, ({}, {}, 0))
+        with h5py.File(sharded_file.get_fname(shard), 'w') as fh:
+            meta = _write_buffer(fh, buffer, sep, num_items, storage)
+        out_queue.put(('meta', shard, meta))
+
+    try:
+        while True:
+            msg = in_queue.get()
+            if msg is None:
+                break
+            shard, key, data, fn, args = msg
+            if fn is not None:
+                data = fn(*args)
+            if shard not in buffers:
+                buffers[shard] = ({}, {}, 0)
+            buffer, sep, num_items = buffers[shard]
+            _append_item(buffer, sep, data, key)
+            buffers[shard] = (buffer, sep, num_items + 1)
+
+            # Shards routed by position are complete once full.
+            if route == 'position' and \
+                    num_items + 1 == num_objects_per_shard:
+                flush(shard)
+
+        # Remaining shards, including empty ones.
+        for shard in shards:
+            if shard in buffers or route == 'hash':
+                flush(shard)
+        out_queue.put(('done', None, None))
+    except Exception:
+        out_queue.put(('error', None, traceback.format_exc()))
+
+    pass
+
+
+class ParallelShardedFileWriter(object):
+    """Sharded file writer that writes shards in a pool of processes.
+
+    Shard i is owned by worker i % num_workers, which buffers and writes it.
+    Items are routed by position, giving the same layout as 
+    ShardedFileWriter, or by a hash of the key.
+    """
+
+    def __init__(self, sharded_file, num_objects, num_workers=4,
+                 route='position', queue_size=8, storage=None):
+        """Construct a parallel sharded file writer instance.
+
+        Args:
+            sharded_file: ShardedFile instance.
+            num_objects: number, total number of objects to write.
+            num_workers: number, number of writer processes.
+            route: string, 'position' or 'hash'.
+            queue_size: number, maximum number of pending items per worker.
+            storage: dict, storage spec of each key, see ShardedFileWriter.
+        """
+        if route not in ['position', 'hash']:
+            raise Exception('Unknown route: {}'.format(route))
+        self.file = sharded_file
+        self._num_objects = num_objects
+        self._num_shards = self.file.num_shards
+        self._num_objects_per_shard = int(
+            math.ceil(num_objects / float(self._num_shards)))
+        self._route = route
+        self._num_workers = min(num_workers, self._num_shards)
+
+        # Current item index.
+        self._pos = 0
+
+        # Number of items, keys and separators of each written shard.
+        self._index_meta = {}
+
+        self._out_queue = multiprocessing.Queue()
+        self._in_queues = []
+        self._workers = []
+        for ww in xrange(self._num_workers):
+            in_queue = multiprocessing.Queue(queue_size)
+            shards = range(ww, self._num_shards, self._num_workers)
+            worker = multiprocessing.Process(
+                target=_parallel_writer_worker,
+                args=(self.file, shards, self._num_objects_per_shard,
+                      route, _check_storage(storage), in_queue,
+                      self._out_queue))
+            worker.daemon = True
+            worker.start()
+            self._in_queues.append(in_queue)
+            self._workers.append(worker)
+        self._closed = False
+
+        pass
+
+    def __enter__(self):
+        """Enter with clause."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Exit with clause."""
+        if self._closed:
+            return
+        self._closed = True
+        if type is not None:
+            for worker in self._workers:
+                worker.terminate()
+            return
+
+        for in_queue in self._in_queues:
+            self._put(in_queue, None)
+        num_done = 0
+        while num_done < self._num_workers:
+            if self._receive(timeout=1) == 'done':
+                num_done += 1
+        for worker in self._workers:
+            worker.join()
+
+        if len(self._index_meta) == self._num_shards:
+            _write_index(self.file, [self._index_meta[shard]
+                                     for shard in xrange(self._num_shards)])
+
+        pass
+
+    def _receive(self, timeout):
+        """Receive a message from the workers.
+
+        Returns:
+            status: string, message type, None if no message.
+        """
+        try:
+            status, shard, content = self._out_queue.get(timeout=timeout)
+        except Queue.Empty:
+            for worker in self._workers:
+                if not worker.is_alive() and worker.exitcode != 0:
+                    raise Exception('Writer process exited with code {}'.format(
+                        worker.exitcode))
+            return None
+        if status == 'error':
+            for worker in self._workers:
+                worker.terminate()
+            self._closed = True
+            raise Exception('Writer process failed:\n{}'.format(content))
+        elif status == 'meta':
+            self._index_meta[shard] = content
+
+        return status
+
+    def _put(self, in_queue, msg):
+        """Put a message to a worker, checking for errors while waiting."""
+        while True:
+            try:
+                in_queue.put(msg, timeout=1)
+                return
+            except Queue.Full:
+                self._receive(timeout=0)
+
+        pass
+
+    def _route_item(self, key):
+        """Assign key and shard of the next item."""
+        if self._pos >= self._num_objects:
+            raise Exception('Number of objects exceeds {:d}'.format(
+                self._num_objects))
+        if key is None:
+            key = self._pos
+        if self._route == 'position':
+            shard = self._pos // self._num_objects_per_shard
+        else:
+            shard = _get_shard_by_hash(key, self._num_shards)
+        self._pos += 1
+
+        return shard, key
+
+    def write(self, data, key=None):
+        """Write a single entry.
+
+        Args:
+            data: dict, data entry.
+            key: (optional), int or string, key for data entry, default is the 
+            0-based index.
+        """
+        shard, key = self._route_item(key)
+        self._put(self._in_queues[shard % self._num_workers],
+                  (shard, key, data, None, None))
+
+        pass
+
+    def write_from(self, fn, args=(), key=None):
+        """Write a single entry produced by the worker owning its shard.
+
+        Args:
+            fn: function, module level function returning the data entry.
+            args: tuple, arguments of fn.
+            key: (optional), int or string, key for data entry, default is the 
+            0-based index.
+        """
+        shard, key = self._route_item(key)
+        self._put(self._in_queues[shard % self._num_workers],
+                  (shard, key, None, fn, args))
+
+        pass
+
+    def close(self):
+        """Wait for all shards to be written."""
+        self.__exit__(None, None, None)
+
+        pass
+
+
+def get_balanced_shard_sizes(weights, num_shards):
+    """Split a sequence of items into contiguous shards of similar weight.
+
+    Args:
+        weights: 1D numpy.ndarray, weight of each item, e.g. number of bytes.
+        num_shards: number, number of shards, at most the number of items.
+    Returns:
+        shard_sizes: list, number of items of each shard, at least one.
+    """
+    num_items = weights.shape[0]
+    if num_shards > num_items:
+        raise Exception('Cannot split {:d} items into {:d} shards'.format(
+            num_items, num_shards))
+    cum_weights = numpy.cumsum(weights, dtype='float64')
+    targets = cum_weights[-1] * numpy.arange(1, num_shards + 1) / num_shards
+    shard_end = (numpy.searchsorted(cum_weights, targets) + 1).tolist()
+    shard_end[-1] = num_items
+
+    # Every shard gets at least one item.
+    for shard in xrange(num_shards):
+        low = shard + 1 if shard == 0 else shard_end[shard - 1] + 1
+        high = num_items - (num_shards - 1 - shard)
+        shard_end[shard] = min(max(shard_end[shard], low), high)
+
+    return numpy.diff([0] + shard_end).tolist()
+
+
+def _get_shard_stats(shard_sizes, item_bytes):
+    """Get a string of the min and max number of items and bytes of shards."""
+    shard_end = numpy.cumsum(shard_sizes)
+    shard_bytes = numpy.diff(numpy.concatenate(
+        [[0], numpy.cumsum(item_bytes)[shard_end - 1]]))
+
+    return 'items {:d}-{:d} MB {:.1f}-{:.1f}'.format(
+        min(shard_sizes), max(shard_sizes),
+        shard_bytes.min() / 1048576.0, shard_bytes.max() / 1048576.0)
+
+
+def _check_item_equal(key, source_item, target_item):
+    """Check that a copied item equals the source, after dtype conversion."""
+    if sorted(source_item.keys()) != sorted(target_item.keys()):
+        raise Exception('Fields of key {} differ'.format(key))
+    for kkey in source_item.iterkeys():
+        source_value = numpy.asarray(source_item[kkey])
+        target_value = numpy.asarray(target_item[kkey])
+        if not numpy.array_equal(source_value.astype(target_value.dtype),
+                                 target_value):
+            raise Exception('Field {} of key {} differs'.format(kkey, key))
+
+    pass
+
+
+def verify_copy(source, target, batch_size=1):
+    """Check that two sharded files hold the same items with the same keys in
+    the same order, regardless of sharding.
+
+    Args:
+        source: ShardedFile instance.
+        target: ShardedFile instance.
+        batch_size: number, number of items read at once.
+    """
+    with ShardedFileReader(source) as source_reader:
+        with ShardedFileReader(target) as target_reader:
+            if len(source_reader) != len(target_reader):
+                raise Exception('Number of items differ: {:d} vs {:d}'.format(
+                    len(source_reader), len(target_reader)))
+            for source_entry, target_entry in zip(
+                    source_reader.iteritems(batch_size, squeeze=False),
+                    target_reader.iteritems(batch_size, squeeze=False)):
+                if source_entry[0] != target_entry[0]:
+                    raise Exception('Keys differ: {} vs {}'.format(
+                        source_entry[0], target_entry[0]))
+                _check_item_equal(source_entry[0], source_entry[1],
+                                  target_entry[1])
+
+    pass
+
+
+def reshard(source, target, by='bytes', storage=None, batch_size=1,
+            flush_bytes=STREAM_FLUSH_BYTES, verify=False):
+    """Rewrite a sharded file into balanced shards.
+
+    Items keep their keys and order. They are copied in batches and the
+    target is written in streaming mode, so memory stays bounded by the
+    batch and flush_bytes.
+
+    Args:
+        source: ShardedFile instance.
+        target: ShardedFile instance, its number of shards is the number of 
+        output shards.
+        by: string, 'bytes' or 'items', what to balance across shards.
+        storage: dict, storage spec of each key of the target, see 
+        ShardedFileWriter.
+        batch_size: number, number of items read at once.
+        flush_bytes: number, see ShardedFileWriter.
+        verify: bool, whether to compare every item of the target with the 
+        source after writing.
+    Returns:
+        shard_sizes: list, number of items of each target shard.
+    """
+    if by not in ['bytes', 'items']:
+        raise Exception('Unknown balance criterion: {}'.format(by))
+    with ShardedFileReader(source) as reader:
+        item_bytes = reader.get_item_bytes()
+        if by == 'bytes':
+            weights = item_bytes
+        else:
+            weights = numpy.ones(item_bytes.shape, dtype='int64')
+        shard_sizes = get_balanced_shard_sizes(weights, target.num_shards)
+        source_sizes = numpy.diff([0] + reader._file_index).tolist()
+        log.info('Source {}: {}'.format(
+            source, _get_shard_stats(
+                [size for size in source_sizes if size > 0], item_bytes)))
+        log.info('Target {}: {}'.format(
+            target, _get_shard_stats(shard_sizes, item_bytes)))
+
+        with ShardedFileWriter(target, num_objects=item_bytes.shape[0],
+                               streaming=True, flush_bytes=flush_bytes,
+                               storage=storage,
+                               shard_sizes=shard_sizes) as writer:
+            for key, item in reader.iteritems(batch_size, squeeze=False):
+                writer.write(item, key=key)
+
+    if verify:
+        verify_copy(source, target, batch_size=batch_size)
+        log.info('Verified {:d} items'.format(item_bytes.shape[0]))
+
+    return shard_sizes
@@ -0,0 +1,522 @@
+"""
+Benchmarks of the sharded HDF5 format.
+
+Usage:
+    python sharded_hdf5_bench.py open --num_shards 10 100 1000
+    python sharded_hdf5_bench.py keys --num_keys 1000000
+    python sharded_hdf5_bench.py read --batch_size 1 16 256
+    python sharded_hdf5_bench.py pool --max_open_files 1 8 64
+    python sharded_hdf5_bench.py write --num_items 500
+    python sharded_hdf5_bench.py storage --num_items 200
+    python sharded_hdf5_bench.py storage --source /path/to/kitti/train
+    python sharded_hdf5_bench.py prefetch --compute_ms 5
+    python sharded_hdf5_bench.py mmap --num_windows 2000
+    python sharded_hdf5_bench.py scan --num_workers 1 4
+"""
+
+import argparse
+import logger
+import multiprocessing
+import numpy
+import os
+import resource
+import shutil
+import sharded_hdf5 as sh
+import tempfile
+import time
+
+log = logger.get()
+
+
+def make_dataset(folder, num_shards, items_per_shard, shape=(4,)):
+    """Write a synthetic sharded file with string keys.
+
+    Args:
+        folder: string, output folder.
+        num_shards: number, number of shards.
+        items_per_shard: number, number of items in each shard.
+        shape: tuple, shape of the data field of each item.
+    Returns:
+        f: ShardedFile instance.
+    """
+    num_items = num_shards * items_per_shard
+    f = sh.ShardedFile(os.path.join(folder, 'bench'), num_shards=num_shards)
+    random = numpy.random.RandomState(0)
+    with sh.ShardedFileWriter(f, num_objects=num_items) as writer:
+        for ii in xrange(num_items):
+            writer.write({
+                'data': random.uniform(size=shape).astype('float32'),
+                'label': ii % 7
+            }, key='item_{:08d}'.format(ii))
+
+    return f
+
+
+def bench_open(num_shards_list, items_per_shard):
+    """Compare reader start up time with and without the index sidecar."""
+    for num_shards in num_shards_list:
+        folder = tempfile.mkdtemp()
+        try:
+            f = make_dataset(folder, num_shards, items_per_shard)
+            key = 'item_{:08d}'.format(num_shards * items_per_shard - 1)
+            for use_index in [False, True]:
+                start = time.time()
+                with sh.ShardedFileReader(f, use_index=use_index) as reader:
+                    len(reader)
+                    reader[key]
+                elapsed = time.time() - start
+                log.info('shards {:5d} index {:d} open {:.4f}s'.format(
+                    num_shards, use_index, elapsed))
+        finally:
+            shutil.rmtree(folder)
+
+    pass
+
+
+def _run_key_index(kind, keys, shard, offset, query, queue):
+    """Build a key index in a fresh process and measure it."""
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if kind == 'dict':
+        key_index = dict(zip(keys.tolist(), zip(shard.tolist(),
+                                                 offset.tolist())))
+        get = key_index.get
+    else:
+        key_index = sh._KeyIndex(keys, shard, offset)
+        get = key_index.get
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    query = query.tolist()
+    start = time.time()
+    for key in query:
+        get(key)
+    elapsed = time.time() - start
+    queue.put((rss_end - rss_start, elapsed / len(query)))
+
+    pass
+
+
+def bench_keys(num_keys, num_shards, num_queries):
+    """Compare lookup latency and memory of dict and array key indices."""
+    random = numpy.random.RandomState(0)
+    keys = numpy.array(['item_{:08d}'.format(ii) for ii in xrange(num_keys)])
+    items_per_shard = int(numpy.ceil(num_keys / float(num_shards)))
+    shard = (numpy.arange(num_keys) // items_per_shard).astype('int32')
+    offset = numpy.arange(num_keys) % items_per_shard
+    query = keys[random.randint(0, num_keys, size=num_queries)]
+    for kind in ['dict', 'array']:
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(
+            target=_run_key_index,
+            args=(kind, keys, shard, offset, query, queue))
+        proc.start()
+        rss, latency = queue.get()
+        proc.join()
+        log.info('{:5s} keys {:d} memory {:.1f}MB lookup {:.2f}us'.format(
+            kind, num_keys, rss / 1024.0, latency * 1e6))
+
+    pass
+
+
+def _read_per_item(reader, num_items):
+    """Read a batch with one read per item and key, as before bulk reads.
+    Only handles reads within the current shard."""
+    if reader._file_index is None:
+        reader._file_index = reader._build_index()
+    if reader._fh is None:
+        reader.seek(reader._pos)
+    fh = reader._fh
+    fid = reader._cur_fid
+    file_start = 0 if fid == 0 else reader._file_index[fid - 1]
+    item_start = reader._pos - file_start
+    item_end = min(reader._pos + num_items,
+                   reader._file_index[fid]) - file_start
+    results = []
+    for idx in xrange(item_start, item_end):
+        result = {}
+        for key in fh.keys():
+            if not key.startswith('__'):
+                sep = reader._cur_sep[key]
+                line_start = 0 if idx == 0 else sep[idx - 1]
+                result[key] = fh[key][line_start: sep[idx]]
+        results.append(result)
+    reader._pos += item_end - item_start
+
+    return results
+
+
+def bench_read(batch_size_list, num_items, shape):
+    """Compare read throughput of per-item, bulk and columnar reads."""
+    folder = tempfile.mkdtemp()
+    try:
+        f = make_dataset(folder, 1, num_items, shape=shape)
+        methods = {
+            'per_item': lambda reader, bs: _read_per_item(reader, bs),
+            'bulk': lambda reader, bs: reader.read(bs),
+            'columnar': lambda reader, bs: reader.read(bs, columnar=True)
+        }
+        for batch_size in batch_size_list:
+            for name in ['per_item', 'bulk', 'columnar']:
+                with sh.ShardedFileReader(f) as reader:
+                    reader.seek(0)
+                    start = time.time()
+                    count = 0
+                    while count < num_items:
+                        methods[name](reader, batch_size)
+                        count = reader._pos
+                    elapsed = time.time() - start
+                log.info('batch {:4d} {:8s} {:.0f} items/s'.format(
+                    batch_size, name, num_items / elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+    pass
+
+
+def bench_pool(max_open_files_list, num_shards, items_per_shard,
+               num_queries):
+    """Random key reads with different open shard pool capacities."""
+    folder = tempfile.mkdtemp()
+    try:
+        f = make_dataset(folder, num_shards, items_per_shard)
+        random = numpy.random.RandomState(0)
+        num_items = num_shards * items_per_shard
+        query = ['item_{:08d}'.format(ii) for ii in
+                 random.randint(0, num_items, size=num_queries)]
+        for max_open_files in max_open_files_list:
+            with sh.ShardedFileReader(
+                    f, max_open_files=max_open_files) as reader:
+                len(reader)
+                reader.keys()
+                start = time.time()
+                for key in query:
+                    reader[key]
+                elapsed = time.time() - start
+                stats = reader.get_pool_stats()
+            log.info(('pool {:4d} {:.0f} keys/s hits {:d} misses {:d} '
+                      'evictions {:d}').format(
+                max_open_files, num_queries / elapsed, stats['hits'],
+                stats['misses'], stats['evictions']))
+    finally:
+        shutil.rmtree(folder)
+
+    pass
+
+
+def _run_write(streaming, folder, num_items, shape, flush_bytes, queue):
+    """Write one shard in a fresh process and measure peak memory."""
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    f = sh.ShardedFile(os.path.join(folder, 'write'), num_shards=1)
+    random = numpy.random.RandomState(0)
+    item = random.randint(0, 255, size=shape).astype('uint8')
+    start = time.time()
+    with sh.ShardedFileWriter(f, num_objects=num_items, streaming=streaming,
+                              flush_bytes=flush_bytes) as writer:
+        for ii in xrange(num_items):
+            writer.write({'images': item.copy(), 'label': ii})
+    elapsed = time.time() - start
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((rss_end - rss_start, elapsed))
+
+    pass
+
+
+def bench_write(num_items, shape, flush_bytes):
+    """Compare peak memory of buffered and streaming writes of one shard."""
+    folder = tempfile.mkdtemp()
+    try:
+        for streaming in [False, True]:
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(
+                target=_run_write,
+                args=(streaming, folder, num_items, shape, flush_bytes,
+                      queue))
+            proc.start()
+            rss, elapsed = queue.get()
+            proc.join()
+            shard_mb = num_items * numpy.prod(shape) / 1024.0 / 1024.0
+            log.info(('streaming {:d} shard {:.0f}MB peak memory {:.0f}MB '
+                      'time {:.2f}s').format(
+                streaming, shard_mb, rss / 1024.0, elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+    pass
+
+
+STORAGE_PRESETS = {
+    'default': None,
+    'chunked': {},
+    'lzf': {'compression': 'lzf', 'shuffle': True},
+    'gzip': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+}
+
+
+def _get_shards_size(f):
+    """Total size in bytes of the shards of a sharded file."""
+    return sum([os.path.getsize(f.get_fname(ii))
+                for ii in xrange(f.num_shards)])
+
+
+def _copy_with_storage(source, folder, storage):
+    """Copy a sharded file, writing every array field with a storage spec."""
+    with sh.ShardedFileReader(source) as reader:
+        keys = reader.keys()
+        specs = None
+        if storage is not None and len(keys) > 0:
+            item = reader[keys[0]]
+            specs = dict([(name, storage) for name in item.iterkeys()
+                          if isinstance(item[name], numpy.ndarray)])
+        f = sh.ShardedFile(os.path.join(folder, 'storage'),
+                           num_shards=source.num_shards)
+        with sh.ShardedFileWriter(f, num_objects=len(keys),
+                                  storage=specs) as writer:
+            for key in keys:
+                writer.write(reader[key], key=key)
+
+    return f
+
+
+def bench_storage(num_items, shape, presets, chunk_rows, source=None):
+    """Compare size on disk and read throughput of storage specs."""
+    folder = tempfile.mkdtemp()
+    try:
+        if source is None:
+            random = numpy.random.RandomState(0)
+            src = sh.ShardedFile(os.path.join(folder, 'source'), num_shards=1)
+            with sh.ShardedFileWriter(src, num_objects=num_items) as writer:
+                for ii in xrange(num_items):
+                    # Smooth image-like content and a few boxes.
+                    image = (numpy.linspace(0, 200, shape[0]).reshape(
+                        [-1] + [1] * (len(shape) - 1)) +
+                        random.randint(0, 16, size=shape)).astype('uint8')
+                    writer.write({
+                        'images': image,
+                        'bbox': random.uniform(
+                            0, 1000, size=(10, 4)).astype('float32')
+                    }, key='item_{:08d}'.format(ii))
+        else:
+            src = sh.ShardedFile.from_pattern_read(source)
+        for preset in presets:
+            path = os.path.join(folder, preset)
+            os.makedirs(path)
+            storage = STORAGE_PRESETS[preset]
+            if storage is not None:
+                storage = dict(storage, chunks=chunk_rows)
+            f = _copy_with_storage(src, path, storage)
+            with sh.ShardedFileReader(f) as reader:
+                keys = reader.keys()
+                start = time.time()
+                for key in keys:
+                    reader[key]
+                elapsed = time.time() - start
+            log.info('{:10s} size {:.1f}MB read {:.0f} items/s'.format(
+                preset, _get_shards_size(f) / 1024.0 / 1024.0,
+                len(keys) / elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+    pass
+
+
+def bench_prefetch(num_items, shape, batch_size, num_prefetch, compute_ms):
+    """Compare an epoch with and without prefetching, with a fixed compute
+    time per batch standing in for a training step."""
+    folder = tempfile.mkdtemp()
+    try:
+        f = make_dataset(folder, 4, num_items // 4, shape=shape)
+        for mode in ['none', 'thread', 'process']:
+            with sh.ShardedFileReader(f, batch_size=batch_size) as reader:
+                start = time.time()
+                if mode == 'none':
+                    batches = reader
+                else:
+                    batches = sh.PrefetchReader(
+                        reader, num_prefetch=num_prefetch, mode=mode)
+                for batch in batches:
+                    time.sleep(compute_ms / 1000.0)
+                elapsed = time.time() - start
+                if mode == 'none':
+                    stats = {'mean_wait_time': 0.0, 'mean_queue_depth': 0.0}
+                else:
+                    stats = batches.get_stats()
+                    batches.close()
+            log.info(('{:7s} {:.0f} items/s wait {:.2f}ms/batch '
+                      'depth {:.1f}').format(
+                mode, num_items / elapsed, stats['mean_wait_time'] * 1e3,
+                stats['mean_queue_depth']))
+    finally:
+        shutil.rmtree(folder)
+
+    pass
+
+
+def bench_mmap(num_seqs, num_frames, frame_shape, window_size, num_windows):
+    """Compare random frame window reads through h5py and memory maps."""
+    folder = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(folder, 'mmap'), num_shards=num_seqs)
+        random = numpy.random.RandomState(0)
+        frame = random.randint(0, 255, size=frame_shape).astype('uint8')
+        with sh.ShardedFileWriter(f, num_objects=num_seqs) as writer:
+            for ii in xrange(num_seqs):
+                writer.write({
+                    'images': numpy.tile(frame, [num_frames, 1, 1, 1])
+                }, key='seq_{:04d}'.format(ii))
+        seq = random.randint(0, num_seqs, size=num_windows)
+        start = random.randint(0, num_frames - window_size, size=num_windows)
+        for mmap in [False, True]:
+            with sh.ShardedFileReader(f, mmap=mmap,
+                                      max_open_files=num_seqs) as reader:
+                reader.keys()
+                tic = time.time()
+                for ii in xrange(num_windows):
+                    item = reader['seq_{:04d}'.format(seq[ii])]
+                    window = numpy.array(
+                        item['images'][start[ii]: start[ii] + window_size])
+                elapsed = time.time() - tic
+            log.info('mmap {:d} {:.0f} windows/s'.format(
+                mmap, num_windows / elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+    pass
+
+
+def _get_box_moments(data):
+    """Count, sum and sum of squares of box sizes of columnar shard data."""
+    if 'bbox' not in data:
+        return numpy.zeros([3, 2])
+    size = data['bbox'][:, 2: 4] - data['bbox'][:, :2]
+
+    return numpy.array([[size.shape[0]] * 2, size.sum(axis=0),
+                        (size * size).sum(axis=0)])
+
+
+def bench_scan(num_workers_list, num_shards, items_per_shard, num_boxes):
+    """Compare box size statistics computed with a sequential reader and
+    with map_shards."""
+    folder = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(folder, 'scan'),
+                           num_shards=num_shards)
+        random = numpy.random.RandomState(0)
+        with sh.ShardedFileWriter(
+                f, num_objects=num_shards * items_per_shard) as writer:
+            for ii in xrange(num_shards * items_per_shard):
+                top_left = random.uniform(0, 1000, size=(num_boxes, 2))
+                writer.write({'bbox': numpy.concatenate(
+                    [top_left, top_left + random.uniform(
+                        20, 200, size=(num_boxes, 2))], axis=1)})
+
+        start = time.time()
+        moments = numpy.zeros([3, 2])
+        with sh.ShardedFileReader(f) as reader:
+            for item in reader:
+                moments += _get_box_moments(item)
+        elapsed = time.time() - start
+        log.info('reader    {:.3f}s mean {}'.format(
+            elapsed, moments[1] / moments[0]))
+        for num_workers in num_workers_list:
+            start = time.time()
+            moments = sh.map_shards(f, _get_box_moments, reducer=numpy.add,
+                                    num_workers=num_workers, columnar=True)
+            elapsed = time.time() - start
+            log.info('workers {:d} {:.3f}s mean {}'.format(
+                num_workers, elapsed, moments[1] / moments[0]))
+    finally:
+        shutil.rmtree(folder)
+
+    pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sharded HDF5 benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_open = subparsers.add_parser(
+        'open', help='Cold open time with and without index sidecar')
+    parser_open.add_argument('--num_shards', type=int, nargs='+',
+                             default=[10, 100, 1000])
+    parser_open.add_argument('--items_per_shard', type=int, default=100)
+    parser_keys = subparsers.add_parser(
+        'keys', help='Key index lookup latency and memory')
+    parser_keys.add_argument('--num_keys', type=int, default=1000000)
+    parser_keys.add_argument('--num_shards', type=int, default=100)
+    parser_keys.add_argument('--num_queries', type=int, default=100000)
+    parser_read = subparsers.add_parser(
+        'read', help='Read throughput of per-item and bulk reads')
+    parser_read.add_argument('--batch_size', type=int, nargs='+',
+                             default=[1, 16, 256])
+    parser_read.add_argument('--num_items', type=int, default=20000)
+    parser_read.add_argument('--shape', type=int, nargs='+', default=[64])
+    parser_pool = subparsers.add_parser(
+        'pool', help='Random key reads with different pool capacities')
+    parser_pool.add_argument('--max_open_files', type=int, nargs='+',
+                             default=[1, 8, 64])
+    parser_pool.add_argument('--num_shards', type=int, default=64)
+    parser_pool.add_argument('--items_per_shard', type=int, default=100)
+    parser_pool.add_argument('--num_queries', type=int, default=5000)
+    parser_write = subparsers.add_parser(
+        'write', help='Peak memory of buffered and streaming writes')
+    parser_write.add_argument('--num_items', type=int, default=500)
+    parser_write.add_argument('--shape', type=int, nargs='+',
+                              default=[375, 1242, 3])
+    parser_write.add_argument('--flush_bytes', type=int, default=2 ** 26)
+    parser_storage = subparsers.add_parser(
+        'storage', help='Size on disk and read throughput of storage specs')
+    parser_storage.add_argument('--num_items', type=int, default=200)
+    parser_storage.add_argument('--shape', type=int, nargs='+',
+                                default=[375, 1242, 3])
+    parser_storage.add_argument('--presets', nargs='+',
+                                default=['default', 'chunked', 'lzf',
+                                         'gzip'])
+    parser_storage.add_argument('--chunk_rows', type=int, default=64,
+                                help='Rows per chunk of every array field')
+    parser_storage.add_argument('--source', default=None,
+                                help='Pattern of an existing sharded file')
+    parser_prefetch = subparsers.add_parser(
+        'prefetch', help='Epoch time with and without prefetching')
+    parser_prefetch.add_argument('--num_items', type=int, default=20000)
+    parser_prefetch.add_argument('--shape', type=int, nargs='+',
+                                 default=[1024])
+    parser_prefetch.add_argument('--batch_size', type=int, default=64)
+    parser_prefetch.add_argument('--num_prefetch', type=int, default=4)
+    parser_prefetch.add_argument('--compute_ms', type=float, default=5)
+    parser_mmap = subparsers.add_parser(
+        'mmap', help='Random frame window reads with and without mmap')
+    parser_mmap.add_argument('--num_seqs', type=int, default=8)
+    parser_mmap.add_argument('--num_frames', type=int, default=100)
+    parser_mmap.add_argument('--frame_shape', type=int, nargs='+',
+                             default=[128, 416, 3])
+    parser_mmap.add_argument('--window_size', type=int, default=8)
+    parser_mmap.add_argument('--num_windows', type=int, default=2000)
+    parser_scan = subparsers.add_parser(
+        'scan', help='Shard statistics with a reader and with map_shards')
+    parser_scan.add_argument('--num_workers', type=int, nargs='+',
+                             default=[1, 4])
+    parser_scan.add_argument('--num_shards', type=int, default=16)
+    parser_scan.add_argument('--items_per_shard', type=int, default=500)
+    parser_scan.add_argument('--num_boxes', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'open':
+        bench_open(args.num_shards, args.items_per_shard)
+    elif args.command == 'keys':
+        bench_keys(args.num_keys, args.num_shards, args.num_queries)
+    elif args.command == 'read':
+        bench_read(args.batch_size, args.num_items, tuple(args.shape))
+    elif args.command == 'pool':
+        bench_pool(args.max_open_files, args.num_shards,
+                   args.items_per_shard, args.num_queries)
+    elif args.command == 'write':
+        bench_write(args.num_items, tuple(args.shape), args.flush_bytes)
+    elif args.command == 'storage':
+        bench_storage(args.num_items, tuple(args.shape), args.presets,
+                      args.chunk_rows, args.source)
+    elif args.command == 'prefetch':
+        bench_prefetch(args.num_items, tuple(args.shape), args.batch_size,
+                       args.num_prefetch, args.compute_ms)
+    elif args.command == 'mmap':
+        bench_mmap(args.num_seqs, args.num_frames, tuple(args.frame_shape),
+                   args.window_size, args.num_windows)
+    elif args.command == 'scan':
+        bench_scan(args.num_workers, args.num_shards, args.items_per_shard,
+                   args.num_boxes)
@@ -1,8 +1,47 @@
 import cv2
 import h5py
+import itertools
+import multiprocessing
 import numpy as np
+import os
 import tfplus
 import tfplus.utils.progress_bar as pb
+import time
+
+# Assembler of the encoding workers, inherited by fork, see assemble.
+_assembler = None
+
+
+def _get_stamp(fname):
+    """Get modification time and size of a source file, None if unknown."""
+    if fname is None or not os.path.exists(fname):
+        return None
+    stat = os.stat(fname)
+    return (stat.st_mtime, stat.st_size)
+
+
+def _is_stamp_equal(group, stamp):
+    """Check whether a group was built from a source with the same stamp."""
+    if stamp is None:
+        return False
+    if 'src_mtime' not in group.attrs or 'src_size' not in group.attrs:
+        return False
+    return group.attrs['src_mtime'] == stamp[0] and \
+        group.attrs['src_size'] == stamp[1]
+
+
+def _set_stamp(group, stamp):
+    """Record the source stamp of a group."""
+    if stamp is not None:
+        group.attrs['src_mtime'] = stamp[0]
+        group.attrs['src_size'] = stamp[1]
+    pass
+
+
+def _encode_frame(task):
+    """Read and encode a frame in a worker."""
+    vid_id, frm_id = task
+    return _assembler.encode(_assembler.get_frame_img(vid_id, frm_id))
 
 
 class TrackingDataAssembler(object):
@@ -10,6 +49,10 @@ class TrackingDataAssembler(object):
     {video_id}/video/frm_{frame_id}/image: PNG encoded image
     {video_id}/annotations/obj_{object_id}/bbox: {left, top, right, bottom} * num_valid_frames
     {video_id}/annotations/obj_{object_id}/presence: frame indices of appearance
+
+    Frame and annotation groups record the mtime and size of their source 
+    file in attributes "src_mtime" and "src_size", see get_frame_source and 
+    get_obj_source, so that incremental builds skip unchanged sources.
     """
 
     def __init__(self, output_fname):
@@ -39,36 +82,142 @@ class TrackingDataAssembler(object):
     def get_frame_img(self, vid_id, frm_id):
         raise Exception('Not implemented')
 
+    def get_frame_source(self, vid_id, frm_id):
+        """File name the frame is read from, None if unknown, in which case 
+        the frame is always rebuilt."""
+        return None
+
     def get_obj_ids(self, vid_id):
         raise Exception('Not implemented')
 
     def get_obj_data(self, vid_id, obj_id):
         raise Exception('Not implemented')
 
-    def assemble(self):
+    def get_obj_source(self, vid_id):
+        """File name the annotations of a video are read from, None if 
+        unknown, in which case they are always rebuilt."""
+        return None
+
+    def prune(self, h5f):
+        """Delete videos, frames and annotations that no longer have a 
+        source, so that an incremental build matches a clean one.
+
+        Args:
+            h5f: h5py.File instance, the output file.
+
+        Returns:
+            num_removed: number of deleted groups.
+        """
+        num_removed = 0
+        vid_ids = set(self.vid_ids)
+        for vid_id in list(h5f.keys()):
+            if vid_id not in vid_ids:
+                del h5f[vid_id]
+                num_removed += 1
+                continue
+            vid_group = h5f[vid_id]
+            if 'video' in vid_group:
+                frm_keys = set(['frm_{}'.format(frm_id)
+                                for frm_id in self.get_frame_ids(vid_id)])
+                for frm_key in list(vid_group['video'].keys()):
+                    if frm_key not in frm_keys:
+                        del vid_group['video'][frm_key]
+                        num_removed += 1
+            if 'annotations' in vid_group and \
+                    self.get_obj_ids(vid_id) is None:
+                del vid_group['annotations']
+                num_removed += 1
+        return num_removed
+
+    def assemble(self, num_workers=0, incremental=False):
+        """Write all videos into the output file.
+
+        Args:
+            num_workers: number of processes reading and PNG-encoding frames, 
+            0 to encode in the current process. The current process writes 
+            the file either way.
+            incremental: skip frames and annotations whose source mtime and 
+            size match the ones recorded in the file, and delete the ones 
+            whose source is gone, see prune.
+        """
+        global _assembler
         num_vid = len(self.vid_ids)
+        start_time = time.time()
 
         with h5py.File(self.output_fname, 'a') as h5f:
-            for idx in pb.get(num_vid):
-                vid_id = self.vid_ids[idx]
+            if incremental:
+                self.log.info('Removed {} entries without a source'.format(
+                    self.prune(h5f)))
+
+            # Frames to encode.
+            tasks = []
+            stamps = []
+            num_skip = 0
+            for vid_id in self.vid_ids:
                 for frm_id in self.get_frame_ids(vid_id):
-                    frm_img = self.get_frame_img(vid_id, frm_id)
-                    img_enc = self.encode(frm_img)
-                    frm_key = '{}/video/frm_{}/image'.format(vid_id, frm_id)
-                    self.save(frm_key, img_enc, h5f)
+                    stamp = _get_stamp(self.get_frame_source(vid_id, frm_id))
+                    frm_key = '{}/video/frm_{}'.format(vid_id, frm_id)
+                    if incremental and frm_key + '/image' in h5f and \
+                            _is_stamp_equal(h5f[frm_key], stamp):
+                        num_skip += 1
+                        continue
+                    tasks.append((vid_id, frm_id))
+                    stamps.append(stamp)
+            self.log.info('Encoding {} frames, {} unchanged'.format(
+                len(tasks), num_skip))
+
+            _assembler = self
+            pool = None
+            if num_workers > 0 and len(tasks) > 0:
+                pool = multiprocessing.Pool(num_workers)
+                results = pool.imap(_encode_frame, tasks, chunksize=8)
+            else:
+                results = itertools.imap(_encode_frame, tasks)
+            try:
+                for idx, img_enc in itertools.izip(pb.get(len(tasks)),
+                                                   results):
+                    vid_id, frm_id = tasks[idx]
+                    frm_key = '{}/video/frm_{}'.format(vid_id, frm_id)
+                    self.save(frm_key + '/image', img_enc, h5f)
+                    _set_stamp(h5f[frm_key], stamps[idx])
+                if pool is not None:
+                    pool.close()
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+                _assembler = None
 
+            num_skip = 0
+            for idx in pb.get(num_vid):
+                vid_id = self.vid_ids[idx]
                 obj_ids = self.get_obj_ids(vid_id)
                 if obj_ids is None:
                     # Testing data do not have labels.
                     continue
+                ann_key = '{}/annotations'.format(vid_id)
+                stamp = _get_stamp(self.get_obj_source(vid_id))
+                if incremental and ann_key in h5f:
+                    if _is_stamp_equal(h5f[ann_key], stamp):
+                        num_skip += 1
+                        continue
+                    # Objects may have been removed from the source.
+                    del h5f[ann_key]
                 for obj_id in obj_ids:
                     obj_data = self.get_obj_data(vid_id, obj_id)
-                    obj_key = '{}/annotations/obj_{}'.format(vid_id, obj_id)
+                    obj_key = '{}/obj_{}'.format(ann_key, obj_id)
                     frm_nonzero = obj_data['presence'].nonzero()[0]
                     self.save(obj_key + '/bbox',
                               obj_data['bbox'][frm_nonzero], h5f)
                     self.save(obj_key + '/frame_indices', frm_nonzero, h5f)
                     pass
+                if ann_key in h5f:
+                    _set_stamp(h5f[ann_key], stamp)
                 pass
+            if incremental:
+                self.log.info('{} videos with unchanged annotations'.format(
+                    num_skip))
             pass
+        self.log.info('Assembled {} in {:.1f}s'.format(
+            self.output_fname, time.time() - start_time))
         pass
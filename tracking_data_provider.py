@@ -1,13 +1,107 @@
 import cslab_environ
 
+import collections
 import cv2
 import h5py
+import json
+import multiprocessing
 import numpy as np
+import os
+import Queue
+import random
 import tfplus
+import time
+import traceback
 
 tfplus.cmd_args.add('td:window_size', 'int', 20)
+tfplus.cmd_args.add('td:window_mode', 'str', 'train_dense')
+tfplus.cmd_args.add('td:window_stride', 'int', 1)
 tfplus.cmd_args.add('td:inp_height', 'int', 128)
 tfplus.cmd_args.add('td:inp_width', 'int', 448)
+tfplus.cmd_args.add('td:frame_cache_mb', 'int', 1024)
+tfplus.cmd_args.add('td:frame_cache_file', 'bool', False)
+
+# Channels of a decoded frame: image, foreground and 8 orientations.
+NUM_FRAME_CHANNELS = 12
+
+# Window index entry, video and object IDs are interned as integer codes.
+# Frames [frame_start + keep_start, frame_start + keep_end) are the ones the
+# window contributes when stitching outputs back into tracks.
+WINDOW_DTYPE = np.dtype([('video', 'int32'), ('object', 'int32'),
+                         ('frame_start', 'int32'), ('keep_start', 'int32'),
+                         ('keep_end', 'int32')])
+
+WINDOW_MODES = ['train_dense', 'eval_no_overlap']
+
+BATCH_VARIABLES = ['x', 'fg', 'angle', 'bbox_gt', 's_gt']
+
+
+def _write_atomic(fname, write_fn):
+    """Write a file under a temporary name then rename it into place, so
+    that readers never see a partial file.
+
+    Args:
+        fname: string, output file name.
+        write_fn: function of an open binary file object.
+    """
+    tmp_fname = '{}.tmp{:d}'.format(fname, os.getpid())
+    try:
+        with open(tmp_fname, 'wb') as f:
+            write_fn(f)
+        os.rename(tmp_fname, fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+    pass
+
+
+class FrameCache(object):
+    """LRU cache of decoded frames with a byte budget."""
+
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Get a frame and mark it as most recently used, None if absent."""
+        if key in self._entries:
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            self.num_hits += 1
+            return entry
+        else:
+            self.num_misses += 1
+            return None
+
+    def put(self, key, entry):
+        """Add a frame, a tuple (pixels, orig_height, orig_width), evicting
+        the least recently used ones over budget."""
+        nbytes = entry[0].nbytes
+        if nbytes > self.capacity_bytes:
+            return
+        while self._num_bytes + nbytes > self.capacity_bytes:
+            old_key, old_entry = self._entries.popitem(last=False)
+            self._num_bytes -= old_entry[0].nbytes
+        self._entries[key] = entry
+        self._num_bytes += nbytes
+        pass
+
+    def get_stats(self):
+        return {
+            'hits': self.num_hits,
+            'misses': self.num_misses,
+            'frames': len(self._entries),
+            'bytes': self._num_bytes
+        }
 
 
 class TrackingDataProvider(tfplus.data.DataProvider):
@@ -15,13 +109,20 @@ class TrackingDataProvider(tfplus.data.DataProvider):
     def __init__(self, split='train', filename=None):
         super(TrackingDataProvider, self).__init__()
         self._windows = None
+        self._window_names = None
         self._filename = filename
         self._split = split
         self.log = tfplus.utils.logger.get()
         self.register_option('td:window_size')
+        self.register_option('td:window_mode')
+        self.register_option('td:window_stride')
         self.register_option('td:inp_height')
         self.register_option('td:inp_width')
-        self.mode = 'train_dense'
+        self.register_option('td:frame_cache_mb')
+        self.register_option('td:frame_cache_file')
+        self._frame_cache = None
+        self._frame_cache_file = None
+        self._file = None
         pass
 
     @property
@@ -31,155 +132,731 @@ class TrackingDataProvider(tfplus.data.DataProvider):
     @property
     def windows(self):
         if self._windows is None:
-            self._windows = self.compute_windows()
+            self._windows, self._window_names = self.load_windows()
         return self._windows
 
     @property
     def split(self):
         return self._split
 
+    @property
+    def mode(self):
+        return self.get_option('td:window_mode')
+
     def get_size(self):
-        if self._windows is None:
-            self._windows = self.compute_windows()
-        return len(self._windows)
+        return len(self.windows)
+
+    def get_window(self, ii):
+        """Get video ID, object ID and start frame of a window."""
+        window = self.windows[ii]
+        video_ids, object_ids = self._window_names
+        return (video_ids[window['video']], object_ids[window['object']],
+                int(window['frame_start']))
+
+    def get_window_meta(self, idx):
+        """Get the stitching metadata of a list of windows.
+
+        Args:
+            idx: window indices.
+
+        Returns:
+            meta: dict of "video_id", "object_id" lists and "frame_start",
+            "keep_start", "keep_end" numpy arrays.
+        """
+        windows = self.windows[np.array(idx, dtype='int64')]
+        video_ids, object_ids = self._window_names
+        return {
+            'video_id': [video_ids[vv] for vv in windows['video']],
+            'object_id': [object_ids[oo] for oo in windows['object']],
+            'frame_start': windows['frame_start'].copy(),
+            'keep_start': windows['keep_start'].copy(),
+            'keep_end': windows['keep_end'].copy()
+        }
+
+    def stitch(self, idx, outputs, tracks=None):
+        """Put per-window outputs back into per-object tracks.
+
+        Only the kept frames of each window are used, so in the eval modes
+        every frame of a track comes from exactly one window.
+
+        Args:
+            idx: window indices of the batch.
+            outputs: numpy array [B, T, ...], model outputs of the batch.
+            tracks: dict to add to, from previous batches.
+
+        Returns:
+            tracks: dict of (video ID, object ID) to dict of frame number to
+            output.
+        """
+        if tracks is None:
+            tracks = {}
+        meta = self.get_window_meta(idx)
+        for kk in xrange(len(idx)):
+            key = (meta['video_id'][kk], meta['object_id'][kk])
+            track = tracks.setdefault(key, {})
+            frm_start = meta['frame_start'][kk]
+            for tt in xrange(meta['keep_start'][kk], meta['keep_end'][kk]):
+                track[frm_start + tt] = outputs[kk, tt]
+                pass
+            pass
+        return tracks
+
+    def get_window_stride(self):
+        """Stride between consecutive windows of an object."""
+        if self.mode == 'eval_no_overlap':
+            return self.get_option('td:window_size')
+        else:
+            return self.get_option('td:window_stride')
+
+    def get_window_fname(self):
+        """File name prefix of the window index of the split."""
+        return '{}_windows_{}_{}_{}'.format(
+            os.path.splitext(self.filename)[0], self.mode,
+            self.get_option('td:window_size'), self.get_window_stride())
+
+    def load_windows(self):
+        """Load the window index, computing and saving it next to the
+        dataset if it is missing or the dataset has changed.
+
+        Both files are written under a temporary name and renamed into
+        place, the .json last, so that a crash or a concurrent build never
+        leaves a partial index behind. If they cannot be written, e.g. in a
+        read-only folder, the index is kept in memory.
+
+        Returns:
+            windows: structured numpy array memory mapped from
+            {prefix}.npy, see compute_windows.
+            names: tuple of video IDs and object IDs lists, the strings of
+            the integer codes, stored in {prefix}.json.
+        """
+        prefix = self.get_window_fname()
+        stat = os.stat(self.filename)
+        names = None
+        if os.path.exists(prefix + '.json') and \
+                os.path.exists(prefix + '.npy'):
+            try:
+                with open(prefix + '.json') as f:
+                    names = json.load(f)
+            except ValueError:
+                names = None
+            if names is not None and (
+                    names.get('src_mtime') != stat.st_mtime or
+                    names.get('src_size') != stat.st_size):
+                names = None
+        if names is not None:
+            try:
+                windows = np.load(prefix + '.npy', mmap_mode='r')
+            except (IOError, ValueError):
+                windows = None
+            if windows is not None and \
+                    windows.shape[0] == names.get('num_windows'):
+                return windows, (names['video_ids'], names['object_ids'])
+            names = None
+
+        windows, video_ids, object_ids = self.compute_windows()
+        names = {
+            'video_ids': video_ids,
+            'object_ids': object_ids,
+            'num_windows': windows.shape[0],
+            'src_mtime': stat.st_mtime,
+            'src_size': stat.st_size
+        }
+        try:
+            _write_atomic(prefix + '.npy', lambda f: np.save(f, windows))
+            _write_atomic(prefix + '.json', lambda f: json.dump(names, f))
+        except (IOError, OSError) as e:
+            self.log.warning(
+                'Could not save window index {}, keeping it in memory: '
+                '{}'.format(prefix, e))
+            return windows, (video_ids, object_ids)
+        windows = np.load(prefix + '.npy', mmap_mode='r')
+        return windows, (names['video_ids'], names['object_ids'])
 
     def compute_windows(self):
         """
         Extracts usable windows from the video sequence.
 
-        Args:
-            mode: how the windows are selected.
-                "train_dense": overlapping windows (stride 1) on valid frame indices.
-                "eval_no_overlap": non-overlapping windows on all frames
+        Windows are selected according to td:window_mode.
+            "train_dense": overlapping windows (td:window_stride apart) on
+            valid frame indices.
+            "eval_no_overlap": non-overlapping windows covering every frame
+            of the object track once.
 
         Returns:
-            windows: list of window metadata.
-                "video_id", "object_id", "frame_start"
+            windows: structured numpy array of WINDOW_DTYPE, video and object
+            codes index video_ids and object_ids.
+            video_ids: list of video IDs.
+            object_ids: list of object IDs.
         """
-        if self.mode != 'train_dense':
-            raise Exception('Mode "{}" not supported'.format(mode))
+        if self.mode not in WINDOW_MODES:
+            raise Exception('Mode "{}" not supported'.format(self.mode))
         window_size = self.get_option('td:window_size')
+        stride = self.get_window_stride()
+        if stride < 1:
+            raise Exception('Window stride must be positive')
         windows = []
+        video_codes = {}
+        object_codes = {}
         with h5py.File(self.filename, 'r') as f:
             video_ids = f.keys()
-            window_count = 0
             for vid in video_ids:
+                video_codes[vid] = len(video_codes)
                 group = f[vid]['annotations']
                 obj_list = group.keys()
+                window_count = 0
                 for oid in obj_list:
-                    frm_idx = group[oid]['frame_indices']
+                    if oid not in object_codes:
+                        object_codes[oid] = len(object_codes)
+                    frm_idx = group[oid]['frame_indices'][:]
                     num_val_frm = frm_idx[-1] - frm_idx[0] + 1
-                    # if oid == 'obj_0051' and vid == '0011':
-                    #     print 'OBJDEBUG', frm_idx[:], num_val_frm
-                    # At least 4
-                    for frm_start in xrange(max(num_val_frm - 4, 1)):
-                        windows.append({
-                            'video_id': vid,
-                            'object_id': oid,
-                            'frame_start': frm_start + frm_idx[0]
-                        })
-                        pass
+                    if self.mode == 'train_dense':
+                        # At least 4
+                        frm_start = np.arange(
+                            0, max(num_val_frm - 4, 1), stride)
+                    else:
+                        frm_start = np.arange(0, num_val_frm, stride)
+                    # Each window keeps the track frames that no earlier
+                    # window has covered, so earlier windows win overlaps.
+                    keep_start = np.zeros(frm_start.shape, dtype='int32')
+                    keep_start[1:] = np.maximum(
+                        frm_start[:-1] + window_size - frm_start[1:], 0)
+                    keep_end = np.minimum(num_val_frm - frm_start,
+                                          window_size)
+                    _windows = np.zeros(frm_start.shape, dtype=WINDOW_DTYPE)
+                    _windows['video'] = video_codes[vid]
+                    _windows['object'] = object_codes[oid]
+                    _windows['frame_start'] = frm_start + frm_idx[0]
+                    _windows['keep_start'] = np.minimum(keep_start, keep_end)
+                    _windows['keep_end'] = keep_end
+                    windows.append(_windows)
+                    window_count += frm_start.shape[0]
                     pass
-                self.log.info('Vid {} Windows {}'.format(vid, len(windows) -
-                                                         window_count))
-                window_count = len(windows)
+                self.log.info('Vid {} Windows {}'.format(vid, window_count))
                 pass
             pass
-        return windows
+        if len(windows) > 0:
+            windows = np.concatenate(windows)
+        else:
+            windows = np.zeros([0], dtype=WINDOW_DTYPE)
+        video_ids = sorted(video_codes.keys(), key=lambda x: video_codes[x])
+        object_ids = sorted(object_codes.keys(),
+                            key=lambda x: object_codes[x])
+        return windows, video_ids, object_ids
+
+    def open(self):
+        """Keep the dataset open for the following get_batch_idx calls."""
+        if self._file is None:
+            self._file = h5py.File(self.filename, 'r')
+        pass
+
+    def close(self):
+        """Close the dataset opened by open."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        pass
+
+    @property
+    def frame_cache(self):
+        if self._frame_cache is None:
+            self._frame_cache = FrameCache(
+                self.get_option('td:frame_cache_mb') * 1024 * 1024)
+        return self._frame_cache
+
+    def decode_frame(self, frm_grp):
+        """Decode a frame at the input size.
+
+        Args:
+            frm_grp: h5py.Group, frame group of the dataset.
+
+        Returns:
+            pixels: [H, W, 12] uint8, image, foreground and orientations.
+            orig_height: height of the original image.
+            orig_width: width of the original image.
+        """
+        inp_height = self.get_option('td:inp_height')
+        inp_width = self.get_option('td:inp_width')
+        pixels = np.zeros([inp_height, inp_width, NUM_FRAME_CHANNELS],
+                          dtype='uint8')
+
+        _img = cv2.imdecode(frm_grp['image'][:], -1)
+        orig_height = _img.shape[0]
+        orig_width = _img.shape[1]
+        pixels[:, :, :3] = cv2.resize(_img, (inp_width, inp_height),
+                                      interpolation=cv2.INTER_CUBIC)
+
+        keys = ['foreground_pred'] + \
+            ['orientation_pred/{:02d}'.format(angle) for angle in xrange(8)]
+        for channel, key in enumerate(keys):
+            _pred = cv2.imdecode(frm_grp[key][:], -1)
+            if _pred.shape[:2] != (inp_height, inp_width):
+                _pred = cv2.resize(_pred, (inp_width, inp_height))
+            pixels[:, :, 3 + channel] = _pred
+
+        return pixels, orig_height, orig_width
+
+    def get_frame_cache_fname(self):
+        """File name prefix of the frame cache file of the split."""
+        return '{}_frames_{}x{}'.format(
+            os.path.splitext(self.filename)[0],
+            self.get_option('td:inp_height'), self.get_option('td:inp_width'))
+
+    def build_frame_cache_file(self):
+        """Decode every frame once into a uint8 memmap next to the dataset.
+
+        Writes {prefix}.npy, [N, H, W, 12] pixels of all frames, and
+        {prefix}_meta.npz, the first row of each video, original image sizes
+        and the mtime and size of the dataset it was built from. Both are
+        written under temporary names of this process and renamed into
+        place, the meta file last, so that an existing meta file always
+        goes with a complete .npy.
+        """
+        prefix = self.get_frame_cache_fname()
+        stat = os.stat(self.filename)
+        with h5py.File(self.filename, 'r') as f:
+            video_ids = sorted(f.keys())
+            num_frames = [len(f[vid]['video'].keys()) for vid in video_ids]
+            video_start = np.concatenate([[0], np.cumsum(num_frames)])
+            self.log.info('Building frame cache {} of {} frames'.format(
+                prefix, video_start[-1]))
+            tmp_fname = '{}.npy.tmp{:d}'.format(prefix, os.getpid())
+            try:
+                pixels = np.lib.format.open_memmap(
+                    tmp_fname, mode='w+', dtype='uint8',
+                    shape=(int(video_start[-1]),
+                           self.get_option('td:inp_height'),
+                           self.get_option('td:inp_width'),
+                           NUM_FRAME_CHANNELS))
+                orig_size = np.zeros([video_start[-1], 2], dtype='int32')
+                for vv, vid in enumerate(video_ids):
+                    for jj in xrange(num_frames[vv]):
+                        frm_grp = f[vid]['video/frm_{:06d}/'.format(jj)]
+                        row = video_start[vv] + jj
+                        pixels[row], orig_size[row, 0], orig_size[row, 1] = \
+                            self.decode_frame(frm_grp)
+                pixels.flush()
+                del pixels
+                os.rename(tmp_fname, prefix + '.npy')
+            except:
+                if os.path.exists(tmp_fname):
+                    os.remove(tmp_fname)
+                raise
+        _write_atomic(prefix + '_meta.npz', lambda fout: np.savez(
+            fout, video_ids=np.array(video_ids), video_start=video_start,
+            orig_size=orig_size, src_mtime=stat.st_mtime,
+            src_size=stat.st_size))
+        pass
+
+    @property
+    def frame_cache_file(self):
+        """Memory mapped frame cache file, built on first use or when the
+        dataset has changed. None if disabled."""
+        if not self.get_option('td:frame_cache_file'):
+            return None
+        if self._frame_cache_file is None:
+            prefix = self.get_frame_cache_fname()
+            meta = None
+            if os.path.exists(prefix + '_meta.npz') and \
+                    os.path.exists(prefix + '.npy'):
+                meta = dict(np.load(prefix + '_meta.npz'))
+                stat = os.stat(self.filename)
+                if meta['src_mtime'] != stat.st_mtime or \
+                        meta['src_size'] != stat.st_size:
+                    meta = None
+            pixels = None
+            if meta is not None:
+                pixels = np.load(prefix + '.npy', mmap_mode='r')
+                if pixels.shape[0] != meta['video_start'][-1]:
+                    meta = None
+            if meta is None:
+                self.build_frame_cache_file()
+                meta = dict(np.load(prefix + '_meta.npz'))
+                pixels = np.load(prefix + '.npy', mmap_mode='r')
+            video_row = dict(zip(meta['video_ids'].tolist(),
+                                 meta['video_start'].tolist()))
+            self._frame_cache_file = {
+                'pixels': pixels,
+                'video_row': video_row,
+                'orig_size': meta['orig_size']
+            }
+        return self._frame_cache_file
+
+    def get_frame(self, f, vid, frm):
+        """Get a decoded frame from the cache file, the in-process cache, or
+        by decoding it.
+
+        Args:
+            f: h5py.File, opened dataset.
+            vid: video ID.
+            frm: frame index.
+
+        Returns:
+            pixels, orig_height, orig_width: see decode_frame.
+        """
+        cache_file = self.frame_cache_file
+        if cache_file is not None:
+            row = cache_file['video_row'][vid] + frm
+            return (cache_file['pixels'][row],
+                    cache_file['orig_size'][row, 0],
+                    cache_file['orig_size'][row, 1])
+
+        cache = self.frame_cache
+        entry = cache.get((vid, frm))
+        if entry is None:
+            entry = self.decode_frame(f[vid]['video/frm_{:06d}/'.format(frm)])
+            cache.put((vid, frm), entry)
+        return entry
+
+    def get_batch_spec(self, batch_size, variables=None):
+        """Get the shapes and types of the batch variables.
+
+        Args:
+            batch_size: number of windows in a batch.
+            variables: names of the variables, default all of them.
+
+        Returns:
+            spec: dict of variable name to (shape, dtype).
+        """
+        if variables is None:
+            variables = BATCH_VARIABLES
+        window_size = self.get_option('td:window_size')
+        inp_height = self.get_option('td:inp_height')
+        inp_width = self.get_option('td:inp_width')
+        frame_shape = [batch_size, window_size, inp_height, inp_width]
+        spec = {
+            'x': (frame_shape + [3], 'float32'),
+            'fg': (frame_shape + [1], 'float32'),
+            'angle': (frame_shape + [8], 'float32'),
+            'bbox_gt': ([batch_size, window_size, 4], 'float32'),
+            's_gt': ([batch_size, window_size], 'float32')
+        }
+        return dict([(key, spec[key]) for key in variables])
 
     def get_batch_idx(self, idx, **kwargs):
+        """Assemble a batch of windows.
+
+        Args:
+            idx: window indices.
+            variables: names of the variables to assemble, default all.
+            out: dict of preallocated arrays to write the variables into,
+            with at least len(idx) rows, see get_batch_spec.
+        """
         # Remember that the images are not resized to uniform size.
         # Remember to normalize the bounding box
         # coordinates.
         if 'variables' in kwargs:
             variables = kwargs['variables']
         else:
-            variables = set(['x', 'fg', 'angle', 'bbox_gt', 's_gt'])
+            variables = set(BATCH_VARIABLES)
         num_ex = len(idx)
         window_size = self.get_option('td:window_size')
         inp_height = self.get_option('td:inp_height')
         inp_width = self.get_option('td:inp_width')
-        images = np.zeros([num_ex, window_size, inp_height, inp_width, 3],
-                          dtype='float32')
-        fg = np.zeros([num_ex, window_size, inp_height,
-                       inp_width, 1], dtype='float32')
-        orient = np.zeros([num_ex, window_size, inp_height, inp_width, 8],
-                          dtype='float32')
-
-        bbox = np.zeros([num_ex, window_size, 4], dtype='float32')
-        presence = np.zeros([num_ex, window_size], dtype='float32')
+        scale = np.float32(255.0)
+        spec = self.get_batch_spec(num_ex, set(variables) |
+                                   set(['bbox_gt', 's_gt']))
+        if 'out' in kwargs:
+            results = {}
+            for key in spec:
+                if key in kwargs['out']:
+                    results[key] = kwargs['out'][key][:num_ex]
+                    results[key][...] = 0
+                else:
+                    results[key] = np.zeros(*spec[key])
+        else:
+            results = dict([(key, np.zeros(*spec[key])) for key in spec])
+        images = results.get('x')
+        fg = results.get('fg')
+        orient = results.get('angle')
+        bbox = results['bbox_gt']
+        presence = results['s_gt']
+        orig_size = np.zeros([window_size, 2], dtype='float64')
 
-        with h5py.File(self.filename, 'r') as f:
+        f = self._file
+        if f is None:
+            f = h5py.File(self.filename, 'r')
+        try:
             for kk, ii in enumerate(idx):
-                window = self.windows[ii]
-                vid = window['video_id']
-                oid = window['object_id']
-                frm_start = window['frame_start']
+                vid, oid, frm_start = self.get_window(ii)
                 vid_group = f[vid]
                 obj_group = vid_group['annotations'][oid]
-                val_frm_idx = obj_group['frame_indices'][:]
-                num_frm = len(vid_group['video'].keys())
+                num_frm = len(vid_group['video'])
                 frm_end = min(frm_start + window_size, num_frm)
-                # print frm_start, frm_end
-                # print 'Ex', kk, 'vid', vid, 'object', oid, frm_start, num_frm
-                count = 0
-                for jj in xrange(frm_start, frm_end):
-                    frm_grp = vid_group['video/frm_{:06d}/'.format(jj)]
-                    _img = frm_grp['image'][:]
-                    _img = cv2.imdecode(_img, -1)
-
-                    _fg = frm_grp['foreground_pred'][:]
-                    _fg = cv2.imdecode(_fg, -1)
-                    _fg = np.expand_dims(_fg, -1)
-
-                    _orient = []
-                    for angle in xrange(8):
-                        orik = 'orientation_pred/{:02d}'.format(angle)
-                        _ori = frm_grp[orik][:]
-                        _ori = cv2.imdecode(_ori, -1)
-                        _orient.append(np.expand_dims(_ori, -1))
-                    _orient = np.concatenate(_orient, axis=-1)
-
-                    orig_height = _img.shape[0]
-                    orig_width = _img.shape[1]
-                    _img = cv2.resize(_img, (inp_width, inp_height),
-                                      interpolation=cv2.INTER_CUBIC)
-                    images[kk, jj - frm_start, :, :] = _img
-                    fg[kk] = _fg
-                    orient[kk] = _orient
-
-                    val_frm = set(val_frm_idx).intersection(
-                        set(range(frm_start, frm_end)))
-                    
-                    # print 'Intersection', kk, val_frm_idx, frm_start, frm_end
-
-                    if jj in val_frm_idx:
-                        presence[kk, jj - frm_start] = 1.0
-                        bbox_ = obj_group['bbox'][count]
-                        # Resize boxes.
-                        bbox_[0] = bbox_[0] / orig_width * inp_width
-                        bbox_[1] = bbox_[1] / orig_height * inp_height
-                        bbox_[2] = bbox_[2] / orig_width * inp_width
-                        bbox_[3] = bbox_[3] / orig_height * inp_height
-                        bbox[kk, jj - frm_start] = bbox_
-                        # print 'Bbox', kk, jj - frm_start, bbox_
-                        count += 1
+
+                # Frames are written in place, already divided by 255.
+                for tt in xrange(frm_end - frm_start):
+                    _pixels, orig_height, orig_width = self.get_frame(
+                        f, vid, frm_start + tt)
+                    orig_size[tt] = (orig_width, orig_height)
+                    if images is not None:
+                        np.divide(_pixels[:, :, :3], scale,
+                                  out=images[kk, tt])
+                    if fg is not None:
+                        np.divide(_pixels[:, :, 3: 4], scale, out=fg[kk, tt])
+                    if orient is not None:
+                        np.divide(_pixels[:, :, 4:], scale,
+                                  out=orient[kk, tt])
                     pass
+
+                # Boxes of the valid frames inside the window are contiguous
+                # rows since the frame indices are sorted.
+                val_frm_idx = obj_group['frame_indices'][:]
+                row_start, row_end = np.searchsorted(
+                    val_frm_idx, [frm_start, frm_end])
+                if row_end > row_start:
+                    tt = val_frm_idx[row_start: row_end] - frm_start
+                    presence[kk, tt] = 1.0
+                    bbox_ = obj_group['bbox'][row_start: row_end]
+                    # Resize boxes.
+                    bbox_ = bbox_ / np.tile(orig_size[tt], [1, 2])
+                    bbox_ *= [inp_width, inp_height, inp_width, inp_height]
+                    bbox[kk, tt] = bbox_
                 pass
-            pass
+        finally:
+            if f is not self._file:
+                f.close()
+
+        return dict([(key, results[key]) for key in variables])
+
+
+def _batch_loader_worker(provider, worker_id, seed, variables, buffers,
+                         tasks, results, frame_cache_mb):
+    """Assemble batches into shared memory slots in a loader process."""
+    np.random.seed([seed, worker_id])
+    random.seed((seed, worker_id))
+    # In-process frame cache with this worker's share of the budget.
+    provider.set_option('td:frame_cache_mb', frame_cache_mb)
+    provider._frame_cache = None
+    provider.open()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            step, slot, idx = task
+            try:
+                provider.get_batch_idx(
+                    idx, variables=variables, out=buffers[slot])
+            except Exception:
+                results.put(('error', traceback.format_exc()))
+                break
+            results.put(('ok', step))
+    finally:
+        provider.close()
+    results.close()
+    results.join_thread()
+
+    pass
+
+
+class BatchLoader(object):
+    """Iterates batches of a TrackingDataProvider assembled by a pool of
+    processes.
 
-        results = {}
-        if 'x' in variables:
-            results['x'] = images / 255.0
-        if 'fg' in variables:
-            results['fg'] = fg / 255.0
-        if 'angle' in variables:
-            results['angle'] = orient / 255.0
-        if 'bbox_gt' in variables:
-            results['bbox_gt'] = bbox
-        if 's_gt' in variables:
-            results['s_gt'] = presence
-        return results
+    Each worker keeps the dataset open and writes whole batches into shared
+    memory slots. Batch i is always assembled by worker i % num_workers and
+    the random state of a worker only depends on the seed and its ID, so
+    runs with the same seed are reproducible.
+
+    The window index and the frame cache file are prepared before forking,
+    so the workers share them instead of each building its own. The budget
+    of the in-process frame cache, td:frame_cache_mb, is split between the
+    workers.
+
+    The arrays returned by next are views of a slot that is reused once next
+    is called again. Copy them to keep a batch around longer.
+    """
+
+    def __init__(self, provider, batch_size=1, shuffle=True, cycle=True,
+                 num_workers=4, num_slots=None, seed=0, variables=None):
+        """Construct a batch loader.
+
+        Args:
+            provider: TrackingDataProvider instance.
+            batch_size: number, windows per batch.
+            shuffle: bool, whether to shuffle windows every epoch.
+            cycle: bool, whether to go over the windows repeatedly.
+            num_workers: number, number of worker processes.
+            num_slots: number, number of batch buffers, at least 2, default
+            num_workers + 1.
+            seed: number, seed of the window order and the workers.
+            variables: names of the batch variables, default all.
+        """
+        if num_workers < 1:
+            raise Exception('Number of workers must be at least 1')
+        if num_slots is None:
+            num_slots = num_workers + 1
+        if num_slots < 2:
+            raise Exception('Number of slots must be at least 2')
+        if variables is None:
+            variables = BATCH_VARIABLES
+        self._num = provider.get_size()
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._cycle = cycle
+        self._random = np.random.RandomState(seed)
+        self._num_slots = num_slots
+        self._order = np.zeros([0], dtype='int64')
+        self._exhausted = False
+        self._batch_idx = {}
+        self._ready = set()
+        self._next_submit = 0
+        self._next_out = 0
+        self._closed = False
+
+        # Stats.
+        self._num_batches = 0
+        self._wait_time = 0.0
+
+        # Slots are allocated before forking, so workers share them.
+        spec = provider.get_batch_spec(batch_size, variables)
+        self._buffers = []
+        for ii in xrange(num_slots):
+            slot = {}
+            for key in spec:
+                shape, dtype = spec[key]
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                raw = multiprocessing.RawArray('b', nbytes)
+                slot[key] = np.frombuffer(raw, dtype=dtype).reshape(shape)
+            self._buffers.append(slot)
+
+        # Built once here, the workers inherit them.
+        provider.windows
+        provider.frame_cache_file
+        frame_cache_mb = provider.get_option('td:frame_cache_mb') / num_workers
+
+        self._tasks = []
+        self._results = multiprocessing.Queue()
+        self._workers = []
+        for ii in xrange(num_workers):
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=_batch_loader_worker,
+                args=(provider, ii, seed, variables, self._buffers, tasks,
+                      self._results, frame_cache_mb))
+            worker.daemon = True
+            worker.start()
+            self._tasks.append(tasks)
+            self._workers.append(worker)
+        self._submit()
+
+        pass
+
+    def __iter__(self):
+        """Get an iterator."""
+        return self
+
+    def __enter__(self):
+        """Enter with clause."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Exit with clause."""
+        if self._closed:
+            return
+        self._closed = True
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+        pass
+
+    def _get_next_idx(self):
+        """Get the window indices of the next batch, None after the last."""
+        if self._exhausted:
+            return None
+        while self._order.size < self._batch_size:
+            if self._next_submit > 0 and not self._cycle:
+                break
+            if self._shuffle:
+                order = self._random.permutation(self._num)
+            else:
+                order = np.arange(self._num)
+            self._order = np.concatenate([self._order, order])
+            if not self._cycle:
+                break
+        if self._order.size == 0:
+            self._exhausted = True
+            return None
+        idx = self._order[:self._batch_size]
+        self._order = self._order[self._batch_size:]
+
+        return idx
+
+    def _submit(self):
+        """Send batches to the workers while there are free slots."""
+        while self._next_submit < self._next_out + self._num_slots:
+            idx = self._get_next_idx()
+            if idx is None:
+                break
+            step = self._next_submit
+            self._batch_idx[step] = idx
+            self._tasks[step % len(self._tasks)].put(
+                (step, step % self._num_slots, idx))
+            self._next_submit += 1
+
+        pass
+
+    def next(self):
+        """Get the next batch.
+
+        Returns:
+            batch: dict of variable name to array view, see get_batch_idx.
+        """
+        if self._closed:
+            raise StopIteration()
+        # The slot of the previous batch is free again.
+        self._submit()
+        step = self._next_out
+        if step == self._next_submit:
+            raise StopIteration()
+
+        start = time.time()
+        while step not in self._ready:
+            try:
+                status, content = self._results.get(timeout=1)
+            except Queue.Empty:
+                if not all([worker.is_alive() for worker in self._workers]):
+                    self.close()
+                    raise Exception('Loader worker exited unexpectedly')
+                continue
+            if status == 'error':
+                self.close()
+                raise Exception('Loader worker failed:\n{}'.format(content))
+            self._ready.add(content)
+        self._wait_time += time.time() - start
+        self._ready.remove(step)
+        num_ex = len(self._batch_idx.pop(step))
+        self._next_out += 1
+        self._num_batches += 1
+        slot = self._buffers[step % self._num_slots]
+
+        return dict([(key, slot[key][:num_ex]) for key in slot])
+
+    def get_stats(self):
+        """Get loader stats.
+
+        Returns:
+            stats: dict, number of batches consumed, total and mean time
+            spent waiting for a batch in seconds.
+        """
+        num_batches = max(self._num_batches, 1)
+
+        return {
+            'num_batches': self._num_batches,
+            'wait_time': self._wait_time,
+            'mean_wait_time': self._wait_time / num_batches
+        }
+
+    def close(self):
+        """Stop the workers."""
+        self.__exit__(None, None, None)
+
+        pass
 
 if __name__ == '__main__':
     dp = TrackingDataProvider(
@@ -0,0 +1,58 @@
+"""
+Benchmarks of the tracking data provider.
+
+Usage:
+    python tracking_data_provider_bench.py batch --filename train.h5
+"""
+
+import argparse
+import logger
+import numpy
+import time
+import tracking_data_provider as tdp
+
+log = logger.get()
+
+
+def bench_batch(filename, batch_size, num_batches, frame_cache_mb_list):
+    """Batch assembly time per window, with and without the frame cache.
+
+    Args:
+        filename: string, tracking dataset.
+        batch_size: number, windows per batch.
+        num_batches: number, batches to time.
+        frame_cache_mb_list: list, frame cache budgets to compare.
+    """
+    for frame_cache_mb in frame_cache_mb_list:
+        dp = tdp.TrackingDataProvider(filename=filename)
+        dp.set_option('td:frame_cache_mb', frame_cache_mb)
+        num_windows = dp.get_size()
+        random = numpy.random.RandomState(0)
+        batches = [random.randint(0, num_windows, batch_size)
+                   for ii in xrange(num_batches + 1)]
+        # Warm up, not timed.
+        dp.get_batch_idx(batches[0])
+        start = time.time()
+        for idx in batches[1:]:
+            dp.get_batch_idx(idx)
+        elapsed = time.time() - start
+        log.info('Frame cache {:5d}MB: {:.2f}ms per window'.format(
+            frame_cache_mb, elapsed * 1e3 / (batch_size * num_batches)))
+    pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tracking data benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_batch = subparsers.add_parser(
+        'batch', help='Batch assembly time per window')
+    parser_batch.add_argument('--filename', required=True)
+    parser_batch.add_argument('--batch_size', type=int, default=8)
+    parser_batch.add_argument('--num_batches', type=int, default=20)
+    parser_batch.add_argument('--frame_cache_mb', type=int, nargs='+',
+                              default=[0, 1024])
+    args = parser.parse_args()
+
+    if args.command == 'batch':
+        bench_batch(args.filename, args.batch_size, args.num_batches,
+                    args.frame_cache_mb)
@@ -18,7 +18,6 @@ import tensorflow as tf
 import time
 
 import logger
-from batch_iter import BatchIterator
 from lazy_registerer import LazyRegisterer
 from log_manager import LogManager
 from saver import Saver
@@ -29,7 +28,7 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import plot_utils as pu
 
-from patch_data import KITTIPatchData
+from patch_data import KITTIPatchData, PatchSampler
 import matching_model as model
 
 
@@ -40,13 +39,25 @@ def get_model(opt, device='/cpu:0'):
     return model.get_model(opt, device)
 
 
-def get_dataset(opt):
+def get_dataset(opt, batch_size, num_workers):
+    """Get patch samplers, batches are sampled on the fly from the frames.
+
+    The trainval and valid samplers are only used for statistics and plots,
+    they are reset before each use so that they always give the same
+    _get_num_batch_valid() batches.
+    """
     dataset = {}
     folder = '/ais/gobi4/mren/data/kitti/tracking/training'
-    dataset['train'] = KITTIPatchData(
-        folder, opt, split='train', usage='match').get_dataset()
-    dataset['valid'] = KITTIPatchData(
-        folder, opt, split='valid', usage='match').get_dataset()
+    for name, split in [('train', 'train'), ('trainval', 'train'),
+                        ('valid', 'valid')]:
+        patch_data = KITTIPatchData(folder, opt, split=split, usage='match')
+        if name == 'train':
+            num_prefetch = 8
+        else:
+            num_prefetch = _get_num_batch_valid()
+        dataset[name] = PatchSampler(
+            patch_data, batch_size, num_workers=num_workers,
+            num_prefetch=num_prefetch)
 
     return dataset
 
@@ -77,16 +88,10 @@ def plot_output(fname, x1, x2, y_gt, y_out):
     plt.close('all')
 
 
-def _get_batch_fn(dataset):
-    def get_batch(idx):
-        x1_bat = dataset['images_0'][idx]
-        x2_bat = dataset['images_1'][idx]
-        y_bat = dataset['labels'][idx]
-        x1_bat, x2_bat, y_bat = preprocess(x1_bat, x2_bat, y_bat)
-
-        return x1_bat, x2_bat, y_bat
-
-    return get_batch
+def _get_batch_iter(sampler):
+    for batch in sampler:
+        yield preprocess(batch['images_0'], batch['images_1'],
+                         batch['labels'])
 
 
 def _run_model(sess, m, names, feed_dict):
@@ -121,6 +126,7 @@ def _add_dataset_args(parser):
     parser.add_argument('--center_noise', default=kCenterNoise, type=float)
     parser.add_argument('--num_ex_pos', default=kNumExPos, type=int)
     parser.add_argument('--num_ex_neg', default=kNumExNeg, type=int)
+    parser.add_argument('--num_workers', default=4, type=int)
 
     pass
 
@@ -384,7 +390,7 @@ if __name__ == '__main__':
     m = get_model(model_opt, device=device)
 
     log.info('Loading dataset')
-    dataset = get_dataset(data_opt)
+    dataset = get_dataset(data_opt, args.batch_size, args.num_workers)
 
     sess = tf.Session()
 
@@ -406,12 +412,7 @@ if __name__ == '__main__':
 
     batch_size = args.batch_size
     log.info('Batch size: {}'.format(batch_size))
-    num_ex_train = dataset['train']['labels'].shape[0]
-    get_batch_train = _get_batch_fn(dataset['train'])
-    log.info('Number of training examples: {}'.format(num_ex_train))
-    num_ex_valid = dataset['valid']['labels'].shape[0]
-    get_batch_valid = _get_batch_fn(dataset['valid'])
-    log.info('Number of validation examples: {}'.format(num_ex_valid))
+    batch_iter_train = _get_batch_iter(dataset['train'])
 
     def run_samples():
         """Samples"""
@@ -427,11 +428,12 @@ if __name__ == '__main__':
         _ssets = ['train', 'valid']
         for _set in _ssets:
             _is_train = _set == 'train'
-            _get_batch = get_batch_train if _is_train else get_batch_valid
-            _num_ex = num_ex_train if _is_train else num_ex_valid
+            _sampler = dataset['trainval' if _is_train else 'valid']
+            _sampler.reset()
             log.info('Plotting {} samples'.format(_set))
-            _x1, _x2, _y = _get_batch(
-                np.arange(min(_num_ex, args.num_samples_plot)))
+            _x1, _x2, _y = [_v[: args.num_samples_plot]
+                            for _v in _get_batch_iter(_sampler).next()]
+            _sampler.reset()
 
             labels = ['output']
             fname_output = samples['output_{}'.format(_set)].get_fname()
@@ -452,10 +454,12 @@ if __name__ == '__main__':
 
         return _outputs
 
-    def run_stats(step, num_batch, batch_iter, outputs, write_log, phase_train):
-        """Validation"""
+    def run_stats(step, num_batch, sampler, outputs, write_log, phase_train):
+        """Validation, on the first num_batch batches of sampler."""
         nvalid = num_batch * batch_size
         r = {}
+        sampler.reset()
+        batch_iter = _get_batch_iter(sampler)
 
         for bb in xrange(num_batch):
             _x1, _x2, _y = batch_iter.next()
@@ -473,6 +477,9 @@ if __name__ == '__main__':
         log.info('{:d} loss {:.4f}'.format(step, r['loss']))
         write_log(step, loggers, r)
 
+        # Prefetch the same batches for the next evaluation.
+        sampler.reset()
+
         pass
 
     def write_log_valid(step, loggers, r):
@@ -508,36 +515,22 @@ if __name__ == '__main__':
 
     def train_loop(step=0):
         """Train loop"""
-        batch_iter_valid = BatchIterator(num_ex_valid,
-                                         batch_size=batch_size,
-                                         get_fn=get_batch_valid,
-                                         cycle=True,
-                                         progress_bar=False)
         outputs_valid = get_outputs_valid()
         num_batch_valid = _get_num_batch_valid()
-        batch_iter_trainval = BatchIterator(num_ex_train,
-                                            batch_size=batch_size,
-                                            get_fn=get_batch_train,
-                                            cycle=True,
-                                            progress_bar=False)
         outputs_trainval = get_outputs_trainval()
 
-        for _x1, _x2, _y in BatchIterator(num_ex_train,
-                                          batch_size=batch_size,
-                                          get_fn=get_batch_train,
-                                          cycle=True,
-                                          progress_bar=False):
+        for _x1, _x2, _y in batch_iter_train:
             # Run validation stats
             if step % train_opt['steps_per_valid'] == 0:
                 log.info('Running validation')
-                run_stats(step, num_batch_valid, batch_iter_valid,
+                run_stats(step, num_batch_valid, dataset['valid'],
                           outputs_valid, write_log_valid, False)
                 pass
 
             # Train stats
             if step % train_opt['steps_per_trainval'] == 0:
                 log.info('Running train validation')
-                run_stats(step, num_batch_valid, batch_iter_trainval,
+                run_stats(step, num_batch_valid, dataset['trainval'],
                           outputs_trainval, write_log_trainval, True)
                 pass
 
@@ -569,6 +562,8 @@ if __name__ == '__main__':
 
     train_loop(step=step)
 
+    for sampler in dataset.itervalues():
+        sampler.close()
     sess.close()
     for logger in loggers.itervalues():
         logger.close()